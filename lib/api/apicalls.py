@@ -2,14 +2,23 @@
 
 
 import json
+import threading
+import time
 
 import connexion
+from celery.exceptions import TimeoutError as TaskTimeoutError
+from celery.result import AsyncResult
 
 # needed because eval() will instantiate a Datum object in get_data
 from lib.backend.tasks.payment import tasks as payment_tasks
 from lib.backend.tasks.data_source import tasks as data_source_tasks
 from lib.backend.tasks.user import tasks as user_tasks
 from lib.backend.tasks.query import tasks as query_tasks
+from lib.backend.database import DatabaseConnector
+from lib.backend.write_buffer import WriteBuffer
+from lib.config import Configuration
+from lib.data_sources import codec
+from lib.data_structures import enums
 from lib.data_structures import QueryState
 from lib.data_structures import User, Processor
 from lib.data_structures import JwtToken
@@ -17,6 +26,65 @@ from lib.data_structures import JwtToken
 call_timeout = 10
 call_timeout_long = 30
 
+_waiters = None
+_waiters_lock = threading.Lock()
+
+
+def _wait_for(result, timeout=call_timeout):
+    """ Wait for the result of a task.
+
+        At most Configuration.api_max_waiters requests wait for results at
+        the same time, further requests wait for a free slot. Waiting for a
+        slot and for the result together take at most the timeout. A task
+        which failed yields an error response instead of raising.
+
+    Raises:
+        - celery.exceptions.TimeoutError: if there is no result within the timeout """
+    global _waiters
+    deadline = time.monotonic() + timeout
+    with _waiters_lock:
+        if _waiters is None:
+            _waiters = threading.BoundedSemaphore(Configuration.api_max_waiters)
+    if not _waiters.acquire(timeout=timeout):
+        raise TaskTimeoutError("Too many requests are waiting for results.")
+    try:
+        remaining = deadline - time.monotonic()
+        # a timeout of 0 would make get() wait forever
+        if remaining <= 0 and not result.ready():
+            raise TaskTimeoutError("The operation timed out.")
+        response = result.get(timeout=max(remaining, 0.001), propagate=False)
+    finally:
+        _waiters.release()
+    if result.failed():
+        return {'success': False, 'error': {'code': enums.Error.UNDEFINED, 'message': "Task failed ({}): {}".format(result.state, response)}}
+    return response
+
+
+def _read(task, *args):
+    """ Run a read-only task.
+
+        If Configuration.api_direct_reads is set, the task runs in the API
+        process on its own database connection pool, otherwise it is sent
+        to a worker like any other task. Direct reads are only enabled with
+        a database driver cooperating with gevent (see lib.api.endpoint). """
+    if not Configuration.api_direct_reads:
+        return _wait_for(task.delay(*args))
+    try:
+        return task(*args)
+    finally:
+        DatabaseConnector.remove_session()
+
+
+def _is_async_request():
+    """ Whether the client asked to receive a task handle instead of the result (header mynedata-async). """
+    return connexion.request.headers.get('mynedata-async', '').lower() in ['1', 'true', 'yes']
+
+
+def _accepted(result, uid, scope):
+    """ Response for an asynchronously dispatched task, the handle can be polled at /task/{task_handle}. """
+    response = {'task_id': result.id, 'task_handle': JwtToken.generate_task_handle(uid, result.id, scope)}
+    return {'success': True, 'response': response}, 202
+
 
 def add_available_data_source(source_type, source_id):
     """ Debug function to add new data sources on the fly.
@@ -38,7 +106,7 @@ def add_available_data_source(source_type, source_id):
         (returns error only if success == False)
     """
     result = data_source_tasks.add_available_data_source.delay(source_type, int(source_id))
-    return result.get(timeout=call_timeout)
+    return _wait_for(result)
 
 
 # path: /user/{username}/unregister method: POST
@@ -75,7 +143,7 @@ def unregister_user(username, passw):
     if JwtToken.check_token(tok, uuid, scope='user'):
         pw = passw['password']
         result = user_tasks.user_remove.delay(uuid, pw)
-        res = result.get(timeout=call_timeout)
+        res = _wait_for(result)
         if "error" in res:
             return res, 400
         return res
@@ -145,7 +213,7 @@ def register_user(username, user_data):
         btc_address,
         anon
     )
-    res = result.get(timeout=call_timeout)
+    res = _wait_for(result)
     if "error" in res:
         return res, 400
     return res
@@ -199,7 +267,7 @@ def update_user(username, user_data):
             gender,
             password
         )
-        res = result.get(timeout=call_timeout)
+        res = _wait_for(result)
         if "error" in res:
             return res, 400
         return res
@@ -233,7 +301,7 @@ def login_user(username, passw):
     pw = passw['password']
     uuid = User.derive_uid(username)
     result = user_tasks.check_login.delay(uuid, pw)
-    res = result.get(timeout=call_timeout)
+    res = _wait_for(result)
     if res:
         token = user_tasks.finish_user_login(uuid)
         if token is None:
@@ -330,8 +398,7 @@ def get_profile_user(username):
     tok = connexion.request.headers['mynedata-token']
     uuid = User.derive_uid(username)
     if JwtToken.check_token(tok, uuid, scope='user'):
-        result = user_tasks.get_user_profile.delay(uuid)
-        res = result.get(timeout=call_timeout)
+        res = _read(user_tasks.get_user_profile, uuid)
         if "error" in res:
             return res, 400
         return res
@@ -370,7 +437,7 @@ def get_data_source_privacy_user(username):
     uid = User.derive_uid(username)
     if JwtToken.check_token(tok, uid, scope='user'):
         result = data_source_tasks.list_data_source_privacy_levels.delay(uid, None)
-        res = result.get(timeout=call_timeout)
+        res = _wait_for(result)
         if "error" in res:
             return res, 400
         return res
@@ -407,7 +474,7 @@ def set_data_source_privacy_user(username, privacy_setting):
     uid = User.derive_uid(username)
     if JwtToken.check_token(tok, uid, scope='user'):
         result = data_source_tasks.set_all_data_source_privacy_levels.delay(uid, privacy_setting)
-        res = result.get(timeout=call_timeout)
+        res = _wait_for(result)
         if "error" in res:
             return res, 400
         return res
@@ -441,7 +508,7 @@ def get_default_privacy_user(username):
     uid = User.derive_uid(username)
     if JwtToken.check_token(tok, uid, scope='user'):
         result = user_tasks.list_default_privacy_levels.delay(uid, None)
-        res = result.get(timeout=call_timeout)
+        res = _wait_for(result)
         if "error" in res:
             return res, 400
         return res
@@ -477,7 +544,7 @@ def set_default_privacy_user(username, default_privacy):
     uid = User.derive_uid(username)
     if JwtToken.check_token(tok, uid, scope='user'):
         result = user_tasks.set_default_privacy_levels.delay(uid, default_privacy['privacy_levels'])
-        res = result.get(timeout=call_timeout)
+        res = _wait_for(result)
         if "error" in res:
             return res, 400
         return res
@@ -521,7 +588,7 @@ def unregister_processor(username, passw):
     if JwtToken.check_token(tok, puid, scope='processor'):
         pw = passw['password']
         result = user_tasks.proc_remove.delay(puid, pw, tok)
-        res = result.get(timeout=call_timeout)
+        res = _wait_for(result)
         if "error" in res:
             return res, 400
         return res
@@ -555,7 +622,7 @@ def register_processor(username, passw):
     puid = Processor.derive_uid(username)
     password = passw['password']
     result = user_tasks.proc_register.delay(puid, username, password)
-    res = result.get(timeout=call_timeout)
+    res = _wait_for(result)
     if "error" in res:
         return res, 400
     return res
@@ -585,7 +652,7 @@ def login_processor(username, passw):
     pw = passw['password']
     puid = Processor.derive_uid(username)
     result = user_tasks.check_login.delay(puid, pw)
-    res = result.get(timeout=call_timeout)
+    res = _wait_for(result)
     if res:
         token = user_tasks.finish_proc_login(username)
         result = {}
@@ -623,7 +690,7 @@ def logout_processor(username):
     puid = Processor.derive_uid(username)
     if JwtToken.check_token(tok, puid, scope='processor'):
         result = user_tasks.proc_logout.delay(puid)
-        res = result.get(timeout=call_timeout)
+        res = _wait_for(result)
         if "error" in res:
             return res, 400
         return res
@@ -676,7 +743,7 @@ def get_processor_profile(username):
         token_scope = 'processor'
     if JwtToken.check_token(tok, uid, scope=token_scope):
         result = user_tasks.get_proc_profile.delay(uid, is_user=is_user)
-        res = result.get(timeout=call_timeout)
+        res = _wait_for(result)
         if "error" in res:
             return res, 400
         return res
@@ -713,7 +780,7 @@ def set_profile_processor(username, processor_profile):
     uuid = Processor.derive_uid(username)
     if JwtToken.check_token(tok, uuid, scope='processor'):
         result = user_tasks.set_processor_profile.delay(uuid, processor_profile)
-        res = result.get(timeout=call_timeout)
+        res = _wait_for(result)
         if "error" in res:
             return res, 400
         return res
@@ -749,7 +816,7 @@ def get_privacy_processor(username, _):
     if JwtToken.check_token(tok, proc_id, scope='everyone'):
         # FIXME Function does not exist!
         result = data_source_tasks.list_privacy_levels.delay(username, tok)
-        res = result.get(timeout=call_timeout)
+        res = _wait_for(result)
         if "error" in res:
             return res, 400
         return res
@@ -806,8 +873,7 @@ def list_data_sources(username, detail):
     tok = connexion.request.headers['mynedata-token']
     uuid = User.derive_uid(username)
     if JwtToken.check_token(tok, uuid, scope='user'):
-        result = data_source_tasks.get_data_source_list.delay(uuid, detail)
-        res = result.get(timeout=call_timeout)
+        res = _read(data_source_tasks.get_data_source_list, uuid, detail)
         if "error" in res:
             return res, 400
         return res
@@ -864,7 +930,7 @@ def register_data_source(username, source_id, parameters):
             parameters['privacy_settings'],
             None
         )
-        res = result.get(timeout=call_timeout)
+        res = _wait_for(result)
         if "error" in res:
             return res, 400
         return res
@@ -921,7 +987,7 @@ def get_data_source_information(username, source_id):
     uuid = User.derive_uid(username)
     if JwtToken.check_token(tok, uuid, scope='user'):
         result = data_source_tasks.get_data_source_information.delay(uuid, source_id)
-        res = result.get(timeout=call_timeout)
+        res = _wait_for(result)
         if "error" in res:
             return res, 400
         return res
@@ -958,7 +1024,7 @@ def remove_data_source(username, source_id):
     uuid = User.derive_uid(username)
     if JwtToken.check_token(tok, uuid, scope='user'):
         result = data_source_tasks.remove_data_source.delay(uuid, source_id)
-        res = result.get(timeout=call_timeout)
+        res = _wait_for(result)
         if "error" in res:
             return res, 400
         return res
@@ -996,7 +1062,7 @@ def get_data_source_privacy(username, source_id):
     uuid = User.derive_uid(username)
     if JwtToken.check_token(tok, uuid, scope='user'):
         result = data_source_tasks.get_data_source_privacy_level.delay(uuid, source_id)
-        res = result.get(timeout=call_timeout)
+        res = _wait_for(result)
         if "error" in res:
             return res, 400
         return res
@@ -1036,7 +1102,7 @@ def set_data_source_privacy(username, source_id, data_source_privacy):
             source_id,
             data_source_privacy['privacy_settings']
         )
-        res = result.get(timeout=call_timeout)
+        res = _wait_for(result)
         if "error" in res:
             return res, 400
         return res
@@ -1070,8 +1136,7 @@ def get_data_source_granularity(username, source_id):
     tok = connexion.request.headers['mynedata-token']
     uuid = User.derive_uid(username)
     if JwtToken.check_token(tok, uuid, scope='user'):
-        result = data_source_tasks.get_granularity.delay(uuid, source_id)
-        res = result.get(timeout=call_timeout)
+        res = _read(data_source_tasks.get_granularity, uuid, source_id)
         if "error" in res:
             return res, 400
         return res
@@ -1105,7 +1170,7 @@ def set_data_source_granularity(username, source_id, granularity_setting):
     uuid = User.derive_uid(username)
     if JwtToken.check_token(tok, uuid, scope='user'):
         result = data_source_tasks.set_granularity.delay(uuid, source_id, granularity_setting['interval'])
-        res = result.get(timeout=call_timeout)
+        res = _wait_for(result)
         if "error" in res:
             return res, 400
         return res
@@ -1139,7 +1204,7 @@ def get_data_source_token(username, source_id):
     uuid = User.derive_uid(username)
     if JwtToken.check_token(tok, uuid, scope='user'):
         result = data_source_tasks.get_access_token.delay(uuid, source_id)
-        res = result.get(timeout=call_timeout)
+        res = _wait_for(result)
         if "error" in res:
             return res, 400
         return res
@@ -1173,7 +1238,7 @@ def set_data_source_token(username, source_id, access_token):
     uuid = User.derive_uid(username)
     if JwtToken.check_token(tok, uuid, scope='user'):
         result = data_source_tasks.set_access_token.delay(uuid, source_id, access_token['value'])
-        res = result.get(timeout=call_timeout)
+        res = _wait_for(result)
         if "error" in res:
             return res, 400
         return res
@@ -1215,8 +1280,7 @@ def list_available_data_sources():
 
         (returns error only if success == False and response otherwise)
     """
-    result = data_source_tasks.get_available_data_source_list.delay()
-    res = result.get(timeout=call_timeout)
+    res = _read(data_source_tasks.get_available_data_source_list)
     if "error" in res:
         return res, 400
     return res
@@ -1246,7 +1310,7 @@ def store_data(username, source_type, data):
     uuid = User.derive_uid(username)
     if JwtToken.check_token(tok, uuid, scope='user'):
         result = data_source_tasks.add_data.delay(uuid, source_type, data)
-        res = result.get(timeout=call_timeout)
+        res = _wait_for(result)
         if "error" in res:
             return res, 400
         return res
@@ -1271,7 +1335,9 @@ def store_bulk_data(username, source_type, data):
     uuid = User.derive_uid(username)
     if JwtToken.check_token(tok, uuid, scope='user'):
         result = data_source_tasks.upload_data_bulk.delay(uuid, source_type, data)
-        res = result.get(timeout=call_timeout)
+        if _is_async_request():
+            return _accepted(result, uuid, 'user')
+        res = _wait_for(result)
         if "error" in res:
             return res, 400
         return res
@@ -1296,7 +1362,9 @@ def get_data(username, source_type, interval_begin, interval_end):
     uuid = User.derive_uid(username)
     if JwtToken.check_token(tok, uuid, scope='user'):
         result = data_source_tasks.get_data.delay(uuid, source_type, interval_begin, interval_end)
-        res = result.get()
+        if _is_async_request():
+            return _accepted(result, uuid, 'user')
+        res = _wait_for(result, call_timeout_long)
         if "error" in res:
             return res, 400
         return res
@@ -1319,7 +1387,7 @@ def delete_data(username, source_type):
     uuid = User.derive_uid(username)
     if JwtToken.check_token(tok, uuid, scope='user'):
         result = data_source_tasks.remove_data_points.delay(uuid, source_type)
-        res = result.get(timeout=call_timeout)
+        res = _wait_for(result)
         if "error" in res:
             return res, 400
         return res
@@ -1407,7 +1475,9 @@ def register_query(username, query_request):
             goal_description,
             thumbnail_url
         )
-        res = res.get(timeout=call_timeout_long)
+        if _is_async_request():
+            return _accepted(res, puid, 'processor')
+        res = _wait_for(res, call_timeout_long)
         if "error" in res:
             return res, 400
         return res
@@ -1417,6 +1487,41 @@ def register_query(username, query_request):
         return result, 401
 
 
+# path: /task/{task_handle}: GET
+def get_task_status(task_handle, wait=0):
+    """ Poll the state of an asynchronously dispatched task.
+
+    Args:
+        - task_handle (str): handle returned when the task was dispatched
+        - wait (int): seconds to wait for the task to finish (long poll), at most call_timeout_long
+
+    Returns:
+        - the result of the task if it is finished (an error response with status 400 if the task failed), otherwise (with status 202)
+        - success (bool)
+        - response (dict):
+            - task_id (str): id of the task
+            - state (str): state of the task, e.g. PENDING or STARTED
+    """
+    tok = connexion.request.headers['mynedata-token']
+    handle = JwtToken.decode_task_handle(task_handle)
+    if handle is None or not JwtToken.check_token(tok, handle['sub'], scope=handle['scope']):
+        result = {}
+        result['success'] = False
+        return result, 401
+    result = AsyncResult(handle['task'])
+    if not result.ready() and wait > 0:
+        try:
+            _wait_for(result, min(wait, call_timeout_long))
+        except TaskTimeoutError:
+            pass
+    if not result.ready():
+        return {'success': True, 'response': {'task_id': result.id, 'state': result.state}}, 202
+    res = _wait_for(result)
+    if "error" in res:
+        return res, 400
+    return res
+
+
 # path: /processor/{username}/check_query: POST
 def check_query(username, query):
     """ Check syntax of a query. """
@@ -1424,7 +1529,7 @@ def check_query(username, query):
     proc_id = Processor.derive_uid(usernam)
     if JwtToken.check_token(tok, proc_id, scope='processor'):
         res = query_tasks.check_query.delay(query["query"])
-        res = res.get(timeout=call_timeout_long)
+        res = _wait_for(res, call_timeout_long)
         if "error" in res:
             return res, 400
         return res
@@ -1483,7 +1588,7 @@ def register_pin_query(username, pin_query_request):
             consent_finish_time,
             state, result
         )
-        res = res.get(timeout=call_timeout)
+        res = _wait_for(res)
         if "error" in res:
             return res, 400
         return res
@@ -1566,7 +1671,7 @@ def get_proc_query(username, query_id):
     if JwtToken.check_token(tok, proc_id, scope='processor'):
         debugComputeAdhoc = 'debugComputeAdhoc' in connexion.request.headers.keys() and connexion.request.headers['debugComputeAdhoc']
         res = payment_tasks.check_payment.delay(proc_id, query_id, None, debugComputeAdhoc)
-        res = res.get(timeout=call_timeout)
+        res = _wait_for(res)
         if "error" in res:
             return res, 400
         return res
@@ -1604,7 +1709,7 @@ def get_proc_query_tid(username, query_id, transaction_id):
     proc_id = Processor.derive_uid(username)
     if JwtToken.check_token(tok, proc_id, scope='processor'):
         res = payment_tasks.check_payment.delay(proc_id, query_id, transaction_id)
-        res = res.get(timeout=call_timeout)
+        res = _wait_for(res)
         if "error" in res:
             return res, 400
         return res
@@ -1621,7 +1726,7 @@ def set_payment_state(username, query_id):
     proc_id = Processor.derive_uid(username)
     if JwtToken.check_token(tok, proc_id, scope='processor'):
         res = payment_tasks.set_payment_state.delay(proc_id, query_id)
-        res = res.get(timeout=call_timeout)
+        res = _wait_for(res)
         if "error" in res:
             return res, 400
         return res
@@ -1659,7 +1764,7 @@ def get_proc_pin_query(username, query_id):
     proc_id = Processor.derive_uid(username)
     if JwtToken.check_token(tok, proc_id, scope='processor'):
         res = query_tasks.retrieve_pin_query.delay(proc_id, proc_id, query_id)
-        res = res.get(timeout=call_timeout)
+        res = _wait_for(res)
         if "error" in res:
             return res, 400
         return res
@@ -1700,7 +1805,7 @@ def get_pin_query_info(username, pin):
     user_id = User.derive_uid(username)
     if JwtToken.check_token(tok, user_id, scope='user'):
         res = query_tasks.get_pin_query_info.delay(user_id, None, pin)
-        res = res.get(timeout=call_timeout)
+        res = _wait_for(res)
         if "error" in res:
             return res, 400
         return res
@@ -1739,7 +1844,7 @@ def get_user_query(username, query_id):
     user_id = User.derive_uid(username)
     if JwtToken.check_token(tok, user_id, scope='user'):
         res = query_tasks.retrieve_query.delay(user_id, None, query_id, False)
-        res = res.get(timeout=call_timeout)
+        res = _wait_for(res)
         if "error" in res:
             return res, 400
         return res
@@ -1778,7 +1883,7 @@ def list_proc_pin_queries(username, state):
     proc_id = Processor.derive_uid(username)
     if JwtToken.check_token(tok, proc_id, scope='processor'):
         res = query_tasks.get_proc_pin_queries.delay(proc_id, state)
-        res = res.get(timeout=call_timeout)
+        res = _wait_for(res)
         if "error" in res:
             return res, 400
         return res
@@ -1822,7 +1927,7 @@ def list_user_pin_queries(username, state):
     user_id = User.derive_uid(username)
     if JwtToken.check_token(tok, user_id, scope='user'):
         res = query_tasks.get_user_pin_queries.delay(user_id, state)
-        res = res.get(timeout=call_timeout)
+        res = _wait_for(res)
         if "error" in res:
             return res, 400
         return res
@@ -1861,7 +1966,7 @@ def list_proc_queries(username, state):
     proc_id = Processor.derive_uid(username)
     if JwtToken.check_token(tok, proc_id, scope='processor'):
         res = query_tasks.get_proc_queries.delay(proc_id, state)
-        res = res.get(timeout=call_timeout)
+        res = _wait_for(res)
         if "error" in res:
             return res, 400
         return res
@@ -1908,7 +2013,7 @@ def list_user_queries(username, state):
             query_state = ""
             consent_state = state
         res = query_tasks.get_user_queries.delay(user_id, query_state, consent_state)
-        res = res.get(timeout=call_timeout)
+        res = _wait_for(res)
         if "error" in res:
             return res, 400
         return res
@@ -1925,7 +2030,8 @@ def set_query_consent(username, state, query_ids):
     Args:
         - username (str)
         - state: can be 'accepted' or 'refused'
-        - query_ids (dict of str : int): query_id (int) and proc_id (int)
+        - query_ids (dict of str : int): query_id (int) and proc_id (int), or query_id_list (list of int) instead
+            of query_id to change the consent to several queries of the processor at once
 
     Returns:
         - success (bool)
@@ -1941,13 +2047,13 @@ def set_query_consent(username, state, query_ids):
     tok = connexion.request.headers['mynedata-token']
     user_id = User.derive_uid(username)
     if JwtToken.check_token(tok, user_id, scope='user'):
-        query_id = query_ids['query_id']
+        query_id = query_ids.get('query_id_list', query_ids.get('query_id'))
         proc_id = query_ids['proc_id']
         accept = False
         if state == 'accepted':
             accept = True
         result = query_tasks.set_query_consent.delay(user_id, proc_id, query_id, accept)
-        res = result.get(timeout=call_timeout)
+        res = _wait_for(result)
         if "error" in res:
             return res, 400
         return res
@@ -1982,7 +2088,7 @@ def set_pin_query_consent(username, pin, pin_query_response):
     if JwtToken.check_token(tok, user_id, scope='user'):
         accept = bool(pin_query_response['accept'])
         result = query_tasks.set_pin_query_consent.delay(user_id, pin, accept)
-        res = result.get(timeout=call_timeout)
+        res = _wait_for(result)
         if "error" in res:
             return res, 400
         return res
@@ -1998,7 +2104,7 @@ def get_payment_info(username, query_id):
     proc_id = Processor.derive_uid(username)
     if JwtToken.check_token(tok, proc_id, scope='processor'):
         result = payment_tasks.get_payment_info.delay(proc_id, query_id)
-        res = result.get(timeout=call_timeout)
+        res = _wait_for(result)
         if "error" in res:
             return res, 400
         return res
@@ -2013,8 +2119,7 @@ def has_done_wizard(username):
     tok = connexion.request.headers['mynedata-token']
     user_id = User.derive_uid(username)
     if JwtToken.check_token(tok, user_id, scope='user'):
-        result = user_tasks.get_wizard_state.delay(user_id)
-        res = result.get(timeout=call_timeout)
+        res = _read(user_tasks.get_wizard_state, user_id)
         if "error" in res:
             return res, 400
         return res
@@ -2030,7 +2135,7 @@ def set_wizard_done(username):
     user_id = User.derive_uid(username)
     if JwtToken.check_token(tok, user_id, scope='user'):
         result = user_tasks.set_wizard_state.delay(user_id, True)
-        res = result.get(timeout=call_timeout)
+        res = _wait_for(result)
         if "error" in res:
             return res, 400
         return res
@@ -2049,7 +2154,7 @@ def set_wizard_done_devel(username, state):
     user_id = User.derive_uid(username)
     if JwtToken.check_token(tok, user_id, scope='user'):
         result = user_tasks.set_wizard_state.delay(user_id, state["state"])
-        res = result.get(timeout=call_timeout)
+        res = _wait_for(result)
         if "error" in res:
             return res, 400
         return res
@@ -2078,7 +2183,7 @@ def auth_store_bulk_data(source_type, data):
     token = JwtToken.decode_token(tok)
     if token['source'] == source_type:
         result = data_source_tasks.upload_data_bulk.delay(int(token['sub']), source_type, data)
-        res = result.get(timeout=call_timeout)
+        res = _wait_for(result)
         if "error" in res:
             return res, 400
         return res
@@ -2095,19 +2200,62 @@ def auth_store_data(source_type, data):
         return "Missing Authorization token", 401
     token = JwtToken.decode_token(tok)
     if token['source'] == source_type:
-        result = data_source_tasks.add_data.delay(int(token['sub']), source_type, data, True)
-        res = result.get(timeout=call_timeout)
+        if Configuration.write_buffer:
+            res = _buffer_data(int(token['sub']), source_type, data)
+        else:
+            result = data_source_tasks.add_data.delay(int(token['sub']), source_type, data)
+            res = _wait_for(result)
         if "error" in res:
             return res, 400
         return res
     return "Unauthorized", 401
 
 
+_write_buffer = None
+_write_buffer_lock = threading.Lock()
+
+
+def _write_buffered_data(batches):
+    """ Write batches of the write buffer with one task, return the result of each batch. """
+    result = data_source_tasks.add_data_batches.delay(
+        [[batch.user_id, batch.data_source_name, {'data': batch.data_points}] for batch in batches])
+    res = _wait_for(result)
+    if not res.get('success', False):
+        return [res] * len(batches)
+    return res['response']['results']
+
+
+def _buffer_data(user_id, source_type, data):
+    """ Add data items to the write buffer, waiting until they are written if the buffer is durable. """
+    global _write_buffer
+    with _write_buffer_lock:
+        if _write_buffer is None:
+            _write_buffer = WriteBuffer(_write_buffered_data, Configuration.write_buffer_size, Configuration.write_buffer_max_age)
+    if 'data' not in data:
+        return {'success': False, 'error': {'code': enums.Error.NO_DATA_GIVEN, 'message': "No data was given which could be uploaded!"}}
+    # reject invalid data items right away, they would fail the whole batch
+    data_source_codec = codec.get_codec(source_type)
+    if data_source_codec is None:
+        return {'success': False, 'error': {'code': enums.Error.NO_SUCH_DATA_SOURCE, 'message': "No data source with name {} exists!".format(source_type)}}
+    try:
+        for data_point in data['data']:
+            data_source_codec.decode(user_id, data_point)
+    except ValueError as e:
+        return {'success': False, 'error': {'code': enums.Error.INVALID_DATA_POINT, 'message': "Invalid data point: {}".format(e)}}
+
+    batch = _write_buffer.add(user_id, source_type, data['data'])
+    if not Configuration.write_buffer_durable:
+        return {'success': True, 'response': {}}
+    if not batch.written.wait(timeout=Configuration.write_buffer_max_age + call_timeout):
+        return {'success': False, 'error': {'code': enums.Error.UNDEFINED, 'message': "Data was not written in time."}}
+    return batch.result
+
+
 def generate_token(username, source_type, passw):
     pw = passw['password']
     user_id = User.derive_uid(username)
     result = user_tasks.check_login.delay(user_id, pw)
-    res = result.get(timeout=call_timeout)
+    res = _wait_for(result)
     result = dict()
     result['success'] = False
     if res:
@@ -7,11 +7,13 @@ import logging
 import connexion
 import celery
 from flask_cors import CORS
+from sqlalchemy.engine.url import make_url
 
 lib_folder = '/'.join(os.path.split(os.path.dirname(sys.path[0]))[:-1])
 sys.path.insert(0, lib_folder)
 
 from lib.config import Configuration
+from lib.backend.database import DatabaseConnector
 
 # from .model_encoder import ModelEncoder
 
@@ -51,4 +53,20 @@ app.app.config.update(
     celery_result_backend=Configuration.result_backend,
 )
 make_celery(app.app, test_mode=Configuration.test_mode)
+if Configuration.api_direct_reads:
+    # read-only requests are answered in this process (see apicalls._read()), which serves all requests with gevent,
+    # the database driver has to wait for the database without blocking the other requests
+    green_driver = False
+    if make_url(Configuration.database_uri).get_backend_name() == 'postgresql':
+        try:
+            from psycogreen.gevent import patch_psycopg
+            patch_psycopg()
+            green_driver = True
+        except ImportError:
+            pass
+    if green_driver:
+        DatabaseConnector.initialize(target=Configuration.database_uri)
+    else:
+        logging.warning("Direct reads require PostgreSQL and psycogreen, read-only requests are sent to the workers")
+        Configuration.api_direct_reads = False
 application = app.app
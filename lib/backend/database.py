@@ -1,34 +1,106 @@
 """ This module defines a wrapper for SQLAlchemy. """
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import logging
+
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
+from lib.config import Configuration
 from lib.data_structures import BaseObject
+from lib.backend import partitioning
 
 
 class DatabaseConnector():
-    """ Wrapper for SQLAlchemy. """
+    """ Wrapper for SQLAlchemy.
+
+        Sessions are scoped, i.e. every thread gets its own session. Celery
+        workers remove the session after each task (see lib.backend.tasks.app),
+        such that every task works on a session of its own. """
 
+    engine = None
     session = None
     initialized = False
 
     @staticmethod
     def initialize(target):
-        """ Initialize SQLAlchemy wrapper. """
-        engine = create_engine(target, echo=False)
+        """ Initialize SQLAlchemy wrapper.
+
+            Except for SQLite, connections are kept in a QueuePool whose
+            options are read from the configuration if it is initialized. """
+        options = {'echo': False}
+        if Configuration.initialized:
+            options['pool_pre_ping'] = Configuration.db_pool_pre_ping
+            options['pool_recycle'] = Configuration.db_pool_recycle
+            if make_url(target).get_backend_name() != 'sqlite':
+                options['poolclass'] = QueuePool
+                options['pool_size'] = Configuration.db_pool_size or int(Configuration.concurrency_max)
+                options['max_overflow'] = Configuration.db_max_overflow
+        engine = create_engine(target, **options)
+        if Configuration.initialized and Configuration.time_partitioning:
+            partitioning.create_partitioned_tables(engine)
         BaseObject.metadata.bind = engine
         BaseObject.metadata.create_all(engine, checkfirst=True)
 
-        Session = sessionmaker(bind=engine)
-        DatabaseConnector.session = Session()
+        DatabaseConnector.engine = engine
+        DatabaseConnector.session = scoped_session(sessionmaker(bind=engine))
 
         DatabaseConnector.initialized = True
+        DatabaseConnector.create_missing_columns()
+        DatabaseConnector.create_missing_indexes()
+
+    @staticmethod
+    def create_missing_columns():
+        """ Add the nullable columns defined after their table was created, create_all() skips existing tables. """
+        engine = DatabaseConnector.engine
+        inspector = inspect(engine)
+        for table in BaseObject.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing and column.nullable and not column.primary_key:
+                    try:
+                        engine.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                            engine.dialect.identifier_preparer.format_table(table),
+                            engine.dialect.identifier_preparer.quote(column.name),
+                            column.type.compile(dialect=engine.dialect)))
+                    except SQLAlchemyError:
+                        logging.warning("Could not add column %s to table %s", column.name, table.name)
+
+    @staticmethod
+    def create_missing_indexes():
+        """ Create the indexes defined after their table was created, create_all() skips existing tables.
+            Indexes which cannot be created, e.g. unique indexes over duplicate rows, are logged and skipped. """
+        engine = DatabaseConnector.engine
+        inspector = inspect(engine)
+        for table in BaseObject.metadata.sorted_tables:
+            existing = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    try:
+                        index.create(engine)
+                    except SQLAlchemyError:
+                        logging.warning("Could not create index %s of table %s", index.name, table.name)
+
+    @staticmethod
+    def remove_session():
+        """ Close and discard the session of the current thread. """
+        if DatabaseConnector.initialized:
+            DatabaseConnector.session.remove()
+
+    @staticmethod
+    def dispose():
+        """ Drop all pooled connections, e.g. after forking a worker process. """
+        if DatabaseConnector.initialized:
+            DatabaseConnector.session.remove()
+            DatabaseConnector.engine.dispose()
 
 
 def get_db_session():
-    """ Get current session. """
+    """ Get session of the current thread. """
     if not DatabaseConnector.initialized:
         raise RuntimeError('DatabaseConnector is not yet initialized!')
-    return DatabaseConnector.session
+    return DatabaseConnector.session()
 
 
 def add_data_to_database(data):
@@ -0,0 +1,173 @@
+""" Time partitioned storage of the data source tables.
+
+    If Configuration.time_partitioning is set and the database is PostgreSQL,
+    the tables of the time series data sources (TIME_SERIES_SOURCES) are
+    created as tables partitioned by range of the timestamp: one partition
+    per calendar month (UTC), named <table>_pYYYYMM, and a default partition
+    <table>_default for data points outside of all partitions. PostgreSQL
+    prunes the partitions of reads filtering by timestamp, e.g. get_data()
+    and select_query_data().
+
+    Partitions are created ahead of time by maintain_data_storage() and for
+    the months of written data points by ensure_partitions(). Data points
+    older than Configuration.data_retention_months are dropped by
+    drop_expired_data(), which drops whole partitions of partitioned tables
+    and deletes the rows of all other time series tables. The profiles of
+    the users (PersonalInformation) are neither partitioned nor expired.
+
+    Tables created before partitioning was enabled and the tables of other
+    databases stay plain tables. """
+import calendar
+from datetime import datetime, timezone
+import logging
+import re
+
+from sqlalchemy import event, inspect, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.schema import CreateTable
+
+from lib.data_sources import Iris, LocationProbe, OpenhabSensor, RandomData
+from lib.data_structures import PartialAggregate
+
+
+# data sources whose data points are partitioned by month and expired
+TIME_SERIES_SOURCES = [RandomData, LocationProbe, OpenhabSensor, Iris]
+
+# names of the partitioned tables and of their partitions known to this process
+_partitioned = set()
+_partitions = set()
+
+
+def month_start(timestamp):
+    """ Return the start of the UTC month containing a timestamp, both in milliseconds. """
+    date = datetime.fromtimestamp(timestamp // 1000, timezone.utc)
+    return calendar.timegm((date.year, date.month, 1, 0, 0, 0)) * 1000
+
+
+def add_months(timestamp, months):
+    """ Return the start of the UTC month the given number of months after the month containing a timestamp. """
+    date = datetime.fromtimestamp(timestamp // 1000, timezone.utc)
+    year, month = divmod(date.year * 12 + date.month - 1 + months, 12)
+    return calendar.timegm((year, month + 1, 1, 0, 0, 0)) * 1000
+
+
+def partition_name(table_name, start):
+    """ Return the name of the partition of a table for the month starting at start. """
+    return '{}_p{}'.format(table_name, datetime.fromtimestamp(start // 1000, timezone.utc).strftime('%Y%m'))
+
+
+def time_series_sources():
+    """ Return the data sources whose tables can be partitioned and whose data points expire. """
+    return list(TIME_SERIES_SOURCES)
+
+
+def partitioned_sources():
+    """ Return the data sources whose tables are partitioned. """
+    return [source for source in time_series_sources() if source.__tablename__ in _partitioned]
+
+
+def create_partitioned_tables(engine):
+    """ Create the missing tables of time series data sources as partitioned tables, PostgreSQL only.
+        Has to be called before create_all() creates them as plain tables. """
+    if engine.dialect.name != 'postgresql':
+        logging.warning("Time partitioning is only supported on PostgreSQL, data source tables are not partitioned")
+        return
+    preparer = engine.dialect.identifier_preparer
+    existing = set(inspect(engine).get_table_names())
+    for source in time_series_sources():
+        table = source.__table__
+        if table.name in existing:
+            continue
+        engine.execute('{} PARTITION BY RANGE ({})'.format(
+            str(CreateTable(table).compile(dialect=engine.dialect)).rstrip(), preparer.quote('timestamp')))
+        engine.execute('CREATE TABLE {} PARTITION OF {} DEFAULT'.format(
+            preparer.quote(table.name + '_default'), preparer.format_table(table)))
+    _partitioned.update(row[0] for row in engine.execute(
+        "SELECT c.relname FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid"))
+    for table_name in _partitioned:
+        _partitions.update(_list_partitions(engine, table_name))
+
+
+def _list_partitions(bind, table_name):
+    return [row[0] for row in bind.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = :table_name"), {'table_name': table_name})]
+
+
+def ensure_partitions(session, table, rows):
+    """ Create the missing partitions for the months of rows about to be written into a table.
+        Nothing is done for tables which are not partitioned. """
+    if table.name not in _partitioned or len(rows) == 0:
+        return
+    timestamps = [row['timestamp'] for row in rows]
+    ensure_months(session, table, min(timestamps), max(timestamps))
+
+
+def ensure_months(session, table, first, last):
+    """ Create the missing partitions of a partitioned table for all months from first to last (timestamps).
+        The partitions are known to this process once the transaction of the session is committed. """
+    preparer = session.bind.dialect.identifier_preparer
+    created = session.info.setdefault('created_partitions', set())
+    start = month_start(first)
+    while start <= last:
+        end = add_months(start, 1)
+        name = partition_name(table.name, start)
+        if name not in _partitions and name not in created:
+            # a savepoint, such that a partition created concurrently does not abort the transaction
+            savepoint = session.begin_nested()
+            try:
+                session.execute('CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES FROM ({}) TO ({})'.format(
+                    preparer.quote(name), preparer.format_table(table), start, end))
+                savepoint.commit()
+                created.add(name)
+            except SQLAlchemyError:
+                savepoint.rollback()
+                logging.warning("Could not create partition %s, its data points are stored in the default partition", name)
+        start = end
+    if created and not event.contains(session, 'after_commit', _record_partitions):
+        event.listen(session, 'after_commit', _record_partitions)
+        event.listen(session, 'after_transaction_end', _forget_partitions)
+
+
+def _record_partitions(session):
+    # also called for savepoints, whose partitions are only known after the outermost transaction
+    if session.transaction.parent is None:
+        _partitions.update(session.info.pop('created_partitions', ()))
+
+
+def _forget_partitions(session, transaction):
+    # partitions created by a rolled back transaction are created again by the next one
+    if transaction.parent is None:
+        session.info.pop('created_partitions', None)
+
+
+def drop_expired_data(session, cutoff):
+    """ Drop the data points of all time series data sources older than cutoff and their partial aggregates.
+
+    Args:
+        - session (db session): session to use, it is not committed
+        - cutoff (int): data points with smaller timestamps are dropped, the start of a month drops whole partitions
+
+    Returns:
+        - int: number of dropped partitions """
+    preparer = session.bind.dialect.identifier_preparer
+    pattern = re.compile(r'_p(\d{4})(\d{2})$')
+    dropped = 0
+    for source in time_series_sources():
+        table = source.__table__
+        if table.name in _partitioned:
+            for name in _list_partitions(session, table.name):
+                match = pattern.search(name)
+                if match is None or name != table.name + match.group(0):
+                    continue
+                start = calendar.timegm((int(match.group(1)), int(match.group(2)), 1, 0, 0, 0)) * 1000
+                if add_months(start, 1) <= cutoff:
+                    session.execute('DROP TABLE {}'.format(preparer.quote(name)))
+                    _partitions.discard(name)
+                    dropped += 1
+        # rows of plain tables, of the default partition and of a partition containing cutoff
+        session.execute(table.delete().where(table.c.timestamp < cutoff))
+        PartialAggregate.remove_before(session, source, cutoff)
+    return dropped
+
@@ -30,15 +30,23 @@
     - sends Basic HTTP authentication headers
     - parses all JSON numbers that look like floats as Decimal
     - uses standard Python json lib
+    - keeps the HTTP connections in a thread-safe pool shared by all proxies
+      derived from the same AuthServiceProxy object
+    - sends several calls as one JSON-RPC batch request (batch_call)
+    - records the number of calls and their latency per method (metrics)
 """
 
 import base64
+import contextlib
 import decimal
 import http.client
+import itertools
 import json
 import logging
 import os
+import queue
 import socket
+import threading
 import time
 import urllib.parse
 
@@ -63,10 +71,71 @@ def EncodeDecimal(o):
         return str(o)
     raise TypeError(repr(o) + " is not JSON serializable")
 
+class ConnectionPool():
+    """ Thread-safe pool of at most size HTTP connections to one server. """
+
+    def __init__(self, url, timeout, size, connection=None):
+        self.url = url
+        self.timeout = connection.timeout if connection else timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(1 if connection else size)
+        if connection:
+            self._idle.put(connection)
+
+    def _new_connection(self):
+        port = 80 if self.url.port is None else self.url.port
+        if self.url.scheme == 'https':
+            return http.client.HTTPSConnection(self.url.hostname, port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.url.hostname, port, timeout=self.timeout)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """ Borrow a connection, blocks while all connections are in use. """
+        self._slots.acquire()
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._new_connection()
+            try:
+                yield conn
+            except BaseException:
+                # the state of the connection is unknown, it reconnects on its next request
+                conn.close()
+                raise
+            finally:
+                self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+
+class RpcMetrics():
+    """ Thread-safe number of calls, errors and latencies per RPC method. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._methods = {}
+
+    def record(self, method, seconds, failed=False):
+        with self._lock:
+            entry = self._methods.setdefault(method, {'calls': 0, 'errors': 0, 'seconds': 0., 'max_seconds': 0.})
+            entry['calls'] += 1
+            entry['errors'] += int(failed)
+            entry['seconds'] += seconds
+            entry['max_seconds'] = max(entry['max_seconds'], seconds)
+
+    def snapshot(self):
+        """ Return {method: {'calls', 'errors', 'seconds', 'max_seconds', 'mean_seconds'}}. """
+        with self._lock:
+            return {method: dict(entry, mean_seconds=entry['seconds'] / entry['calls'])
+                    for method, entry in self._methods.items()}
+
+
 class AuthServiceProxy():
-    __id_count = 0
+    _id_count = itertools.count(1)
 
-    def __init__(self, service_url, service_name=None, timeout=HTTP_TIMEOUT, connection=None, ensure_ascii=True):
+    def __init__(self, service_url, service_name=None, timeout=HTTP_TIMEOUT, connection=None, ensure_ascii=True,
+                 pool_size=1, pool=None, metrics=None):
         self.__service_url = service_url
         self._service_name = service_name
         # ensure_ascii: escape unicode as \uXXXX, passed to json.dumps
@@ -76,8 +145,9 @@ class AuthServiceProxy():
         passwd = None if self.__url.password is None else self.__url.password.encode('utf8')
         authpair = user + b':' + passwd
         self.__auth_header = b'Basic ' + base64.b64encode(authpair)
-        self.timeout = timeout
-        self._set_conn(connection)
+        self.__pool = pool if pool is not None else ConnectionPool(self.__url, timeout, pool_size, connection)
+        self.timeout = self.__pool.timeout
+        self.metrics = metrics if metrics is not None else RpcMetrics()
 
     def __getattr__(self, name):
         if name.startswith('__') and name.endswith('__'):
@@ -85,7 +155,7 @@ class AuthServiceProxy():
             raise AttributeError
         if self._service_name is not None:
             name = "%s.%s" % (self._service_name, name)
-        return AuthServiceProxy(self.__service_url, name, connection=self.__conn)
+        return AuthServiceProxy(self.__service_url, name, pool=self.__pool, metrics=self.metrics, ensure_ascii=self.ensure_ascii)
 
     def _request(self, method, path, postdata):
         '''
@@ -96,40 +166,47 @@ class AuthServiceProxy():
                    'User-Agent': USER_AGENT,
                    'Authorization': self.__auth_header,
                    'Content-type': 'application/json'}
-        if os.name == 'nt':
-            # Windows somehow does not like to re-use connections
-            self._set_conn()
-        try:
-            self.__conn.request(method, path, postdata, headers)
-            return self._get_response()
-        except http.client.BadStatusLine as e:
-            if e.line == "''":  # if connection was closed, try again
-                self.__conn.close()
-                self.__conn.request(method, path, postdata, headers)
-                return self._get_response()
-            else:
-                raise
-        except (BrokenPipeError, ConnectionResetError):
-            # Python 3.5+ raises BrokenPipeError instead of BadStatusLine when the connection was reset
-            # ConnectionResetError happens on FreeBSD with Python 3.4
-            self.__conn.close()
-            self.__conn.request(method, path, postdata, headers)
-            return self._get_response()
+        with self.__pool.connection() as conn:
+            if os.name == 'nt':
+                # Windows somehow does not like to re-use connections
+                conn.close()
+            try:
+                conn.request(method, path, postdata, headers)
+                return self._get_response(conn)
+            except http.client.BadStatusLine as e:
+                if e.line == "''":  # if connection was closed, try again
+                    conn.close()
+                    conn.request(method, path, postdata, headers)
+                    return self._get_response(conn)
+                else:
+                    raise
+            except (BrokenPipeError, ConnectionResetError):
+                # Python 3.5+ raises BrokenPipeError instead of BadStatusLine when the connection was reset
+                # ConnectionResetError happens on FreeBSD with Python 3.4
+                conn.close()
+                conn.request(method, path, postdata, headers)
+                return self._get_response(conn)
 
     def get_request(self, *args, **argsn):
-        AuthServiceProxy.__id_count += 1
+        request_id = next(AuthServiceProxy._id_count)
 
-        log.debug("-%s-> %s %s" % (AuthServiceProxy.__id_count, self._service_name, json.dumps(args, default=EncodeDecimal, ensure_ascii=self.ensure_ascii)))
+        log.debug("-%s-> %s %s" % (request_id, self._service_name, json.dumps(args, default=EncodeDecimal, ensure_ascii=self.ensure_ascii)))
         if args and argsn:
             raise ValueError('Cannot handle both named and positional arguments')
         return {'version': '1.1',
                 'method': self._service_name,
                 'params': args or argsn,
-                'id': AuthServiceProxy.__id_count}
+                'id': request_id}
 
     def __call__(self, *args, **argsn):
         postdata = json.dumps(self.get_request(*args, **argsn), default=EncodeDecimal, ensure_ascii=self.ensure_ascii)
-        response = self._request('POST', self.__url.path, postdata.encode('utf-8'))
+        started = time.perf_counter()
+        failed = True
+        try:
+            response = self._request('POST', self.__url.path, postdata.encode('utf-8'))
+            failed = response.get('error') is not None
+        finally:
+            self.metrics.record(self._service_name, time.perf_counter() - started, failed)
         if response['error'] is not None:
             raise JSONRPCException(response['error'])
         elif 'result' not in response:
@@ -143,17 +220,46 @@ class AuthServiceProxy():
         log.debug("--> " + postdata)
         return self._request('POST', self.__url.path, postdata.encode('utf-8'))
 
-    def _get_response(self):
+    def batch_call(self, calls):
+        """ Send several calls with one batch request, e.g. batch_call([('dumpprivkey', (a,)) for a in addresses]).
+            Returns the results in the order of calls, raises JSONRPCException if any call failed. """
+        calls = list(calls)
+        if len(calls) == 0:
+            return []
+        requests = [getattr(self, method).get_request(*args) for method, args in calls]
+        started = time.perf_counter()
+        failed = True
+        try:
+            responses = self.batch(requests)
+            failed = not isinstance(responses, list) or any(r.get('error') is not None for r in responses)
+        finally:
+            elapsed = time.perf_counter() - started
+            for method in {method for method, _ in calls}:
+                self.metrics.record('batch:' + method, elapsed, failed)
+        if not isinstance(responses, list):
+            raise JSONRPCException(responses.get('error') or {'code': -342, 'message': 'invalid batch response'})
+        by_id = {response['id']: response for response in responses}
+        results = []
+        for request in requests:
+            response = by_id.get(request['id'])
+            if response is None or 'result' not in response:
+                raise JSONRPCException({'code': -343, 'message': 'missing JSON-RPC result'})
+            if response['error'] is not None:
+                raise JSONRPCException(response['error'])
+            results.append(response['result'])
+        return results
+
+    def _get_response(self, conn):
         req_start_time = time.time()
         try:
-            http_response = self.__conn.getresponse()
+            http_response = conn.getresponse()
         except socket.timeout:
             raise JSONRPCException({
                 'code': -344,
                 'message': '%r RPC took longer than %f seconds. Consider '
                            'using larger timeout for calls that take '
                            'longer to return.' % (self._service_name,
-                                                  self.__conn.timeout)})
+                                                  conn.timeout)})
         if http_response is None:
             raise JSONRPCException({
                 'code': -342, 'message': 'missing HTTP response from server'})
@@ -173,14 +279,4 @@ class AuthServiceProxy():
         return response
 
     def __truediv__(self, relative_uri):
-        return AuthServiceProxy("{}/{}".format(self.__service_url, relative_uri), self._service_name, connection=self.__conn)
-
-    def _set_conn(self, connection=None):
-        port = 80 if self.__url.port is None else self.__url.port
-        if connection:
-            self.__conn = connection
-            self.timeout = connection.timeout
-        elif self.__url.scheme == 'https':
-            self.__conn = http.client.HTTPSConnection(self.__url.hostname, port, timeout=self.timeout)
-        else:
-            self.__conn = http.client.HTTPConnection(self.__url.hostname, port, timeout=self.timeout)
+        return AuthServiceProxy("{}/{}".format(self.__service_url, relative_uri), self._service_name, pool=self.__pool, metrics=self.metrics)
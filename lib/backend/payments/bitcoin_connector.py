@@ -8,7 +8,7 @@ from lib.backend.payments import AuthServiceProxy
 class BitcoinConnector():
     """ This static class connects the myneData backend to the Bitcoin Core client via JSON-RPC. """
 
-    bitcoincli_auth_proxy = None
+    auth_proxy = None
     platform_address = None
     # Wallet if payments can be send from platform easier but not transparent. else complex transaction with every input corresponding to a query transaction the user took part in
     use_wallet = False
@@ -24,10 +24,19 @@ class BitcoinConnector():
                 rpchost=Configuration.payment_bitcoin_rpc_host,
                 rpcport=Configuration.payment_bitcoin_rpc_port,
             ),
-            timeout=Configuration.payment_bitcoin_rpc_timeout,
+            timeout=int(Configuration.payment_bitcoin_rpc_timeout),
+            # connections are shared by all tasks of a worker process
+            pool_size=Configuration.payment_bitcoin_rpc_pool_size,
         )
 
-        BitcoinConnector.platform_address = BitcoinConnector.bitcoincli_auth_proxy.getnewaddress('platform')
-        BitcoinConnector.use_wallet = (Configuration.payment_mode is PaymentMethod.BITCOIN_CENTRAL)
+        BitcoinConnector.platform_address = BitcoinConnector.auth_proxy.getnewaddress('platform')
+        BitcoinConnector.use_wallet = (Configuration.payment_mode == PaymentMethod.BITCOIN_CENTRAL)
 
         BitcoinConnector.initialized = True
+
+    @staticmethod
+    def metrics():
+        """ Return the number of calls and latencies per RPC method (see RpcMetrics.snapshot()). """
+        if not BitcoinConnector.initialized:
+            return {}
+        return BitcoinConnector.auth_proxy.metrics.snapshot()
@@ -0,0 +1,140 @@
+""" Cache for the responses of finished queries.
+
+    Once a query is paid or aborted, the response of retrieve_query() for
+    its processor does not change anymore. Such responses are stored
+    serialized, keyed by (processor id, query id), in a bounded in-process
+    LRU tier and, if Configuration.result_cache_url is set, in a shared
+    redis tier.
+
+    Whenever a query changes, its entry is invalidated after the commit of
+    the change. Other processes drop their local copy when it expires after
+    Configuration.result_cache_ttl seconds. """
+from collections import OrderedDict
+import json
+import logging
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from lib.config import Configuration
+from lib.config import RESULT_CACHE_SHARED_TTL
+from lib.data_structures import Query_Db
+from lib.data_structures import QueryState
+
+
+class ResultCache():
+    """ Two tier cache of serialized responses. """
+
+    cached_states = [QueryState.PAID, QueryState.ABORTED]
+
+    def __init__(self, size, ttl, url=None):
+        """ Create a cache.
+
+        Args:
+            - size (int): maximum number of entries of the local tier
+            - ttl (float): seconds a local entry stays valid
+            - url (str): url of the redis server for the shared tier, None for no shared tier """
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self._shared = None
+        if url:
+            try:
+                import redis
+                self._shared = redis.StrictRedis.from_url(url)
+            except ImportError:
+                logging.warning("redis is not installed, the result cache is not shared")
+
+    @staticmethod
+    def _shared_key(key):
+        return 'mynedata:result:{}:{}'.format(*key)
+
+    def get(self, key):
+        """ Return the cached response for key, None if there is none. """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is not None and entry[0] > now:
+                self._local.move_to_end(key)
+                self.hits += 1
+                return json.loads(entry[1])
+        data = None
+        if self._shared is not None:
+            try:
+                data = self._shared.get(ResultCache._shared_key(key))
+            except Exception:
+                logging.exception("Could not read the shared result cache:")
+        if data is None:
+            self.misses += 1
+            return None
+        self._store_local(key, data)
+        self.hits += 1
+        return json.loads(data)
+
+    def put(self, key, response):
+        """ Cache a response, only responses of paid or aborted queries are cached. """
+        if response.get('query_state') not in ResultCache.cached_states:
+            return
+        data = json.dumps(response).encode()
+        self._store_local(key, data)
+        if self._shared is not None:
+            try:
+                self._shared.set(ResultCache._shared_key(key), data, ex=RESULT_CACHE_SHARED_TTL)
+            except Exception:
+                logging.exception("Could not write the shared result cache:")
+
+    def invalidate(self, key):
+        """ Drop the entry of key from both tiers. """
+        with self._lock:
+            self._local.pop(key, None)
+        if self._shared is not None:
+            try:
+                self._shared.delete(ResultCache._shared_key(key))
+            except Exception:
+                logging.exception("Could not invalidate the shared result cache:")
+
+    def _store_local(self, key, data):
+        with self._lock:
+            self._local[key] = (time.monotonic() + self.ttl, data)
+            self._local.move_to_end(key)
+            while len(self._local) > self.size:
+                self._local.popitem(last=False)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    """ Return the result cache of this process. """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResultCache(Configuration.result_cache_size, Configuration.result_cache_ttl, Configuration.result_cache_url)
+    return _cache
+
+
+@event.listens_for(Query_Db, 'after_update')
+@event.listens_for(Query_Db, 'after_delete')
+def _remember_changed_query(_, __, target):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('changed_queries', set()).add((target.processor_id, target.query_id))
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_changed_queries(session):
+    changed = session.info.pop('changed_queries', None)
+    if changed and Configuration.initialized:
+        for key in changed:
+            get_result_cache().invalidate(key)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_changed_queries(session):
+    session.info.pop('changed_queries', None)
@@ -1,10 +1,20 @@
 """ This module starts the backend process. """
 
+import logging
+
 import celery
 from celery import bootsteps
+from celery import signals
 
 from lib.config import Configuration
+from lib.config import QUERY_SWEEP_INTERVAL
+from lib.config import DATA_STORAGE_MAINTENANCE_INTERVAL
 from lib.backend.database import DatabaseConnector
+from lib.backend.database import get_db_session
+from lib.data_structures import EligibilityIndex
+from lib.data_structures import PartialAggregate
+from lib.data_structures import Txid
+from lib.data_sources import codec
 
 from lib.data_structures.enums import PaymentMethod
 from lib.backend.payments import BitcoinConnector
@@ -19,13 +29,40 @@ class CustomArgs(bootsteps.StartStopStep):
             Configuration.enable_test_mode()
         Configuration.print_config()
         worker.app.config_from_object(Configuration)
+        # the shards of a query are joined by a chord, which e.g. the rpc result backend does not support
+        if Configuration.query_shard_size:
+            try:
+                worker.app.backend.ensure_chords_allowed()
+            except NotImplementedError:
+                logging.error("The result backend %s does not support chords, query_shard_size is ignored", Configuration.result_backend)
+                Configuration.query_shard_size = 0
         DatabaseConnector.initialize(target=Configuration.database_uri)
+        # build the eligibility index for databases created before it existed
+        EligibilityIndex.ensure_populated(get_db_session())
+        PartialAggregate.ensure_populated(get_db_session(), [c.source for c in codec.get_codecs()],
+                                          Configuration.partial_aggregate_granularities)
+        # mappings of transactions to queries were not unique before, drop duplicates and create the unique index
+        if Txid.remove_duplicates(get_db_session()):
+            DatabaseConnector.create_missing_indexes()
+        DatabaseConnector.remove_session()
 
         # Initialize payments
         if Configuration.payment_mode in [PaymentMethod.BITCOIN_DIRECT, PaymentMethod.BITCOIN_QUERY_BASED, PaymentMethod.BITCOIN_CENTRAL]:
             BitcoinConnector.initialize()
 
 
+@signals.worker_process_init.connect
+def reset_database_connections(**_):
+    """ Pooled connections must not be shared with the parent process after forking. """
+    DatabaseConnector.dispose()
+
+
+@signals.task_postrun.connect
+def remove_database_session(**_):
+    """ Every task starts with a fresh database session. """
+    DatabaseConnector.remove_session()
+
+
 app = celery.Celery('data')
 
 """ Custom Start Parameters """
@@ -46,14 +83,20 @@ app.autodiscover_tasks([
     'lib.backend.tasks.payment',
 ])
 
-# schedule for checking if queries are ready for further processing as well as if payments need to be conducted
+# queries are started at the end of their consent phase by ETA tasks (see schedule_query),
+# the schedule sweeps for queries whose start got lost, checks if payments need to be conducted
+# and maintains the partitions and retention of the data points
 app.conf.beat_schedule = {
-    'add-every-30-seconds': {
+    'process_queries': {
         'task': 'lib.backend.tasks.query.tasks.process_queries',
-        'schedule': 5.0,
+        'schedule': QUERY_SWEEP_INTERVAL,
     },
     'pay_out': {
         'task': 'lib.backend.tasks.payment.tasks.pay_out',
         'schedule': 60.0,
     },
+    'maintain_data_storage': {
+        'task': 'lib.backend.tasks.data_source.tasks.maintain_data_storage',
+        'schedule': DATA_STORAGE_MAINTENANCE_INTERVAL,
+    },
 }
@@ -0,0 +1,108 @@
+""" Streaming ingestion of data points.
+
+    Batches of data points are read item by item, decoded by the codec of
+    their data source (see lib.data_sources.codec) and written in chunks with
+    a Core executemany insert, or with COPY if the database is PostgreSQL.
+    This avoids building one ORM object per data point.
+
+    A batch (the body of a bulk upload) may contain the data points as
+      - 'data': list of JSON strings (or dicts), one per data point
+      - 'ndjson': string of newline-delimited JSON objects
+      - 'packed': base64 encoded little-endian records holding the columns of
+        the data source (without user_id) in table order, integers as int64,
+        floats as float64 and booleans as one byte. Data sources with
+        string columns cannot be packed. """
+import base64
+import csv
+import io
+import json
+import logging
+import time
+
+from lib.backend import partitioning
+from lib.data_structures import PartialAggregate
+
+
+def read_data_points(codec, batch):
+    """ Iterate over the data points of a batch, see module description for the accepted formats.
+
+    Raises:
+        - ValueError: if the batch is malformed """
+    if batch.get('data') is not None:
+        for item in batch['data']:
+            yield json.loads(item) if isinstance(item, (str, bytes)) else item
+    if batch.get('ndjson') is not None:
+        for line in io.StringIO(batch['ndjson']):
+            if line.strip():
+                yield json.loads(line)
+    if batch.get('packed') is not None:
+        record = codec.packed_struct()
+        payload = base64.b64decode(batch['packed'])
+        if len(payload) % record.size != 0:
+            raise ValueError("Packed batch is not a multiple of {} bytes".format(record.size))
+        for values in record.iter_unpack(payload):
+            yield dict(zip(codec.columns, values))
+
+
+def ingest(session, codec, user_id, data_points, chunk_size, bucket_sizes=()):
+    """ Validate and write data points in chunks within the transaction of the session.
+
+    Args:
+        - session (db session): session to use, it is not committed
+        - codec (DataSourceCodec): codec of the data source
+        - user_id (int): user the data points belong to
+        - data_points (iterable of dicts): data points as returned by read_data_points()
+        - chunk_size (int): number of rows written at once
+        - bucket_sizes (list of int): bucket sizes of the partial aggregates to update
+
+    Returns:
+        - list of dicts: one per chunk, containing 'rows', 'seconds' and 'rows_per_second'
+
+    Raises:
+        - ValueError: if a data point is invalid """
+    write = _copy_rows if session.bind.dialect.name == 'postgresql' else _insert_rows
+    chunks = []
+    rows = []
+    started = time.perf_counter()
+    for data_point in data_points:
+        rows.append(codec.decode(user_id, data_point))
+        if len(rows) >= chunk_size:
+            chunks.append(_write_chunk(session, codec, rows, write, started, bucket_sizes))
+            rows = []
+            started = time.perf_counter()
+    if rows:
+        chunks.append(_write_chunk(session, codec, rows, write, started, bucket_sizes))
+    return chunks
+
+
+def _write_chunk(session, codec, rows, write, started, bucket_sizes):
+    partitioning.ensure_partitions(session, codec.table, rows)
+    write(session, codec, rows)
+    if bucket_sizes:
+        PartialAggregate.add(session, codec.source, rows, bucket_sizes)
+    seconds = time.perf_counter() - started
+    stats = {'rows': len(rows), 'seconds': seconds, 'rows_per_second': len(rows) / seconds if seconds > 0 else None}
+    logging.info("Ingested %i rows into %s in %.3f s", len(rows), codec.table.name, seconds)
+    return stats
+
+
+def _insert_rows(session, codec, rows):
+    session.execute(codec.table.insert(), rows)
+
+
+def _copy_rows(session, codec, rows):
+    """ Write rows with COPY, using the connection (and transaction) of the session. """
+    preparer = session.bind.dialect.identifier_preparer
+    columns = ['user_id'] + codec.columns
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([r'\N' if row[c] is None else row[c] for c in columns])
+    buffer.seek(0)
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.copy_expert("COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')".format(
+            preparer.format_table(codec.table),
+            ', '.join(preparer.quote(c) for c in columns)), buffer)
+    finally:
+        cursor.close()
@@ -9,6 +9,7 @@ import time
 import logging
 
 import celery
+from sqlalchemy.exc import SQLAlchemyError
 from lib.config import Configuration
 
 from lib.data_structures import token
@@ -18,11 +19,14 @@ from lib.data_structures.upload_granularity import UploadGranularity
 from lib.data_structures.registered_data_source import RegisteredDataSource
 from lib.data_structures.privacy_default import PrivacyDefault
 from lib.data_structures.privacy_setting import PrivacySetting
+from lib.data_structures import PartialAggregate
 from lib.data_structures import enums
 from lib.data_structures import UserDataType
 from lib.backend.helper_methods import HelperMethods
-from lib.data_sources import PersonalInformation, RandomData, OpenhabSensor, Iris
+from lib.data_sources import codec
 from lib.backend import database as db
+from lib.backend import partitioning
+from lib.backend.tasks.data_source import ingestion
 
 
 """ Data Source Section:
@@ -796,6 +800,7 @@ def remove_data_source_data(user_id, data_source_id, data_source_name):
         data_points = session.query(HelperMethods.tablename_to_source(data_source_name)).filter_by(user_id=user_id).all()
         for element in data_points:
             session.delete(element)
+        PartialAggregate.remove(session, data_source_name, user_id)
         # write changes to data base
         session.commit()
         session.close()
@@ -1558,6 +1563,8 @@ def add_data_point(uuid, data_source_type, data_point):
         - error (dict):
             - code (int):
                 1 -- invalid session token
+                8 -- no such data source
+                33 -- invalid data point
                 99 -- undefined
             - message (str): error code meaning including query information
         - response (empty dict)
@@ -1567,61 +1574,11 @@ def add_data_point(uuid, data_source_type, data_point):
     session = db.get_db_session()
     result = {'success': False}
 
-    # Determine what data we got and create object to insert into database
-
-    data = json.loads(data_point['data'])
-
-    try:
-        if data_source_type.lower() == "openhabsensor":
-            data_point_obj = OpenhabSensor(
-                uuid,
-                data['timestamp'],
-                data['sensor_name'],
-                data['data_type'],
-                data['value']
-            )
-
-        elif data_source_type.lower() == "personalinformation":
-            data_point_obj = PersonalInformation(
-                uuid,
-                data['timestamp'],
-                data['user_name'],
-                data['first_name'],
-                data['last_name'],
-                data['street'],
-                data['city'],
-                data['zip_code'],
-                data['country'],
-                data['birthday'],
-                data['email'],
-                data['gender']
-            )
-
-        elif data_source_type.lower() == "randomdata":
-            data_point_obj = RandomData(
-                uuid,
-                data['timestamp'],
-                float(data['random_one']),
-                float(data['random_two'])
-            )
-
-        elif data_source_type.lower() == "iris":
-            data_point_obj = Iris(
-                uuid,
-                data['timestamp'],
-                float(data['sepal_length']),
-                float(data['sepal_width']),
-                float(data['petal_length']),
-                float(data['petal_width']),
-                data['iris_class']
-            )
-
-    except Exception:
-        if Configuration.test_mode:
-            logging.exception("An error occured:")
+    data_source_codec = codec.get_codec(data_source_type)
+    if data_source_codec is None:
         session.close()
         error = {
-            'code': enums.Error.UNDEFINED,
+            'code': enums.Error.NO_SUCH_DATA_SOURCE,
             'message': "Error! Are you sure a data source of type {} exists?".format(
                 data_source_type
             )
@@ -1630,7 +1587,20 @@ def add_data_point(uuid, data_source_type, data_point):
         return result
 
     try:
-        session.add(data_point_obj)
+        row = data_source_codec.decode(uuid, json.loads(data_point['data']))
+    except ValueError as e:
+        if Configuration.test_mode:
+            logging.exception("An error occured:")
+        session.close()
+        error = {'code': enums.Error.INVALID_DATA_POINT, 'message': "Invalid data point: {}".format(e)}
+        result['error'] = error
+        return result
+
+    try:
+        partitioning.ensure_partitions(session, data_source_codec.table, [row])
+        session.execute(data_source_codec.table.insert(), [row])
+        if Configuration.partial_aggregate_granularities:
+            PartialAggregate.add(session, data_source_codec.source, [row], Configuration.partial_aggregate_granularities)
         session.commit()
         session.close()
     except Exception:
@@ -1660,6 +1630,8 @@ def add_data(user_id, data_source_name, data):
         - error (dict):
             - code (int):
                 1 -- invalid session token
+                8 -- no such data source
+                33 -- invalid data point
                 99 -- undefined
             - message (str): error code meaning including query information
         - response (empty dict)
@@ -1677,29 +1649,35 @@ def add_data(user_id, data_source_name, data):
         error = {'code': enums.Error.NO_DATA_GIVEN, 'message': "No data was given which could be uploaded!"}
         result['error'] = error
         return result
+    data_source_codec = codec.get_codec(data_source_name)
+    if data_source_codec is None:
+        session.close()
+        error = {'code': enums.Error.NO_SUCH_DATA_SOURCE, 'message': "No data source with name {} exists!".format(data_source_name)}
+        result['error'] = error
+        return result
     try:
-        for data_point in data:
-            data_point_obj = HelperMethods.classname_to_source(data_source_name)(user_id=user_id)
-            data_point_obj.user_id = user_id
-            for key in data_point.keys():
-                setattr(data_point_obj, key, data_point[key])
-            session.add(data_point_obj)
-        try:
-            session.commit()
-            session.close()
-        except Exception:
-            if Configuration.test_mode:
-                logging.exception("An error occured:")
-            session.rollback()
-            session.close()
-            error = {'code': enums.Error.UNDEFINED, 'message': "Unknown error occured."}
-            result['error'] = error
-            return result
+        rows = [data_source_codec.decode(user_id, data_point) for data_point in data]
+    except ValueError as e:
+        if Configuration.test_mode:
+            logging.exception("An error occured:")
+        session.close()
+        error = {'code': enums.Error.INVALID_DATA_POINT, 'message': "Invalid data point: {}".format(e)}
+        result['error'] = error
+        return result
+    try:
+        if rows:
+            partitioning.ensure_partitions(session, data_source_codec.table, rows)
+            session.execute(data_source_codec.table.insert(), rows)
+            if Configuration.partial_aggregate_granularities:
+                PartialAggregate.add(session, data_source_codec.source, rows, Configuration.partial_aggregate_granularities)
+        session.commit()
+        session.close()
     except Exception:
         if Configuration.test_mode:
             logging.exception("An error occured:")
+        session.rollback()
         session.close()
-        error = {'code': enums.Error.NO_SUCH_DATA_SOURCE, 'message': "No data source with name {} exists!".format(data_source_name)}
+        error = {'code': enums.Error.UNDEFINED, 'message': "Unknown error occured."}
         result['error'] = error
         return result
 
@@ -1708,6 +1686,89 @@ def add_data(user_id, data_source_name, data):
     return result
 
 
+@celery.shared_task
+def add_data_batches(batches):
+    """ Add the data points of several users and data sources at once, e.g. the batches of the write buffer of the API.
+
+        The data points of all batches of a data source are written together
+        in one transaction. If that fails, e.g. because of a duplicate data
+        point, the batches of the data source are written one by one, such
+        that only the failing batches are rejected.
+
+    Args:
+        - batches (list of lists): batches of the form [user_id, data_source_name, data], data as for add_data()
+
+    Returns:
+        - success (bool)
+        - error (dict):
+            - code (int):
+                99 -- undefined
+            - message (str): error code meaning
+        - response (dict):
+            - results (list of dicts): result of each batch as returned by add_data(), in the order of batches
+
+        (returns error only if success == False and response otherwise)
+    """
+    result = {'success': False}
+    results = [None] * len(batches)
+    # decoded rows of the batches per data source, as (data source codec, [(index of batch, rows), ...])
+    sources = {}
+    for i, (user_id, data_source_name, data) in enumerate(batches):
+        data_source_codec = codec.get_codec(data_source_name)
+        if data_source_codec is None:
+            error = {'code': enums.Error.NO_SUCH_DATA_SOURCE, 'message': "No data source with name {} exists!".format(data_source_name)}
+            results[i] = {'success': False, 'error': error}
+            continue
+        try:
+            rows = [data_source_codec.decode(user_id, data_point) for data_point in data.get('data', [])]
+        except ValueError as e:
+            error = {'code': enums.Error.INVALID_DATA_POINT, 'message': "Invalid data point: {}".format(e)}
+            results[i] = {'success': False, 'error': error}
+            continue
+        sources.setdefault(data_source_codec.table.name, (data_source_codec, []))[1].append((i, rows))
+
+    session = db.get_db_session()
+    try:
+        for data_source_codec, parts in sources.values():
+            if not _write_rows(session, data_source_codec, [row for _, rows in parts for row in rows]):
+                for i, rows in parts:
+                    if not _write_rows(session, data_source_codec, rows):
+                        results[i] = {'success': False, 'error': {'code': enums.Error.UNDEFINED, 'message': "Unknown error occured."}}
+            for i, _ in parts:
+                if results[i] is None:
+                    results[i] = {'success': True, 'response': {}}
+        session.close()
+    except Exception:
+        if Configuration.test_mode:
+            logging.exception("An error occured:")
+        session.rollback()
+        session.close()
+        error = {'code': enums.Error.UNDEFINED, 'message': "Unknown error occured."}
+        result['error'] = error
+        return result
+
+    result['success'] = True
+    result['response'] = {'results': results}
+    return result
+
+
+def _write_rows(session, data_source_codec, rows):
+    """ Write rows of a data source and commit them, return False if they were rolled back. """
+    try:
+        if rows:
+            partitioning.ensure_partitions(session, data_source_codec.table, rows)
+            session.execute(data_source_codec.table.insert(), rows)
+            if Configuration.partial_aggregate_granularities:
+                PartialAggregate.add(session, data_source_codec.source, rows, Configuration.partial_aggregate_granularities)
+        session.commit()
+        return True
+    except SQLAlchemyError:
+        if Configuration.test_mode:
+            logging.exception("An error occured:")
+        session.rollback()
+        return False
+
+
 @celery.shared_task
 def add_data_points(data_points):
     """ Internal function for testing to add new data points of specific data source to database for testing and without checking any requirements.
@@ -1806,10 +1867,14 @@ def get_data(uuid, data_source_name, interval_begin, interval_end):
 def upload_data_bulk(uuid, data_source_type, data_points):
     """Add new data points of specific data source to database.
 
+    The data points are validated against the columns of the data source and
+    written in chunks of Configuration.ingest_chunk_size rows (see ingestion).
+
     Args:
         - uuid (int): uid of user
         - data_source_type (str): type of data, e.g., openhabsensor or personalinformation
-        - data_points (dict): data points to upload
+        - data_points (dict): data points to upload, as list of JSON strings ('data'),
+            newline-delimited JSON ('ndjson') or base64 encoded packed records ('packed')
 
     Returns:
         - success (bool)
@@ -1817,98 +1882,50 @@ def upload_data_bulk(uuid, data_source_type, data_points):
             - code (int):
                 1 -- invalid token
                 8 -- no such data source
+                31 -- no data given
+                33 -- invalid data point
                 99 -- undefined
             - message (str): error code meaning including query information
-        - response (empty dict)
+        - response (dict):
+            - rows (int): number of uploaded data points
+            - chunks (list of dicts): rows, seconds and rows_per_second of every written chunk
 
         (returns error only if success == False and response otherwise)
     """
     session = db.get_db_session()
     result = {'success': False}
 
-    # Determine what data we got and create object to insert into database
-    data_items = (data_points['data'])
-    data_point_obj = []
-
-    try:
-        if data_source_type.lower() == "openhabsensor":
-            for data_item in data_items:
-                data = json.loads(data_item)
-                data_point_obj.append(
-                    OpenhabSensor(
-                        uuid,
-                        data['timestamp'],
-                        data['sensor_name'],
-                        data['data_type'],
-                        data['value']
-                    )
-                )
-
-        elif data_source_type.lower() == "personalinformation":
-            for data_item in data_items:
-                data = json.loads(data_item)
-                data_point_obj.append(
-                    PersonalInformation(
-                        uuid,
-                        data['timestamp'],
-                        data['user_name'],
-                        data['first_name'],
-                        data['last_name'],
-                        data['street'],
-                        data['city'],
-                        data['zip_code'],
-                        data['country'],
-                        data['birthday'],
-                        data['email'],
-                        data['gender']
-                    )
-                )
-
-        elif data_source_type.lower() == "randomdata":
-            for data_item in data_items:
-                data = json.loads(data_item)
-                data_point_obj.append(
-                    RandomData(
-                        uuid,
-                        data['timestamp'],
-                        float(data['random_one']),
-                        float(data['random_two'])
-                    )
-                )
-
-        elif data_source_type.lower() == "iris":
-            for data_item in data_items:
-                data = json.loads(data_item)
-                data_point_obj.append(
-                    Iris(
-                        uuid,
-                        data['timestamp'],
-                        float(data['sepal_length']),
-                        float(data['sepal_width']),
-                        float(data['petal_length']),
-                        float(data['petal_width']),
-                        data['iris_class']
-                    )
-                )
-
-        else:
-            session.close()
-            error = {'code': enums.Error.NO_SUCH_DATA_SOURCE, 'message': "No datasource with type {} exists!".format(data_source_type)}
-            result['error'] = error
-            return result
-
-    except Exception:
-        if Configuration.test_mode:
-            logging.exception("An error occured:")
+    data_source_codec = codec.get_codec(data_source_type)
+    if data_source_codec is None:
         session.close()
-        error = {'code': enums.Error.UNDEFINED, 'message': "Unknown error occured."}
+        error = {'code': enums.Error.NO_SUCH_DATA_SOURCE, 'message': "No datasource with type {} exists!".format(data_source_type)}
+        result['error'] = error
+        return result
+    if not any(data_points.get(key) is not None for key in ['data', 'ndjson', 'packed']):
+        session.close()
+        error = {'code': enums.Error.NO_DATA_GIVEN, 'message': "No data was given which could be uploaded!"}
         result['error'] = error
         return result
 
     try:
-        session.bulk_save_objects(data_point_obj)
+        chunks = ingestion.ingest(
+            session,
+            data_source_codec,
+            uuid,
+            ingestion.read_data_points(data_source_codec, data_points),
+            Configuration.ingest_chunk_size,
+            Configuration.partial_aggregate_granularities
+        )
         session.commit()
         session.close()
+    except ValueError as e:
+        if Configuration.test_mode:
+            logging.exception("An error occured:")
+        session.rollback()
+        session.close()
+        error = {'code': enums.Error.INVALID_DATA_POINT, 'message': "Invalid data point: {}".format(e)}
+        result['error'] = error
+        return result
     except Exception:
         if Configuration.test_mode:
             logging.exception("An error occured:")
@@ -1918,7 +1935,7 @@ def upload_data_bulk(uuid, data_source_type, data_points):
         result['error'] = error
         return result
     result['success'] = True
-    result['response'] = {}
+    result['response'] = {'rows': sum(chunk['rows'] for chunk in chunks), 'chunks': chunks}
     return result
 
 
@@ -1949,6 +1966,7 @@ def remove_data_points(user_id, data_source_name):
         data_points = session.query(data_source_object).filter_by(user_id=user_id).all()
         for element in data_points:
             session.delete(element)
+        PartialAggregate.remove(session, data_source_name, user_id)
 
         session.commit()
         session.close()
@@ -1965,3 +1983,46 @@ def remove_data_points(user_id, data_source_name):
         error['message'] = "Unknown error occured."
         result['error'] = error
         return result
+
+
+@celery.shared_task
+def maintain_data_storage():
+    """ Create the partitions of the current and the next month of all partitioned data source tables and drop
+        the data points older than Configuration.data_retention_months (see lib.backend.partitioning).
+
+    Returns:
+        - success (bool)
+        - error (dict):
+            - code (int):
+                99 -- undefined
+            - message (str): error code meaning
+        - response (dict):
+            - cutoff (int): timestamp before which data points were dropped, None if all data points are kept
+            - dropped_partitions (int): number of dropped partitions
+
+        (returns error only if success == False and response otherwise)
+    """
+    result = {'success': False}
+    session = db.get_db_session()
+    try:
+        now = int(time.time() * 1000)
+        for source in partitioning.partitioned_sources():
+            partitioning.ensure_months(session, source.__table__, now, partitioning.add_months(now, 1))
+        cutoff = None
+        dropped = 0
+        if Configuration.data_retention_months > 0:
+            cutoff = partitioning.add_months(now, -Configuration.data_retention_months)
+            dropped = partitioning.drop_expired_data(session, cutoff)
+        session.commit()
+        session.close()
+    except Exception:
+        if Configuration.test_mode:
+            logging.exception("An error occured:")
+        session.rollback()
+        session.close()
+        error = {'code': enums.Error.UNDEFINED, 'message': "Unknown error occured."}
+        result['error'] = error
+        return result
+    result['success'] = True
+    result['response'] = {'cutoff': cutoff, 'dropped_partitions': dropped}
+    return result
@@ -4,15 +4,19 @@
     All functionality is encapsulated in the corresponding backend
     module. """
 
-import copy
 import logging
-from decimal import Decimal
+from decimal import Decimal, ROUND_CEILING, ROUND_FLOOR
+import time
 
 import celery
 
-from lib.backend.tasks.query.tasks import retrieve_query, process_queries, process_query
+from lib.backend.tasks.query.tasks import retrieve_query, process_query
 from lib.backend import database as db
+from lib.backend.result_cache import get_result_cache
 from lib.config import Configuration
+from lib.config import PAYOUT_TIME_BUDGET
+from lib.config import ADD_TXIDS_CURSOR
+from lib.config import PAY_OUT_CURSOR
 from lib.data_structures.base_object import SqlAlchemyException
 from lib.data_structures import QueryState
 from lib.data_structures import enums
@@ -21,6 +25,8 @@ from lib.data_structures import Query_Db
 from lib.data_structures import QueryUser
 from lib.data_structures import QueryUserMapping
 from lib.data_structures import Txid
+from lib.data_structures import ChainCursor
+from lib.data_structures import PayoutCursor
 from lib.data_structures import User
 from lib.backend.payments import BitcoinConnector
 from lib.backend.payments.authproxy import JSONRPCException
@@ -179,11 +185,17 @@ def set_payment_state(proc_id, query_id):
 
 
 @celery.shared_task
-def check_payment(proc_id, query_id, transaction_id, recalc):
+def check_payment(proc_id, query_id, transaction_id, recalc=False):
     """ Check status of a query's payment. """
-    session = db.get_db_session()
     result = {}
     result['success'] = False
+    # the response of a paid or aborted query does not change anymore
+    response = None if recalc else get_result_cache().get((proc_id, query_id))
+    if response is not None:
+        result['success'] = True
+        result['response'] = response
+        return result
+    session = db.get_db_session()
     try:
         query = session.query(Query_Db).filter_by(processor_id=proc_id, query_id=query_id).one_or_none()
     except SqlAlchemyException.MultipleResultsFound:
@@ -255,43 +267,37 @@ def check_payment(proc_id, query_id, transaction_id, recalc):
 
 
 def add_txids():
-    """ Add txids to QueryDB. Creating a Mapping between Querys and TXIDS """
-    # add every transaction which is confirmed by at least 1 block to the db
+    """ Add txids to QueryDB. Creating a Mapping between Querys and TXIDS
+
+        Only the transactions of the blocks after the last examined block are
+        requested (listsinceblock), the position is kept in a ChainCursor. Every
+        received transaction confirmed by at least one block is mapped to the
+        queries of its address. """
     session = db.get_db_session()
-    transactions = BitcoinConnector.auth_proxy.listreceivedbyaddress(1)
-    querys = session.query(Query_Db).all()
-    bitcoin_addresses = []
-    # creates a triple (btcAddress, queryID, processorID)
-    for i in querys:
-        triple = i.address, i.query_id, i.processor_id
-        bitcoin_addresses.append(triple)
-    transaction_list = []
-    # extend the triple to a quadruple with (btcAddress, queryID, processorID, txID)
-    for i in transactions:
-        for j in bitcoin_addresses:
-            if i['address'] in j[0]:
-                quadruple = j[0], j[1], j[2], i['txids'].pop()
-                transaction_list.append(quadruple)
-    # checks if mapping already exists. otherwise create new mapping
-    for j in transaction_list:
-        existing = False
-        mapping = session.query(Txid).all()
-        if not len(mapping) == 0:
-            for x in mapping:
-                if x.query_id == j[1] and x.tx_id == j[3]:
-                    existing = True
-
-            if not existing and len(transaction_list) != 0:
-                txid = Txid(tx_id=j[3], query_id=j[1], proc_id=j[2])
-                session.add(txid)
-                session.commit()
-                session.close()
+    try:
+        cursor = session.query(ChainCursor).get(ADD_TXIDS_CURSOR)
+        if cursor is None:
+            cursor = ChainCursor(ADD_TXIDS_CURSOR, None)
+            session.add(cursor)
+        if cursor.block_hash is None:
+            since = BitcoinConnector.auth_proxy.listsinceblock()
         else:
-            txid = Txid(tx_id=j[3], query_id=j[1], proc_id=j[2])
-            session.add(txid)
-            session.commit()
-            session.close()
-    session.close()
+            since = BitcoinConnector.auth_proxy.listsinceblock(cursor.block_hash)
+        received = {}
+        for transaction in since['transactions']:
+            if transaction.get('category') == 'receive' and transaction.get('confirmations', 0) >= 1:
+                received.setdefault(transaction['address'], set()).add(transaction['txid'])
+        if received:
+            queries = session.query(Query_Db.address, Query_Db.query_id, Query_Db.processor_id).filter(Query_Db.address.in_(received))
+            Txid.add_all(session, [(tx_id, query_id, proc_id) for address, query_id, proc_id in queries for tx_id in received[address]])
+        # unconfirmed transactions are returned again once they are part of a block after lastblock
+        cursor.block_hash = since['lastblock']
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
 
 
 def check_direct_pay(proc_id, query_id, transaction_id):
@@ -399,99 +405,181 @@ def create_mapping(proc_id, query_id):
         session.close()
 
 
+def satoshi_to_btc(satoshi):
+    """ Convert an amount of satoshi into BTC, rounded like all payouts. """
+    return (Decimal(0.00000001) * Decimal(satoshi)).quantize(Decimal("0.0000001"))
+
+
 @celery.shared_task(ignore_result=True)
 def pay_out():
-    """ Periodically check if users can be or want to be paid out, and do so accordingly. """
-    process_queries()
-    if Configuration.payment_mode is PaymentMethod.NONE:
-        pass  # No payment required
-    elif Configuration.payment_mode is PaymentMethod.BITCOIN_DIRECT:
-        pass  # Direct pay used
-    else:
-        session = db.get_db_session()
-        users = session.query(User).all()
-        for u in users:
-            amount = Decimal(0.00000001 * u.balance).quantize(Decimal("0.0000001"))
-            if amount >= Configuration.payment_payout_threshold:
-                if (BitcoinConnector.initialized and BitcoinConnector.use_wallet):
-                    try:
-                        txid = BitcoinConnector.auth_proxy.sendfrom("platform", u.btc_address, amount - Decimal("0.0001"))
-                    except JSONRPCException as message:
-                        if Configuration.test_mode:
-                            logging.exception("An error occured: %s" % message)
-                    u.balance = 0
-                    session.commit()
+    """ Periodically check if users can be or want to be paid out, and do so accordingly.
+
+        The users whose balance reaches the payout threshold are selected by the
+        database and paid in shards of Configuration.payout_shard_size users with
+        one transaction and one commit per shard. A failing shard is rolled back
+        and its users stay eligible. After PAYOUT_TIME_BUDGET seconds the cycle
+        stops. The last examined user is kept in a PayoutCursor, the next cycle
+        continues after this user and wraps around at the end, such that users
+        with higher ids are reached although others are skipped every cycle. """
+    if Configuration.payment_mode in [PaymentMethod.NONE, PaymentMethod.BITCOIN_DIRECT]:
+        return  # No payment required or direct pay used
+    threshold = Decimal(str(Configuration.payment_payout_threshold))
+    min_balance = int((threshold / Decimal("0.00000001")).to_integral_value(rounding=ROUND_FLOOR))
+    use_wallet = BitcoinConnector.initialized and BitcoinConnector.use_wallet
+    started = time.monotonic()
+    # unspent outputs and private keys are fetched once per cycle
+    unspent = None
+    private_keys = {}
+    session = db.get_db_session()
+    try:
+        cursor = session.query(PayoutCursor).get(PAY_OUT_CURSOR)
+        if cursor is None:
+            cursor = PayoutCursor(PAY_OUT_CURSOR, None)
+            session.add(cursor)
+            session.commit()
+        # every user is examined at most once per cycle: from the cursor to the end and from the start to the cursor
+        first_user_id = cursor.user_id
+        last_user_id = first_user_id
+        wrapped = first_user_id is None
+        while time.monotonic() - started < PAYOUT_TIME_BUDGET:
+            shard = session.query(User).filter(User.balance >= min_balance)
+            if last_user_id is not None:
+                shard = shard.filter(User.user_id > last_user_id)
+            if wrapped and first_user_id is not None:
+                shard = shard.filter(User.user_id <= first_user_id)
+            shard = shard.order_by(User.user_id).limit(Configuration.payout_shard_size).all()
+            if len(shard) == 0:
+                if wrapped:
+                    break
+                wrapped = True
+                last_user_id = None
+                continue
+            last_user_id = shard[-1].user_id
+            users = [u for u in shard if satoshi_to_btc(u.balance) >= threshold]
+            try:
+                if use_wallet:
+                    pay_out_from_wallet(users)
                 else:
-                    query_ids = session.query(QueryUserMapping).filter_by(user_id=u.user_id).all()
-                    inputs = []
-                    change_address = []
-                    input_counter = 1
-                    unspent_transactions = BitcoinConnector.auth_proxy.listunspent()
-                    left_on_address = []
-                    for i in query_ids:
-                        txid_all = session.query(Txid).filter(Txid.query_id == i.query_id).filter(Txid.proc_id == i.proc_id).all()
-                        query = session.query(Query_Db).filter(Query_Db.query_id == i.query_id).filter(Query_Db.processor_id == i.proc_id).one()
-                        for x in txid_all:
-                            for y in unspent_transactions:
-                                existent = False
-
-                                if x.tx_id == y['txid']:
-                                    if y['amount'] >= (Decimal((query.price / query.amount)) * Decimal(0.00000001)).quantize(Decimal("0.0000001")):
-
-                                        txid = x
-
-                                        left_on_address.append((txid.tx_id, y['amount'],
-                                                                y['vout'], query.address))
-                                        for z in inputs:
-                                            if z['txid'] == txid.tx_id and z['vout'] == y['vout']:
-                                                existent = True
-
-                                        if not existent:
-
-                                            if y['address'] == query.address:
-                                                inputs.append(({"txid": txid.tx_id, "vout": y['vout'],
-                                                                "scriptPubKey": y['scriptPubKey']}))
-                                                input_counter = input_counter + 1
-                                                change_amount = y['amount']
-                                                change_address.append((query.address, query.price / query.amount, Decimal(change_amount)))
-                                    else:
-                                        pass  # No money left
-
-                    user_address = u.btc_address
-
-                    outputs = {}
-                    normal_fee = Decimal("0.0000001")
-                    size = ((len(inputs) * 148) + (len(change_address) * 34) + (10 + input_counter))
-                    fees = Decimal(normal_fee * size).quantize(Decimal("0.000000001"))
-
-                    for j in change_address:
-                        refund = Decimal((j[2] - Decimal(0.00000001) * Decimal(j[1]))
-                                         .quantize(Decimal("0.0000001")))
-                        next_output = {j[0]: refund}
-                        outputs.update(next_output)
-                    next_output = {user_address: Decimal(amount - fees)}
-                    outputs.update(next_output)
-                    try:
-                        tx = BitcoinConnector.auth_proxy.createrawtransaction(inputs, outputs)
-                        copy_list = copy.deepcopy(inputs)
-                        priv_key = []
-                        for i in copy_list:
-                            first_unspent = BitcoinConnector.auth_proxy.gettransaction(i.pop('txid'))
-                            for j in first_unspent['details']:
-                                if j['vout'] == i['vout']:
-                                    priv_key.append(BitcoinConnector.auth_proxy.dumpprivkey(j['address']))
-                        signed_raw_tx = BitcoinConnector.auth_proxy.signrawtransactionwithkey(tx, priv_key)
-                        new_txid = BitcoinConnector.auth_proxy.sendrawtransaction(signed_raw_tx['hex'])
-                        for i in query_ids:
-                            session.query(Txid).filter(Txid.query_id == i.query_id).filter(Txid.proc_id == i.proc_id).update({'tx_id': new_txid})
-                            session.commit()
-                        session.query(QueryUserMapping).filter(QueryUserMapping.user_id == u.user_id).filter(QueryUserMapping.paid == 0).update(
-                            {'paid': 1})
-                        session.query(User).filter(User.user_id == u.user_id).update({'balance': 0})
-                        session.commit()
-                        size = BitcoinConnector.auth_proxy.decoderawtransaction(signed_raw_tx['hex'])['size']
-                    except JSONRPCException as message:
-                        if Configuration.test_mode:
-                            logging.exception("An error occured: %s" % message)
-                        session.close()
+                    if unspent is None:
+                        unspent = unspent_by_txid()
+                    pay_out_from_queries(session, users, unspent, private_keys)
+                cursor.user_id = last_user_id
+                session.commit()
+            except JSONRPCException as message:
+                session.rollback()
+                if Configuration.test_mode:
+                    logging.exception("An error occured: %s" % message)
+                cursor.user_id = last_user_id
+                session.commit()
+    finally:
         session.close()
+        logging.debug("Bitcoin RPC metrics: %s", BitcoinConnector.metrics())
+
+
+def pay_out_from_wallet(users):
+    """ Pay out the balances of users from the platform account of the wallet with one transaction. """
+    outputs = {}
+    for u in users:
+        outputs[u.btc_address] = outputs.get(u.btc_address, Decimal(0)) + satoshi_to_btc(u.balance) - Decimal("0.0001")
+        u.balance = 0
+    if outputs:
+        BitcoinConnector.auth_proxy.sendmany("platform", outputs)
+
+
+def unspent_by_txid():
+    """ Return the unspent outputs of the wallet as {txid: [unspent output]}. """
+    unspent = {}
+    for output in BitcoinConnector.auth_proxy.listunspent():
+        unspent.setdefault(output['txid'], []).append(output)
+    return unspent
+
+
+def pay_out_from_queries(session, users, unspent, private_keys):
+    """ Pay out the balances of users with one transaction spending the funds of the queries they participated in.
+
+        The unspent outputs of the query addresses are spent, the shares of the
+        users are paid to them and the remainder goes back to the query
+        addresses. Users whose queries lack funds are skipped.
+
+    Args:
+        - session (db session): session to use, it is not committed
+        - users (list of User): users to pay out
+        - unspent (dict): unspent outputs as returned by unspent_by_txid(), spent outputs are removed
+        - private_keys (dict): private keys by address, filled with the keys of the spent outputs """
+    user_ids = [u.user_id for u in users]
+    mappings = session.query(QueryUserMapping).filter(QueryUserMapping.user_id.in_(user_ids), QueryUserMapping.paid == 0).all()
+    keys = {(m.proc_id, m.query_id) for m in mappings}
+    if len(keys) == 0:
+        return
+    queries = {}
+    for query in session.query(Query_Db).filter(
+            Query_Db.processor_id.in_({k[0] for k in keys}), Query_Db.query_id.in_({k[1] for k in keys})):
+        if (query.processor_id, query.query_id) in keys:
+            queries[(query.processor_id, query.query_id)] = query
+    # funds of every query: the unspent outputs of its transactions paid to its address
+    funds = {}
+    for txid in session.query(Txid).filter(Txid.proc_id.in_({k[0] for k in keys}), Txid.query_id.in_({k[1] for k in keys})):
+        key = (txid.proc_id, txid.query_id)
+        if key not in queries:
+            continue
+        outputs = funds.setdefault(key, {})
+        for output in unspent.get(txid.tx_id, []):
+            if output['address'] == queries[key].address:
+                outputs[(output['txid'], output['vout'])] = output
+    available = {key: sum((o['amount'] for o in outputs.values()), Decimal(0)) for key, outputs in funds.items()}
+
+    # pay every user whose shares are covered by the funds of all of their queries
+    mappings_by_user = {}
+    for m in mappings:
+        mappings_by_user.setdefault(m.user_id, []).append((m.proc_id, m.query_id))
+    paid_users = []
+    spent_shares = {}
+    for u in users:
+        shares = {}
+        for key in mappings_by_user.get(u.user_id, []):
+            if key in queries:
+                shares[key] = shares.get(key, Decimal(0)) + satoshi_to_btc(queries[key].price / queries[key].amount)
+        if len(shares) == 0 or any(available.get(key, Decimal(0)) - spent_shares.get(key, Decimal(0)) < share for key, share in shares.items()):
+            continue
+        for key, share in shares.items():
+            spent_shares[key] = spent_shares.get(key, Decimal(0)) + share
+        paid_users.append(u)
+    if len(paid_users) == 0:
+        return
+
+    inputs = []
+    outputs = {}
+    for key, share in spent_shares.items():
+        for output in funds[key].values():
+            inputs.append({"txid": output['txid'], "vout": output['vout'], "scriptPubKey": output['scriptPubKey']})
+        refund = (available[key] - share).quantize(Decimal("0.0000001"))
+        address = queries[key].address
+        outputs[address] = outputs.get(address, Decimal(0)) + refund
+    normal_fee = Decimal("0.0000001")
+    size = (len(inputs) * 148) + ((len(outputs) + len(paid_users)) * 34) + (10 + len(inputs))
+    fee = (normal_fee * size / len(paid_users)).quantize(Decimal("0.00000001"), rounding=ROUND_CEILING)
+    for u in paid_users:
+        outputs[u.btc_address] = outputs.get(u.btc_address, Decimal(0)) + satoshi_to_btc(u.balance) - fee
+
+    tx = BitcoinConnector.auth_proxy.createrawtransaction(inputs, outputs)
+    spent = [output for key in spent_shares for output in funds[key].values()]
+    missing = sorted({o['address'] for o in spent if o['address'] not in private_keys})
+    private_keys.update(zip(missing, BitcoinConnector.auth_proxy.batch_call([('dumpprivkey', (a,)) for a in missing])))
+    signed_raw_tx = BitcoinConnector.auth_proxy.signrawtransactionwithkey(tx, list({private_keys[o['address']] for o in spent}))
+    new_txid = BitcoinConnector.auth_proxy.sendrawtransaction(signed_raw_tx['hex'])
+
+    for output in spent:
+        remaining = [o for o in unspent.get(output['txid'], []) if o['vout'] != output['vout']]
+        if remaining:
+            unspent[output['txid']] = remaining
+        else:
+            unspent.pop(output['txid'], None)
+    # the funds of the queries are now the outputs of the new transaction
+    for proc_id, query_id in spent_shares:
+        session.query(Txid).filter(Txid.query_id == query_id).filter(Txid.proc_id == proc_id).delete(synchronize_session=False)
+    Txid.add_all(session, [(new_txid, query_id, proc_id) for proc_id, query_id in spent_shares])
+    paid_ids = [u.user_id for u in paid_users]
+    session.query(QueryUserMapping).filter(QueryUserMapping.user_id.in_(paid_ids)).filter(QueryUserMapping.paid == 0).update(
+        {'paid': 1}, synchronize_session=False)
+    for u in paid_users:
+        u.balance = 0
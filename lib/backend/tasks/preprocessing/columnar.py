@@ -0,0 +1,298 @@
+""" Columnar preprocessing engine.
+
+    This module is an alternative implementation of unify_times() and
+    unify_length() from the preprocessing tasks. Instead of working on one
+    python list per user and attribute, all rows of an attribute which share
+    the same granularities are stored as a (users x timeslots) float64 matrix
+    in which missing values are NaN. Re-gridding, pre-aggregation,
+    interpolation and filling are then applied to the whole matrix at once.
+
+    The engine consumes and produces the values-dict format used by the rest
+    of the preprocessing chain, so it can be switched on via the
+    'preprocessing_engine' option without touching any caller. """
+from math import ceil
+
+import numpy as np
+
+from lib.config import MAX_INTERPOLATION_INTERVAL
+from lib.config import INTERPOLATION_LIMIT
+
+
+class RowBlock():
+    """ All rows of one attribute sharing the same time grid.
+
+    Attributes:
+        - users (list): user ids, one per matrix row
+        - levels (list): privacy levels, one per matrix row
+        - values (numpy.ndarray): (users x timeslots) matrix, missing values are NaN
+        - start_time (int): timestamp of the first timeslot in milliseconds
+        - gran (int): distance between two succeeding timeslots in milliseconds """
+
+    def __init__(self, users, levels, values, start_time, gran):
+        self.users = users
+        self.levels = levels
+        self.values = values
+        self.start_time = start_time
+        self.gran = gran
+
+    def select(self, mask):
+        """ Return a new block only containing the rows where mask is True. """
+        users = [user for user, keep in zip(self.users, mask) if keep]
+        levels = [level for level, keep in zip(self.levels, mask) if keep]
+        return RowBlock(users, levels, self.values[mask], self.start_time, self.gran)
+
+
+def unify(values, start_time, end_time, new_gran):
+    """ Columnar equivalent of unify_length(unify_times(values, ...), ..., pre_aggregate, fill_with_nones).
+
+    Args:
+        - values (dict): user data as returned by select_query_data()
+        - start_time (int): start of interval in milliseconds
+        - end_time (int): end of interval in milliseconds
+        - new_gran (int): granularity of the resulting rows in milliseconds
+
+    Returns:
+        - dict of int : dict: same form as the input, see unify_length() """
+    blocks = unify_times(values, start_time, end_time)
+    blocks = unify_length(blocks, start_time, end_time, new_gran)
+    unified = to_values(blocks)
+    # keep the user order of the input, later aggregation steps iterate over it
+    return {user: unified[user] for user in values if user in unified}
+
+
+def unify_times(values, start_time, end_time):
+    """ Columnar equivalent of unify_times() of the preprocessing tasks.
+
+    Returns:
+        - dict of str : list of RowBlock: blocks per attribute """
+    interval = end_time - start_time
+    blocks = {}
+    if len(values) == 0:
+        return blocks
+
+    dropped = set()
+    for attr in list(values.values())[0]:
+        # group users having the same granularities, they share one time grid
+        groups = {}
+        for user, row in values.items():
+            groups.setdefault((row[attr]['fg'], row[attr]['cg']), []).append(user)
+
+        blocks[attr] = []
+        for (fg, cg), users in groups.items():
+            block = regrid([values[user][attr] for user in users], users, start_time, fg, ceil(interval / float(fg)))
+            if fg != cg:
+                block = pre_aggregate(block, cg, interval)
+            keep = interpolate(block, fg)
+            dropped.update(user for user, kept in zip(block.users, keep) if not kept)
+            blocks[attr].append(block)
+
+    # like the row based engine, a single failed row discards the whole user
+    for attr in blocks:
+        blocks[attr] = [block.select(np.array([user not in dropped for user in block.users], dtype=bool))
+                        for block in blocks[attr]]
+    return blocks
+
+
+def unify_length(blocks, start_time, end_time, new_gran):
+    """ Columnar equivalent of unify_length() using pre_aggregate() and fill_with_nones(). """
+    interval = end_time - start_time
+    for attr in blocks:
+        attr_blocks = [block for block in blocks[attr] if len(block.users) > 0]
+        if len(attr_blocks) == 0:
+            blocks[attr] = []
+            continue
+        if new_gran is not None:
+            attr_gran = new_gran
+            new_len = ceil(interval / float(new_gran))
+        else:
+            shortest = min(attr_blocks, key=lambda block: block.values.shape[1])
+            attr_gran = shortest.gran
+            new_len = shortest.values.shape[1]
+
+        unified = []
+        for block in attr_blocks:
+            if block.values.shape[1] < new_len:
+                block = fill_with_nones(block, attr_gran, interval)
+            elif block.values.shape[1] > new_len:
+                block = pre_aggregate(block, attr_gran, interval)
+            unified.append(block)
+        blocks[attr] = unified
+    return blocks
+
+
+def to_values(blocks):
+    """ Convert blocks back into the values-dict format of the preprocessing chain. """
+    values = {}
+    for attr, attr_blocks in blocks.items():
+        for block in attr_blocks:
+            times = (block.start_time + block.gran * np.arange(block.values.shape[1], dtype=np.int64)).tolist()
+            rows = block.values.astype(object)
+            rows[np.isnan(block.values)] = None
+            for user, level, row in zip(block.users, block.levels, rows.tolist()):
+                values.setdefault(user, {})[attr] = {'v': row,
+                                                     't': list(times),
+                                                     'a': level,
+                                                     'fg': block.gran,
+                                                     'cg': block.gran}
+    return values
+
+
+def regrid(rows, users, start_time, gran, length):
+    """ Move the raw values of all rows onto a common time grid.
+
+        Matches the row based engine which walks the timeslots backwards and
+        assigns the latest remaining value to a slot whenever its timestamp is
+        equal or later than the slot. Value j of a row thus lands in slot
+        a_j = min(b_j, a_(j+1) - 1) where b_j is the slot containing its
+        timestamp. With e_j = a_j - j this becomes a reversed cumulative
+        minimum, which is computed for all rows at once by offsetting every
+        row into its own value range.
+
+    Args:
+        - rows (list of dict): rows containing 'v', 't' and 'a'
+        - users (list): user ids belonging to the rows
+        - start_time (int): start of interval in milliseconds
+        - gran (int): granularity of the grid in milliseconds
+        - length (int): number of timeslots
+
+    Returns:
+        - RowBlock: the re-gridded rows """
+    matrix = np.full((len(rows), length), np.nan)
+    counts = np.array([len(row['v']) for row in rows], dtype=np.int64)
+    for row in rows:
+        if len(row['v']) != len(row['t']):
+            raise AssertionError("List with values should always be as "
+                                 "long as the time list. Number of values:"
+                                 " {}. Number of times: {}."
+                                 .format(len(row['v']), len(row['t'])))
+    levels = [row['a'] for row in rows]
+    total = int(counts.sum())
+    if total == 0:
+        return RowBlock(list(users), levels, matrix, start_time, gran)
+
+    row_index = np.repeat(np.arange(len(rows), dtype=np.int64), counts)
+    offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    position = np.arange(total, dtype=np.int64) - offsets[row_index]
+    times = np.concatenate([np.asarray(row['t'], dtype=np.int64) for row in rows])
+    data = np.concatenate([np.asarray(row['v'], dtype=np.float64) for row in rows])
+
+    slot = np.clip((times - start_time) // gran, -1, length)
+    key = slot - position
+    # shift every row below all rows processed before it (in reversed order),
+    # so the running minimum restarts at each row boundary
+    width = length + int(counts.max()) + 2
+    shift = (len(rows) - 1 - row_index) * width
+    running_min = np.minimum.accumulate((key - shift)[::-1])[::-1] + shift
+    running_min = np.minimum(running_min, length - counts[row_index])
+    target = running_min + position
+
+    valid = target >= 0
+    matrix[row_index[valid], target[valid]] = data[valid]
+    return RowBlock(list(users), levels, matrix, start_time, gran)
+
+
+def pre_aggregate(block, new_gran, interval):
+    """ Columnar equivalent of pre_aggregate(): average groups of timeslots, ignoring NaNs. """
+    gran = block.gran
+    if new_gran % gran != 0:
+        raise ValueError("The new granularity (", str(new_gran), ") is not a multiple of the old one (", str(gran), "!")
+    if new_gran < gran:
+        raise ValueError("The new granularity (", str(new_gran), ") is smaller than the old one (", str(gran), " but pre-aggregate can only enlarge the granularity of a row!")
+    v_len = ceil(interval / float(new_gran))
+    factor = int(new_gran / gran)
+
+    # the last new value takes whatever is left, pad it with NaNs
+    padded = np.full((block.values.shape[0], v_len * factor), np.nan)
+    padded[:, :block.values.shape[1]] = block.values
+    tail = padded[:, (v_len - 1) * factor:]
+
+    groups = padded[:, :(v_len - 1) * factor].reshape(block.values.shape[0], v_len - 1, factor)
+    aggregated = np.empty((block.values.shape[0], v_len))
+    aggregated[:, :v_len - 1] = _nanmean(groups)
+    aggregated[:, v_len - 1] = _nanmean(tail)
+    aggregated = _round(aggregated, 2)
+    return RowBlock(block.users, block.levels, aggregated, block.start_time, new_gran)
+
+
+def interpolate(block, gran):
+    """ Columnar equivalent of interpolate_row(), applied in place.
+
+    Args:
+        - block (RowBlock): the rows to interpolate
+        - gran (int): granularity used to determine the maximum number of consecutive missing values
+
+    Returns:
+        - numpy.ndarray: boolean mask, False for every row which had to be discarded """
+    values = block.values
+    n_rows, n_cols = values.shape
+    if n_rows == 0 or n_cols == 0:
+        return np.ones(n_rows, dtype=bool)
+
+    missing = np.isnan(values)
+    columns = np.arange(n_cols)
+    previous = np.maximum.accumulate(np.where(missing, -1, columns), axis=1)
+    following = np.minimum.accumulate(np.where(missing, n_cols, columns)[:, ::-1], axis=1)[:, ::-1]
+
+    # a run of missing values at the end of a row must not be too long
+    trailing = n_cols - 1 - previous[:, -1]
+    max_interpolation_num = MAX_INTERPOLATION_INTERVAL / gran
+    keep = ~((missing.sum(axis=1) / (1. * n_cols) > INTERPOLATION_LIMIT) | (trailing > max_interpolation_num))
+
+    lower = np.take_along_axis(values, np.clip(previous, 0, n_cols - 1), axis=1)
+    upper = np.take_along_axis(values, np.clip(following, 0, n_cols - 1), axis=1)
+    dist = following - previous
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight_lower = (following - columns) / dist
+        weight_upper = (columns - previous) / dist
+        linear = weight_lower * lower + weight_upper * upper
+    filled = np.where(previous < 0, upper, np.where(following >= n_cols, lower, linear))
+    values[missing] = filled[missing]
+    return keep
+
+
+def fill_with_nones(block, new_gran, interval):
+    """ Columnar equivalent of fill_with_nones(): spread the values onto a finer grid. """
+    v_len = ceil(interval / float(new_gran))
+    slots = (np.arange(block.values.shape[1], dtype=np.int64) * block.gran) // new_gran
+    filled = np.full((block.values.shape[0], v_len), np.nan)
+    filled[:, slots] = block.values
+    return RowBlock(block.users, block.levels, filled, block.start_time, new_gran)
+
+
+def _nanmean(values):
+    """ Mean over the last axis ignoring NaNs, NaN for slices of NaNs only.
+
+        Values are summed up one after another, like sum() does for lists,
+        so the results are identical to the row based engine. """
+    sums = np.zeros(values.shape[:-1])
+    counts = np.zeros(values.shape[:-1], dtype=np.int64)
+    for i in range(values.shape[-1]):
+        column = values[..., i]
+        present = ~np.isnan(column)
+        sums = np.where(present, sums + column, sums)
+        counts += present
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+def _round(values, ndigits):
+    """ Vectorized version of the builtin round().
+
+        numpy.round() scales, rounds and scales back which gives different
+        results than round() whenever the scaled value is a tie, e.g.
+        round(2.675, 2) == 2.67 but numpy.round(2.675, 2) == 2.68. The exact
+        rounding error of the scaling is recovered with Dekker's product and
+        used to break those ties like round() does on the exact value. """
+    scale = 10. ** ndigits
+    scaled = values * scale
+    # error free transformation: values * scale == scaled + error
+    split = values * 134217729.
+    high = split - (split - values)
+    low = values - high
+    error = (high * scale - scaled) + low * scale
+
+    rounded = np.rint(scaled)
+    tie = np.abs(scaled - np.floor(scaled)) == 0.5
+    rounded = np.where(tie & (error > 0), np.floor(scaled) + 1, rounded)
+    rounded = np.where(tie & (error < 0), np.floor(scaled), rounded)
+    return rounded / scale
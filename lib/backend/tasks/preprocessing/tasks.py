@@ -2,24 +2,30 @@
 
     All functionality is encapsulated in the corresponding backend module. """
 from collections import deque
+from itertools import groupby
 import logging
-from operator import add
+from operator import add, itemgetter
 
 from math import ceil
 import numpy as np
 import celery
-from sqlalchemy import func, and_, or_
+from sqlalchemy import func, and_, or_, select, union
 
 from lib.config import Configuration
 from lib.config import MAX_INTERPOLATION_INTERVAL
 from lib.config import INTERPOLATION_LIMIT
 from lib.config import PrivacyParams
+from lib.config import QUERY_DATA_YIELD_PER
+from lib.data_structures import PreprocessingEngine
 from lib.data_structures import UploadGranularity
 from lib.data_structures import AvailableDataSource
 from lib.data_structures import RegisteredDataSource
 from lib.data_structures import PrivacySetting
+from lib.data_structures import EligibilityIndex
+from lib.data_structures import PartialAggregate
 from lib.backend.helper_methods import HelperMethods
 from lib.backend import database as db
+from lib.backend.tasks.preprocessing import columnar
 
 
 """ Preprocessing Section:
@@ -28,6 +34,8 @@ from lib.backend import database as db
     - create_values_dict: Create empty dictionary in which the query results can be later inserted
     - select_users: return array with users relevant for the given query
     - select_query_data: return all relevant data for answering a query
+    - select_query_partials: return per bucket aggregates for answering an aggregate query
+    - stored_bucket_size: return the bucket size of the stored partial aggregates usable for a query
     - unify_times: unify time intervals of the data
     - unify_length: unify amount of data points """
 
@@ -100,8 +108,11 @@ def preprocess_data(data_sources, attributes, constraints, start_time, end_time,
 
     users = select_users(data_sources, attributes, constraints, max_granularity, max_privacy_level, start_time, end_time)
     query_data = select_query_data(users, start_time, end_time)
-    time_unified_data = unify_times(query_data, start_time, end_time)
-    length_unified_data = unify_length(time_unified_data, start_time, end_time, max_granularity, pre_aggregate, fill_with_nones)
+    if Configuration.preprocessing_engine == PreprocessingEngine.NUMPY:
+        length_unified_data = columnar.unify(query_data, start_time, end_time, max_granularity)
+    else:
+        time_unified_data = unify_times(query_data, start_time, end_time)
+        length_unified_data = unify_length(time_unified_data, start_time, end_time, max_granularity, pre_aggregate, fill_with_nones)
     split_data = split_by_privacy(length_unified_data)
     return split_data
 
@@ -158,91 +169,75 @@ def select_users(data_sources, attributes, constraints, max_granularity, max_pri
     session = db.get_db_session()
     try:
         # Get internal row IDs of data sources that appear in the query
-        unified_data_sources = list(set(data_sources))
-        data_source_tablenames = [HelperMethods.classname_to_tablename(ds) for ds in unified_data_sources]
+        data_source_tablenames = {ds: HelperMethods.classname_to_tablename(ds) for ds in set(data_sources)}
         available_sources = session.query(
             AvailableDataSource.data_source_id,
             AvailableDataSource.data_source_name
         ).filter(
-            AvailableDataSource.data_source_name.in_(data_source_tablenames)
-        ).order_by(
-            AvailableDataSource.data_source_id
-        ).all()
-
-        source_mapping = dict()
-        for i, name in enumerate(unified_data_sources):
-            source_mapping[name] = available_sources[i][0]
-
-        relevant_data_sources = list(
-            filter(
-                lambda avs: avs[1] in data_source_tablenames,
-                available_sources
-            )
-        )
-        relevant_data_source_ids = list(
-            map(
-                lambda avs: avs[0],
-                relevant_data_sources
-            )
-        )
-
-        # Determine users who registered all relevant data sources and
-        # who have compatible privacy settings
-        user_ids_with_data_sources = session.query(
-            RegisteredDataSource,
-            PrivacySetting
-        ).filter(
-            and_(
-                RegisteredDataSource.user_id == PrivacySetting.user_id,
-                RegisteredDataSource.data_source_id == PrivacySetting.data_source_id,
-                RegisteredDataSource.data_source_id.in_(relevant_data_source_ids),
-                RegisteredDataSource.timestamp <= start_time,
-                PrivacySetting.attribute.in_(attributes),
-                PrivacySetting.level.between(1, max_privacy_level)
-            )
+            AvailableDataSource.data_source_name.in_(list(data_source_tablenames.values()))
         ).all()
-        potential_user_ids = [u[0].user_id for u in user_ids_with_data_sources]
-
-        # Get update history of granularities for potentially interesting users
-        # restricted to their relevant data sources.
-        relevant_upload_granularity_histories = session.query(
-            UploadGranularity
+        tablename_mapping = {name: data_source_id for data_source_id, name in available_sources}
+        source_mapping = {ds: tablename_mapping[name] for ds, name in data_source_tablenames.items()}
+        relevant_data_source_ids = list(set(source_mapping.values()))
+        required_settings = set((source_mapping[ds], attributes[i]) for i, ds in enumerate(data_sources))
+
+        # Determine users who registered all relevant data sources before the query interval
+        registered_users = session.query(
+            RegisteredDataSource.user_id
         ).filter(
-            and_(
-                UploadGranularity.user_id.in_(potential_user_ids),
-                UploadGranularity.data_source_id.in_(relevant_data_source_ids),
-                UploadGranularity.timestamp <= end_time
-            )
+            RegisteredDataSource.data_source_id.in_(relevant_data_source_ids),
+            RegisteredDataSource.timestamp <= start_time
         ).group_by(
+            RegisteredDataSource.user_id
+        ).having(
+            func.count(RegisteredDataSource.data_source_id) == len(relevant_data_source_ids)
+        )
+        candidates = np.unique(np.array([row[0] for row in registered_users], dtype=np.int64))
+
+        # and who have compatible privacy settings for all relevant attributes (intersection of the index entries)
+        eligibility_index = EligibilityIndex.lookup(session, relevant_data_source_ids, list(set(attributes)), max_privacy_level)
+        for setting in required_settings:
+            levels = eligibility_index.get(setting, {})
+            eligible = np.unique(np.concatenate([np.empty(0, dtype=np.int64)] + list(levels.values())))
+            candidates = np.intersect1d(candidates, eligible, assume_unique=True)
+        privacy_levels = dict((int(user_id), dict()) for user_id in candidates)
+        for setting in required_settings:
+            for level, user_ids in eligibility_index.get(setting, {}).items():
+                for user_id in np.intersect1d(candidates, user_ids, assume_unique=True).tolist():
+                    privacy_levels[user_id][setting] = level
+        potential_user_ids = set(privacy_levels.keys())
+
+        # Get update history of granularities restricted to the relevant data sources. The granularities
+        # in effect during the query interval are the last update before the interval and all updates within.
+        granularity_history = session.query(
             UploadGranularity.user_id,
-            UploadGranularity.data_source_id
-        ).all()
-
+            UploadGranularity.data_source_id,
+            UploadGranularity.timestamp,
+            UploadGranularity.interval
+        ).filter(
+            UploadGranularity.data_source_id.in_(relevant_data_source_ids),
+            UploadGranularity.timestamp <= end_time
+        ).order_by(
+            UploadGranularity.timestamp.asc()
+        )
         granularity_updates_per_user = dict()
-        for g in relevant_upload_granularity_histories:
-            if g.user_id not in granularity_updates_per_user.keys():
-                granularity_updates_per_user[g.user_id] = dict()
-            if g.data_source_id not in granularity_updates_per_user[g.user_id].keys():
-                granularity_updates_per_user[g.user_id][g.data_source_id] = list()
-            granularity_updates_per_user[g.user_id][g.data_source_id].append((g.timestamp, g.interval))
+        for user_id, data_source_id, timestamp, interval in granularity_history:
+            if user_id not in potential_user_ids:
+                continue
+            granularities = granularity_updates_per_user.setdefault(user_id, dict()).setdefault(data_source_id, list())
+            if timestamp <= start_time:
+                del granularities[:]
+            granularities.append(interval)
 
         # Filter out users with granularities during the query interval that are too coarse
         potential_users_granularities = dict()
         for u, srcs in granularity_updates_per_user.items():
-            # Only keep user if he has no granularity updates violating the data processor's requirements
-            exclude_user = False
-            user_granularities = dict()
-            for data_source_id, gs in srcs.items():
-                granularities = [g[1] for g in gs]
-                if max(granularities) <= max_granularity:
-                    user_granularities[data_source_id] = (min(granularities), max(granularities))
-                else:
-                    exclude_user = True
-            if not exclude_user:
-                potential_users_granularities[u] = user_granularities
-        potential_user_ids = [u for u in potential_users_granularities.keys()]
+            if len(srcs) == len(relevant_data_source_ids) and all(max(gs) <= max_granularity for gs in srcs.values()):
+                potential_users_granularities[u] = {data_source_id: (min(gs), max(gs)) for data_source_id, gs in srcs.items()}
 
-        # additional constraints (attributes with lower and/or upper bounds)
+        # additional constraints (attributes with lower and/or upper bounds):
+        # users having any value violating a constraint are excluded
+        exclusion_checks = list()
         for constraint in constraints:
             data_source_class = HelperMethods.classname_to_source(constraint[0])
             attr = HelperMethods.str_to_attr(constraint[1], data_source_class)
@@ -252,49 +247,28 @@ def select_users(data_sources, attributes, constraints, max_granularity, max_pri
                 lower = bounds[0]
                 upper = bounds[1]
                 if lower != '' and upper != '':  # Check for values outside the boundaries
-                    exclusion_check = session.query(
-                        data_source_class.user_id,
-                        func.count(attr)
-                    ).filter(
-                        data_source_class.user_id.in_(potential_user_ids),
-                        or_(
-                            attr < lower,
-                            attr > upper
-                        )
-                    )
+                    violation = or_(attr < lower, attr > upper)
                 elif lower != '':  # We have only a lower bound (exclude all smaller values)
-                    exclusion_check = session.query(
-                        data_source_class.user_id,
-                        func.count(attr)
-                    ).filter(
-                        data_source_class.user_id.in_(potential_user_ids),
-                        attr < lower
-                    )
-                else:  # We have only an upper bound (exclude all larger values)
-                    exclusion_check = session.query(
-                        data_source_class.user_id,
-                        func.count(attr)
-                    ).filter(
-                        data_source_class.user_id.in_(potential_user_ids),
-                        attr > upper
-                    )
+                    violation = attr < lower
+                elif upper != '':  # We have only an upper bound (exclude all larger values)
+                    violation = attr > upper
+                else:
+                    continue
             # check quality
             elif len(bounds) == 1 and bounds[0] != '':
                 comparator = bounds[0]
-                exclusion_check = session.query(
-                    data_source_class.user_id,
-                    # func.count(attr)
-                    attr
-                ).filter(
-                    data_source_class.user_id.in_(potential_user_ids),
-                    attr != comparator
-                )
+                violation = attr != comparator
             elif len(bounds) > 2:
                 raise AssertionError("Constraint value interval contains too many values: {}".format(len(bounds)))
-        excluded_user_ids = exclusion_check.all()
+            else:
+                continue
+            exclusion_checks.append(select([data_source_class.user_id]).where(violation))
+        excluded_user_ids = set()
+        if len(exclusion_checks) > 0:
+            excluded_user_ids = set(row[0] for row in session.execute(union(*exclusion_checks)))
 
         # Finally build set of user IDs that will remain after preselection
-        user_ids = list(set(potential_user_ids) - set(excluded_user_ids))
+        user_ids = set(potential_users_granularities.keys()) - excluded_user_ids
 
         # Bundle required information for selected users
         """
@@ -307,11 +281,10 @@ def select_users(data_sources, attributes, constraints, max_granularity, max_pri
             for i, data_source in enumerate(data_sources):
                 data_source_id = source_mapping[data_source]
                 attr = attributes[i]
-                privacy_setting = [u[1].level for u in user_ids_with_data_sources if u[1].user_id == user_id and u[1].attribute == attr][0]
                 user_result.append([
                     data_source,
                     attr,
-                    privacy_setting,
+                    privacy_levels[user_id][(data_source_id, attr)],
                     potential_users_granularities[user_id][data_source_id][0],
                     potential_users_granularities[user_id][data_source_id][1],
                 ])
@@ -327,6 +300,19 @@ def select_users(data_sources, attributes, constraints, max_granularity, max_pri
         session.close()
 
 
+def group_settings_by_source(users):
+    """ Return the attributes of the settings of select_users() grouped by data source.
+
+        All users share the same data sources and attributes, so the settings
+        of the first user are used. """
+    source_attributes = {}
+    if len(users) == 0:
+        return source_attributes
+    for setting in users[list(users.keys())[0]]:
+        source_attributes.setdefault(setting[0], []).append(setting[1])
+    return source_attributes
+
+
 @celery.shared_task
 def select_query_data(users, start_time, end_time, passed_session=None):
     """ Return a dict with the user_id and relevant data needed for calculating the query result.
@@ -364,34 +350,33 @@ def select_query_data(users, start_time, end_time, passed_session=None):
     else:
         session = passed_session
     try:
-        # for every data source
-        attributes = users[list(users.keys())[0]]
-        for attribute in attributes:
-            cur_source = HelperMethods.classname_to_source(attribute[0])
-            # get entries for user_ids contained in user list and the given time interval
-            query_data = session.query(cur_source).\
+        values_dict = {}
+        for source_name, attributes in group_settings_by_source(users).items():
+            cur_source = HelperMethods.classname_to_source(source_name)
+            # get entries for user_ids contained in user list and the given time interval,
+            # only fetching the needed columns in chunks, ordered such that the rows of a user are contiguous
+            columns = [cur_source.user_id, cur_source.timestamp] + [HelperMethods.str_to_attr(a, cur_source) for a in attributes]
+            query_data = session.query(*columns).\
                 filter(cur_source.timestamp.between(start_time, end_time - 1), cur_source.user_id.in_(users)).\
-                order_by(cur_source.user_id.asc(), cur_source.timestamp.asc())
-            # sort data for every user and every attribute into values dict
-            values_dict = {}
-            # collect attributes of first user's first data source
+                order_by(cur_source.user_id.asc(), cur_source.timestamp.asc()).\
+                yield_per(QUERY_DATA_YIELD_PER)
             for user in users:
-                settings = users[user]
-                attributes_dict = {}
-                for setting in settings:
-                    if setting[0] == attribute[0]:
-                        a = setting[1]
+                attributes_dict = values_dict.setdefault(user, {})
+                for setting in users[user]:
+                    if setting[0] == source_name:
                         vals = create_values_dict()
-                        vals['v'] = [round(HelperMethods.str_to_attr(a, row), 2) for row in (r for r in query_data if r.user_id == user)]
-                        vals['t'] = [row.timestamp for row in (r for r in query_data if r.user_id == user)]
                         vals['a'] = setting[2]
                         vals['fg'] = setting[3]
                         vals['cg'] = setting[4]
-                        attributes_dict[a] = vals
-                    else:
-                        break
-                if len(attributes_dict) > 0:
-                    values_dict[user] = attributes_dict
+                        attributes_dict[setting[1]] = vals
+            # sort data for every user and every attribute into values dict in a single pass
+            for user, rows in groupby(query_data, key=itemgetter(0)):
+                rows = list(rows)
+                timestamps = [row[1] for row in rows]
+                for i, a in enumerate(attributes):
+                    vals = values_dict[user][a]
+                    vals['v'] = [round(row[2 + i], 2) for row in rows]
+                    vals['t'] = list(timestamps)
         if passed_session is None:
             session.close()
         return values_dict
@@ -405,6 +390,120 @@ def select_query_data(users, start_time, end_time, passed_session=None):
             session.close()
 
 
+def stored_bucket_size(source, attributes, start_time, granularity):
+    """ Return the largest configured bucket size of the partial aggregates which can be combined into the buckets
+        of a query on the given attributes of a data source, None if there is none. """
+    if not set(attributes).issubset(PartialAggregate.attributes(source)):
+        return None
+    sizes = [s for s in Configuration.partial_aggregate_granularities if granularity % s == 0 and start_time % s == 0]
+    return max(sizes) if sizes else None
+
+
+@celery.shared_task
+def select_query_partials(users, start_time, end_time, granularity, passed_session=None):
+    """ Return a dict with the user_id and the per bucket aggregates needed for calculating an aggregate query result.
+
+        Instead of fetching every single data point like select_query_data(), the
+        database aggregates the data points into buckets of the query granularity:
+        one GROUP BY user_id, floor((timestamp - start_time) / granularity) statement
+        per data source returns the SUM and COUNT of every attribute per bucket.
+
+        If partial aggregates of a bucket size dividing both the granularity and
+        the start time are stored (see PartialAggregate), the buckets are combined
+        from them and only the data points after the last complete stored bucket
+        are aggregated from the data source.
+
+    Args:
+        - users (dict): output of select_users()
+        - start_time (int): user should have data with timestamps above this value (in milliseconds)
+        - end_time (int): user should have data with timestamps below this value (in milliseconds)
+        - granularity (int): size of the buckets in milliseconds
+        - passed_session (db_session): already existing session passed for consistency
+
+    Returns:
+        - dict of int : dict: same form as select_query_data() where
+            - v = list of bucket averages (rounded like pre_aggregate())
+            - t = list of timestamps of the beginning of the buckets in v
+            - n = list of amounts of data points per bucket in v
+    """
+
+    if passed_session is None:
+        session = db.get_db_session()
+    else:
+        session = passed_session
+    try:
+        values_dict = {}
+        for source_name, attributes in group_settings_by_source(users).items():
+            cur_source = HelperMethods.classname_to_source(source_name)
+            # {user: {attribute: {bucket: [sum, count]}}}
+            partials = {}
+            raw_start = start_time
+            stored_size = stored_bucket_size(cur_source, attributes, start_time, granularity)
+            if stored_size is not None:
+                raw_start = max(start_time, end_time - end_time % stored_size)
+                stored_bucket = (PartialAggregate.bucket_start - start_time) / granularity
+                stored_data = session.query(
+                    PartialAggregate.user_id,
+                    PartialAggregate.attribute,
+                    stored_bucket,
+                    func.sum(PartialAggregate.total),
+                    func.sum(PartialAggregate.count)
+                ).filter(
+                    PartialAggregate.source == cur_source.__tablename__,
+                    PartialAggregate.bucket_size == stored_size,
+                    PartialAggregate.user_id.in_(users),
+                    PartialAggregate.attribute.in_(attributes),
+                    PartialAggregate.bucket_start >= start_time,
+                    PartialAggregate.bucket_start < raw_start
+                ).group_by(PartialAggregate.user_id, PartialAggregate.attribute, stored_bucket)
+                for user, a, b, total, count in stored_data:
+                    partials.setdefault(user, {}).setdefault(a, {})[b] = [total, count]
+
+            bucket = (cur_source.timestamp - start_time) / granularity
+            columns = [cur_source.user_id, bucket]
+            for a in attributes:
+                columns.append(func.sum(HelperMethods.str_to_attr(a, cur_source)))
+                columns.append(func.count(HelperMethods.str_to_attr(a, cur_source)))
+            query_data = session.query(*columns).\
+                filter(cur_source.timestamp.between(raw_start, end_time - 1), cur_source.user_id.in_(users)).\
+                group_by(cur_source.user_id, bucket)
+            for row in query_data:
+                for i, a in enumerate(attributes):
+                    partial = partials.setdefault(row[0], {}).setdefault(a, {}).setdefault(row[1], [0., 0])
+                    partial[0] += row[2 + 2 * i] or 0.
+                    partial[1] += row[3 + 2 * i]
+
+            for user in users:
+                attributes_dict = values_dict.setdefault(user, {})
+                for setting in users[user]:
+                    if setting[0] == source_name:
+                        vals = create_values_dict()
+                        vals['n'] = []
+                        vals['a'] = setting[2]
+                        vals['fg'] = setting[3]
+                        vals['cg'] = setting[4]
+                        attributes_dict[setting[1]] = vals
+            for user, attribute_partials in partials.items():
+                for a, buckets in attribute_partials.items():
+                    vals = values_dict[user][a]
+                    for b in sorted(buckets):
+                        total, count = buckets[b]
+                        if count == 0:
+                            continue
+                        vals['v'].append(round(total / float(count), 2))
+                        vals['t'].append(start_time + b * granularity)
+                        vals['n'].append(count)
+        return values_dict
+    except Exception:
+        if Configuration.test_mode:
+            logging.exception("An error occured:")
+        session.rollback()
+        raise
+    finally:
+        if passed_session is None:
+            session.close()
+
+
 @celery.shared_task
 def unify_times(values, start_time, end_time):
 
@@ -460,8 +559,8 @@ def unify_times(values, start_time, end_time):
     if len(list(values.values())) != 0:
         for attr in list(values.values())[0]:
             interval = end_time - start_time
-            # for each user
-            for user in values.keys():
+            # for each user (rows may get discarded while iterating)
+            for user in list(values.keys()):
                 v = values[user][attr]['v']
                 t = values[user][attr]['t']
                 if len(v) != len(t):
@@ -715,12 +814,12 @@ def gaussian(mean, var):
     return noise[0]
 
 
-def apply_DiffPrivRAW(_, inp):
+def apply_DiffPrivRAW(_, __, inp, sensitivities=None):
     """ Dummy wrapper for differential privacy for showcasing purposes. """
     return inp
 
 
-def apply_DiffPrivCOUNT(_, attributes, inp):
+def apply_DiffPrivCOUNT(_, attributes, inp, sensitivities=None):
     """ Apply differential privacy to a COUNT query. """
     sensitivity = 1
     for a in attributes:
@@ -730,15 +829,15 @@ def apply_DiffPrivCOUNT(_, attributes, inp):
             inp[a][p] = round(inp[a][p] + np.random.laplace(0, sensitivity / eps))
             while inp[a][p] < 0:
                 inp[a][p] = round(negativeBackup + np.random.laplace(0, sensitivity / eps))
-    return input
+    return inp
 
 
-def apply_DiffPrivAVG(values, attributes, inp):
-    """ Apply differential privacy to an AVG query. """
+def apply_DiffPrivAVG(values, attributes, inp, sensitivities=None):
+    """ Apply differential privacy to an AVG query, sensitivities are computed from values if not given. """
     means = inp[0]
     stDevs = inp[1]
     amounts = inp[2]
-    sensitivites = get_sensitivities(values, attributes)
+    sensitivites = sensitivities if sensitivities is not None else get_sensitivities(values, attributes)
 
     for a in attributes:
         meanSens = sensitivites[a][0]
@@ -772,12 +871,10 @@ def get_sensitivities(values, attributes):
         It is necessary to determine a range for the attribute. This is done by taking the maximum and minimum value
         of all entries that are in the result set. This introduces an error based on the datapoints taken as they do not
         necessarily cover the whole range, but to proof the possibility of diff Priv this should be sufficient """
-    res = {}
     v_max = {}
     v_min = {}
     count = 0
     for a in attributes:
-        res[a] = []
         v_max[a] = None
         v_min[a] = None
     for attr in attributes:
@@ -793,11 +890,23 @@ def get_sensitivities(values, attributes):
                         v_min[attr] = v
                     elif v_min[attr] >= v:
                         v_min[attr] = v
+    return sensitivities_from_ranges(v_min, v_max, count, attributes)
+
+
+def sensitivities_from_ranges(v_min, v_max, count, attributes):
+    """ Return the sensitivities for mean and StDeriv of each attribute (see get_sensitivities).
+
+    Args:
+        - v_min (dict): smallest value per attribute
+        - v_max (dict): largest value per attribute
+        - count (int): number of user rows of all attributes and privacy levels
+        - attributes: list of the attributes to be anonymized
+    """
+    res = {}
     for a in attributes:
         MeanSens = (v_max[a] - v_min[a]) / (count + 1)
         StDevSens = (count**(0.5) * MeanSens)
-        res[a].append(MeanSens)
-        res[a].append(StDevSens)
+        res[a] = [MeanSens, StDevSens]
     return res
 
 
@@ -924,7 +1033,7 @@ def interpolate_row(row, gran):
     if in_none_interval:
         x_upper = len(values) - 1
         v_upper = None
-        interpolation_intervals.append(x_lower, x_upper, v_lower, v_upper)
+        interpolation_intervals.append((x_lower, x_upper, v_lower, v_upper))
 
     for x_lower, x_upper, v_lower, v_upper in interpolation_intervals:
         relevant_indices = range(x_lower, x_upper + 1)
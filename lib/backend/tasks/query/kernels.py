@@ -0,0 +1,248 @@
+""" Aggregation kernels used by the query functions.
+
+    The rows of all users of one attribute and privacy level are stacked into
+    a (users x values) float64 matrix, padded with NaN if the rows differ in
+    length. Means, sums of squared deviations ("stDevs") and counts are then
+    computed per column with array operations. Panels exceeding
+    KERNEL_STREAMING_THRESHOLD values are processed in chunks of users whose
+    moments are merged, which bounds the memory needed for very long rows.
+
+    Large queries are split into shards of users (see process_query_shard),
+    each shard is reduced to a shard_summary() and the summaries are merged
+    with the same moment merging. """
+import numpy as np
+
+from lib.config import KERNEL_STREAMING_THRESHOLD
+from lib.config import KERNEL_CHUNK_SIZE
+
+
+def stack_rows(rows, length=None):
+    """ Stack rows of values into a matrix, missing values (None or too short rows) become NaN.
+
+    Args:
+        - rows (list of lists): value rows
+        - length (int): number of columns, defaults to the length of the longest row
+
+    Returns:
+        - numpy.ndarray: (len(rows) x length) float64 matrix """
+    if length is None:
+        length = max((len(row) for row in rows), default=0)
+    matrix = np.full((len(rows), length), np.nan)
+    for i, row in enumerate(rows):
+        matrix[i, :len(row)] = np.array(row[:length], dtype=np.float64)
+    return matrix
+
+
+def moments(matrix):
+    """ Count, mean and sum of squared deviations of each column, ignoring NaNs.
+
+    Returns:
+        - tuple of numpy.ndarray: (counts, means, squared deviations) """
+    present = ~np.isnan(matrix)
+    counts = present.sum(axis=0)
+    sums = np.where(present, matrix, 0.).sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = np.where(counts > 0, sums / counts, 0.)
+    deviations = np.where(present, matrix - means, 0.)
+    return counts, means, (deviations ** 2).sum(axis=0)
+
+
+def merge_moments(first, second):
+    """ Merge the moments of two disjoint sets of rows (Chan et al.).
+
+    Args:
+        - first (tuple): (counts, means, squared deviations) as returned by moments()
+        - second (tuple): (counts, means, squared deviations) of the same columns
+
+    Returns:
+        - tuple of numpy.ndarray: moments of the union of both sets """
+    count_a, mean_a, m2_a = first
+    count_b, mean_b, m2_b = second
+    counts = count_a + count_b
+    delta = mean_b - mean_a
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = np.where(counts > 0, mean_a + delta * count_b / counts, 0.)
+        m2 = np.where(counts > 0, m2_a + m2_b + delta ** 2 * count_a * count_b / counts, 0.)
+    return counts, means, m2
+
+
+def streaming_moments(rows, chunk_size=KERNEL_CHUNK_SIZE):
+    """ Same as moments(stack_rows(rows)), but only stacks chunk_size rows at once. """
+    length = max((len(row) for row in rows), default=0)
+    result = (np.zeros(length, dtype=np.int64), np.zeros(length), np.zeros(length))
+    for first in range(0, len(rows), chunk_size):
+        result = merge_moments(result, moments(stack_rows(rows[first:first + chunk_size], length)))
+    return result
+
+
+def row_moments(rows):
+    """ Moments of a list of rows, choosing the streaming variant for large panels. """
+    length = max((len(row) for row in rows), default=0)
+    if len(rows) * length > KERNEL_STREAMING_THRESHOLD:
+        return streaming_moments(rows)
+    return moments(stack_rows(rows, length))
+
+
+def level_moments(values, attributes):
+    """ Means, sums of squared deviations and counts per attribute and privacy level.
+
+    Args:
+        - values (dict): user data split by privacy levels (see split_by_privacy)
+        - attributes (list of str): attributes to aggregate
+
+    Returns:
+        - list of dicts: [means, stDevs, amounts], each of the form {attribute: {privacy level: list}} """
+    means = {}
+    stDevs = {}
+    amounts = {}
+    for a in attributes:
+        means[a] = {}
+        stDevs[a] = {}
+        amounts[a] = {}
+        for p in range(1, 4):
+            rows = [row['v'] for row in values[a][p].values()] if a in values else []
+            if len(rows) == 0:
+                means[a][p], stDevs[a][p], amounts[a][p] = [], [], []
+                continue
+            counts, mean, m2 = row_moments(rows)
+            means[a][p] = mean.tolist()
+            stDevs[a][p] = m2.tolist()
+            amounts[a][p] = counts.tolist()
+    return [means, stDevs, amounts]
+
+
+def squared_deviations(values, attributes, means):
+    """ Sums of squared deviations from the given means per attribute and privacy level. """
+    stDevs = {}
+    for a in attributes:
+        stDevs[a] = {}
+        for p in range(1, 4):
+            rows = [row['v'] for row in values[a][p].values()]
+            if len(rows) == 0:
+                stDevs[a][p] = [0] * len(means[a][p])
+                continue
+            matrix = stack_rows(rows, len(means[a][p]))
+            deviations = np.where(np.isnan(matrix), 0., matrix - np.array(means[a][p], dtype=np.float64))
+            stDevs[a][p] = (deviations ** 2).sum(axis=0).tolist()
+    return stDevs
+
+
+def combine_levels(means, stDevs, amounts, attributes):
+    """ Combine the per privacy level results of level_moments() into one mean and stDev row per attribute.
+
+        Levels are weighted by their amounts. Like before, the result is as
+        long as the shortest non-empty level.
+
+    Returns:
+        - dict: {attribute: {'mean': list, 'stDev': list}} """
+    res = {}
+    for a in attributes:
+        levels = [p for p in range(1, 4) if len(means[a][p]) > 0]
+        res[a] = {}
+        if len(levels) == 0:
+            res[a]['mean'] = []
+            res[a]['stDev'] = []
+            continue
+        length = min(len(means[a][p]) for p in levels)
+        level_means = np.array([means[a][p][:length] for p in levels], dtype=np.float64)
+        level_stDevs = np.array([stDevs[a][p][:length] for p in levels], dtype=np.float64)
+        level_amounts = np.array([amounts[a][p][:length] for p in levels], dtype=np.float64)
+        count = level_amounts.sum(axis=0)
+        res[a]['mean'] = ((level_means * level_amounts).sum(axis=0) / count).tolist()
+        res[a]['stDev'] = ((level_stDevs * level_amounts).sum(axis=0) / count).tolist()
+    return res
+
+
+def level_counts(values, attributes):
+    """ Number of participants per attribute and privacy level. """
+    return {a: {p: len(values[a][p]) for p in range(1, 4)} for a in attributes}
+
+
+def shard_summary(values, attributes):
+    """ Partial aggregates of the rows of one shard of users, which can be merged with merge_shard_summaries().
+
+    Args:
+        - values (dict): user data of the shard split by privacy levels (see split_by_privacy)
+        - attributes (list of str): attributes to aggregate
+
+    Returns:
+        - dict: {attribute: {'moments': [[counts, means, squared deviations] per privacy level],
+                             'participants': [number of users per privacy level],
+                             'min': smallest value, 'max': largest value}}
+          built from lists only, such that it can be passed between tasks """
+    summary = {}
+    for a in attributes:
+        part = {'moments': [], 'participants': [], 'min': None, 'max': None}
+        for p in range(1, 4):
+            rows = [row['v'] for row in values[a][p].values()] if a in values else []
+            part['participants'].append(len(rows))
+            if len(rows) == 0:
+                part['moments'].append([[], [], []])
+                continue
+            part['moments'].append([m.tolist() for m in row_moments(rows)])
+            nonempty = [row for row in rows if len(row) > 0]
+            if nonempty:
+                part['min'] = _extreme(min, part['min'], min(min(row) for row in nonempty))
+                part['max'] = _extreme(max, part['max'], max(max(row) for row in nonempty))
+        summary[a] = part
+    return summary
+
+
+def merge_shard_summaries(summaries):
+    """ Merge the shard_summary() results of disjoint shards of users into the summary of all users. """
+    merged = {}
+    for summary in summaries:
+        for a, part in summary.items():
+            if a not in merged:
+                merged[a] = part
+                continue
+            total = merged[a]
+            total['moments'] = [_merge_moment_lists(first, second) for first, second in zip(total['moments'], part['moments'])]
+            total['participants'] = [first + second for first, second in zip(total['participants'], part['participants'])]
+            total['min'] = _extreme(min, total['min'], part['min'])
+            total['max'] = _extreme(max, total['max'], part['max'])
+    return merged
+
+
+def summary_level_moments(summary, attributes):
+    """ Same as level_moments() for the users of a merged summary. """
+    means = {}
+    stDevs = {}
+    amounts = {}
+    for a in attributes:
+        means[a] = {}
+        stDevs[a] = {}
+        amounts[a] = {}
+        for p in range(1, 4):
+            counts, mean, m2 = summary[a]['moments'][p - 1] if a in summary else ([], [], [])
+            means[a][p] = list(mean)
+            stDevs[a][p] = list(m2)
+            amounts[a][p] = list(counts)
+    return [means, stDevs, amounts]
+
+
+def summary_level_counts(summary, attributes):
+    """ Same as level_counts() for the users of a merged summary. """
+    return {a: {p: summary[a]['participants'][p - 1] if a in summary else 0 for p in range(1, 4)} for a in attributes}
+
+
+def _merge_moment_lists(first, second):
+    length = max(len(first[0]), len(second[0]))
+    merged = merge_moments(_padded_moments(first, length), _padded_moments(second, length))
+    return [m.tolist() for m in merged]
+
+
+def _padded_moments(moment_lists, length):
+    counts, means, m2 = moment_lists
+    padding = length - len(counts)
+    return (np.concatenate([np.array(counts, dtype=np.int64), np.zeros(padding, dtype=np.int64)]),
+            np.concatenate([np.array(means, dtype=np.float64), np.zeros(padding)]),
+            np.concatenate([np.array(m2, dtype=np.float64), np.zeros(padding)]))
+
+
+def _extreme(choose, first, second):
+    if first is None:
+        return second
+    if second is None:
+        return first
+    return choose(first, second)
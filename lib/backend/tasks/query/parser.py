@@ -1,12 +1,21 @@
-""" This module implements a parser for our query language. """
+""" This module implements a parser for our query language.
 
+    Queries are parsed with an LALR parser if the grammar can be compiled for
+    it, and with the Earley parser otherwise or if the LALR parser rejects a
+    query (see parse_query()). Both parsers use the same grammar and the
+    LALR parser is only used if it agrees with the Earley parser on
+    GRAMMAR_EXAMPLES (see check_parsers()). """
+
+import logging
+import re
 import sys
 
 from lark import Lark
 from lark import Transformer
+from lark.exceptions import LarkError
 from lark.lexer import Token
 
-sql_parser = Lark(r"""
+GRAMMAR = r"""
 
     start : selectstatement wherestatement
           | selectstatement
@@ -90,7 +99,37 @@ sql_parser = Lark(r"""
     %import common.SIGNED_NUMBER
     %import common.WS
     %ignore WS
-    """)
+    """
+
+sql_parser = Lark(GRAMMAR)
+
+# queries using every rule of the grammar reachable from start, see check_parsers()
+GRAMMAR_EXAMPLES = [
+    'SELECT SUM(RandomData.random_one, RandomData.random_two)',
+    'SELECT AVG(RandomData.random_two), COUNT(RandomData.random_one), COUNT',
+    'SELECT CORR(RandomData.random_one, RandomData.random_two), RAVG(RandomData.random_two)',
+    'SELECT ALL(RandomData.random_one, RandomData.random_two) WHERE PersonalInformation.city = aachen',
+    'SELECT SUM(RandomData.random_two) WHERE PersonalInformation.city = "aachen"',
+    'SELECT SUM(RandomData.random_two) WHERE (RandomData.random_one > 5) AND (RandomData.random_two < -2.5)',
+    'SELECT SUM(RandomData.random_two) WHERE (RandomData.random_one = 1e3) OR ((RandomData.random_two < .5) AND (RandomData.random_one > 1))',
+    'SELECT SUM(RandomData.random_two) WHERE !RandomData.random_one = 4',
+]
+
+# number parameters, which the lexers may also match as names
+NUMBER_PATTERN = re.compile(r'[+-]?(\d+(\.\d*)?|\.\d+)([eE][+-]?\d+)?$')
+
+
+def parameter(value):
+    """ Return the parsed parameter for the text of a name, number or quoted string.
+
+        Which of these terminals matches a parameter depends on the lexer
+        (e.g. 5 is a name for the LALR parser and either for the Earley
+        parser), the parameter is therefore determined by the text only. """
+    if len(value) >= 2 and value[0] == value[-1] == '"':
+        return {'textparam': value[1:-1]}
+    if NUMBER_PATTERN.match(value):
+        return {'numparam': value}
+    return {'attr': value}
 
 
 class SqlTransformer(Transformer):
@@ -227,10 +266,8 @@ class SqlTransformer(Transformer):
 
     @staticmethod
     def attributename(a):
-        """ Return attribute name. """
-        res = {}
-        res['attr'] = a[0].value
-        return res
+        """ Return attribute name, or the parameter the name stands for (see parameter()). """
+        return parameter(a[0].value)
 
     @staticmethod
     def comp(items):
@@ -240,16 +277,12 @@ class SqlTransformer(Transformer):
     @staticmethod
     def text_parameter(items):
         """ Return text parameter. """
-        res = {}
-        res['textparam'] = items[0].children[0].value[1:-1]
-        return res
+        return parameter(items[0].children[0].value)
 
     @staticmethod
     def number_parameter(items):
         """ Return number parameter. """
-        res = {}
-        res['numparam'] = items[0].value
-        return res
+        return parameter(items[0].value)
 
     @staticmethod
     def tablename(a):
@@ -259,6 +292,43 @@ class SqlTransformer(Transformer):
         return res
 
 
+def check_parsers(first, second, examples=GRAMMAR_EXAMPLES):
+    """ Return the examples which two parsers reject or parse into different parsed queries. """
+    failed = []
+    for example in examples:
+        try:
+            if SqlTransformer().transform(first.parse(example)) != SqlTransformer().transform(second.parse(example)):
+                failed.append(example)
+        except LarkError:
+            failed.append(example)
+    return failed
+
+
+try:
+    lalr_sql_parser = Lark(GRAMMAR, parser='lalr')
+except LarkError:
+    logging.exception("Could not build the LALR query parser, queries are parsed with the Earley parser")
+    lalr_sql_parser = None
+
+if lalr_sql_parser is not None and check_parsers(lalr_sql_parser, sql_parser):
+    logging.error("The LALR query parser disagrees with the Earley parser on %s, queries are parsed with the Earley parser",
+                  check_parsers(lalr_sql_parser, sql_parser))
+    lalr_sql_parser = None
+
+
+def parse_query(query):
+    """ Parse a query and transform it into a parsed query (see SqlTransformer).
+
+    Raises:
+        - lark.exceptions.LarkError: if the query is invalid """
+    if lalr_sql_parser is not None:
+        try:
+            return SqlTransformer().transform(lalr_sql_parser.parse(query))
+        except LarkError:
+            pass
+    return SqlTransformer().transform(sql_parser.parse(query))
+
+
 def constructConstraintList(inp, result):
     """ Derive list of query constraints affecting user selection. """
 
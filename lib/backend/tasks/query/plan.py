@@ -0,0 +1,144 @@
+""" Query plans.
+
+    The plan of a query holds the parsed query and everything derived from it.
+    Plans are computed once per query text and kept in a bounded LRU cache
+    keyed by the SHA-256 hash of the text, such that checking, preparing and
+    processing a query (and every recalculation) parse it only once per
+    process. Plans are shared between their users and must not be modified.
+
+    When a query is registered, its plan is stored as JSON together with the
+    query (Query_Db.plan), such that later stages and other processes load it
+    instead of parsing the query again (see load_plan()). Stored plans carry
+    PLAN_VERSION, plans of another version and queries stored without a plan
+    fall back to parsing the query text. """
+from collections import OrderedDict
+import hashlib
+import json
+import threading
+
+from lib.config import QUERY_PLAN_CACHE_SIZE
+from lib.backend.helper_methods import HelperMethods
+from lib.data_structures import AvailableDataSource
+from .parser import parse_query, constructConstraintList, find_and_parts
+
+
+# version of the stored plans, to be increased whenever their content changes
+PLAN_VERSION = 2
+
+
+class QueryPlan():
+    """ Parsed query and the parts derived from it.
+
+    Attributes:
+        - parsed (dict): parsed query (see SqlTransformer)
+        - target_attributes (list of str): attributes of all functions, e.g. "RandomData.random_two"
+        - data_sources (list of str): data source of every target attribute
+        - attributes (list of str): name of every target attribute
+
+    The constraint lists, used data types and data source ids are derived on first use. """
+
+    def __init__(self, parsed):
+        self.parsed = parsed
+        self.target_attributes = [attr for fun in self.parsed['Select'] for attr in fun[0]['attr']]
+        self.data_sources = [attr.split(".")[0] for attr in self.target_attributes]
+        self.attributes = [attr.split(".")[1] for attr in self.target_attributes]
+        self._constraint_lists = None
+        self._used_data_types = None
+        self._data_source_ids = None
+
+    def constraint_lists(self):
+        """ Return constructConstraintList() of every OR part of the WHERE statement, None if there is no WHERE statement. """
+        if self._constraint_lists is None and 'Where' in self.parsed:
+            self._constraint_lists = [constructConstraintList(p, list([])) for p in find_and_parts(self.parsed['Where'], list([]))]
+        return self._constraint_lists
+
+    def used_data_types(self):
+        """ Return the labels of the target attributes followed by the labels of the constrained attributes.
+
+        Raises:
+            - Exception: if a data source or attribute does not exist """
+        if self._used_data_types is None:
+            used = [HelperMethods.str_to_attr("label", HelperMethods.classname_to_source(ds))[a].value
+                    for ds, a in zip(self.data_sources, self.attributes)]
+            for constraintlist in self.constraint_lists() or []:
+                for constraint in constraintlist:
+                    used.append(HelperMethods.str_to_attr("label", HelperMethods.classname_to_source(constraint[0]))[constraint[1]].value)
+            self._used_data_types = used
+        return self._used_data_types
+
+    def data_source_ids(self, session):
+        """ Return the data_source_id of the data source of every target attribute.
+
+        Raises:
+            - sqlalchemy.orm.exc.NoResultFound: if a data source is not registered """
+        if self._data_source_ids is None:
+            self._data_source_ids = [
+                session.query(AvailableDataSource).filter_by(
+                    data_source_name=HelperMethods.classname_to_tablename(ds)
+                ).one().data_source_id
+                for ds in self.data_sources
+            ]
+        return self._data_source_ids
+
+    def dumps(self, session):
+        """ Serialize the plan to JSON, see load_plan(). """
+        return json.dumps({
+            'version': PLAN_VERSION,
+            'parsed': self.parsed,
+            'targets': [[ds, a] for ds, a in zip(self.data_sources, self.attributes)],
+            'functions': [fun[0]['name'] for fun in self.parsed['Select']],
+            'constraints': self.constraint_lists(),
+            'used_data_types': self.used_data_types(),
+            'data_source_ids': self.data_source_ids(session)
+        }, separators=(',', ':'))
+
+    @staticmethod
+    def loads(data):
+        """ Deserialize a plan serialized by dumps(), None if it is of another version. """
+        stored = json.loads(data)
+        if stored.get('version') != PLAN_VERSION:
+            return None
+        plan = QueryPlan(stored['parsed'])
+        plan._constraint_lists = stored['constraints']
+        plan._used_data_types = stored['used_data_types']
+        plan._data_source_ids = stored['data_source_ids']
+        return plan
+
+
+_plans = OrderedDict()
+_plans_lock = threading.Lock()
+
+
+def get_plan(query):
+    """ Return the plan of a query text, parsing it only if it is not cached.
+
+    Raises:
+        - lark.exceptions.LarkError: if the query is invalid """
+    key = hashlib.sha256(query.encode('utf-8')).digest()
+    with _plans_lock:
+        plan = _plans.get(key)
+        if plan is not None:
+            _plans.move_to_end(key)
+            return plan
+    plan = QueryPlan(parse_query(query))
+    with _plans_lock:
+        _plans[key] = plan
+        while len(_plans) > QUERY_PLAN_CACHE_SIZE:
+            _plans.popitem(last=False)
+    return plan
+
+
+def load_plan(query, stored=None):
+    """ Return the plan of a query, loaded from its stored plan if that is of the current version.
+
+    Args:
+        - query (str): query text
+        - stored (str): plan stored with the query (Query_Db.plan), None if there is none
+
+    Raises:
+        - lark.exceptions.LarkError: if the plan has to be computed and the query is invalid """
+    if stored:
+        plan = QueryPlan.loads(stored)
+        if plan is not None:
+            return plan
+    return get_plan(query)
@@ -5,6 +5,7 @@
     module. """
 
 import ast
+from datetime import datetime, timezone
 import hashlib
 import json
 import time
@@ -13,26 +14,29 @@ import logging
 
 from sqlalchemy import exists
 from sqlalchemy import and_
+from sqlalchemy import or_
 import celery
-from celery.result import allow_join_result
 
 from lib.config import Configuration
 from lib.backend.tasks.preprocessing.tasks \
-    import select_query_data, select_users, \
-    split_by_privacy, add_noise, k_anonymity
+    import select_query_data, select_query_partials, select_users, \
+    split_by_privacy, add_noise, k_anonymity, sensitivities_from_ranges, \
+    apply_DiffPrivAVG, apply_DiffPrivCOUNT, apply_DiffPrivRAW
 from lib.backend import database as db
+from lib.backend.result_cache import get_result_cache
 from lib.data_structures import QueryState
 from lib.data_structures import PaymentMethod
 from lib.data_structures import Query_Db
 from lib.data_structures import Pin_Query_Db
 from lib.data_structures import QueryUser
+from lib.data_structures import QueryUserSetting
 from lib.data_structures import enums
-from lib.data_structures import AvailableDataSource
 from lib.data_structures.base_object import SqlAlchemyException
 from lib.backend.helper_methods import HelperMethods
 from lib.backend.payments import BitcoinConnector
 from lib.data_structures.privacy_setting import PrivacySetting
-from .parser import SqlTransformer, sql_parser, constructConstraintList, find_and_parts
+from .plan import get_plan, load_plan
+from . import kernels
 
 
 if not Configuration.initialized:
@@ -46,6 +50,79 @@ functionmapping = {
     "RAVG": ("diffpriv", "addAvg", "calcAvg", "apply_DiffPrivRAW"),
 }
 
+# functions which can be computed from per bucket aggregates of the database
+pushdown_functions = ["SUM", "AVG", "COUNT"]
+
+
+# calculations of the diffpriv functions from a summary of all shards of a query
+summary_calculations = {
+    "calcAvg": kernels.summary_level_moments,
+    "calcCount": kernels.summary_level_counts,
+}
+
+
+def supports_pushdown(parsed_query, granularity):
+    """ Check if all functions of a parsed query can be answered by select_query_partials(). """
+    if not Configuration.aggregate_pushdown or not granularity:
+        return False
+    return all(fun[0]['name'] in pushdown_functions for fun in parsed_query['Select'])
+
+
+def supports_sharding(parsed_query, amount):
+    """ Check if a parsed query with the given amount of users is processed in shards of users. """
+    if not Configuration.query_shard_size or amount <= Configuration.query_shard_size:
+        return False
+    return all(functionmapping[fun[0]['name']][0] == "diffpriv" for fun in parsed_query['Select'])
+
+
+def function_attributes(fun):
+    """ Return the attributes (without data source) of a function of a parsed query. """
+    return [attr.split(".")[1] for attr in fun[0]['attr']]
+
+
+def select_values(users, query, pushdown, session):
+    """ Select the data of the users relevant for a query, aggregated by the database if pushdown is set. """
+    if pushdown:
+        return select_query_partials(users, query['interval_start_time'], query['interval_finish_time'], query['granularity'], session)
+    return select_query_data(users, query['interval_start_time'], query['interval_finish_time'], session)
+
+
+def process_in_shards(query, users, parsed_query, pushdown, amount):
+    """ Start processing the users of a query in shards of Configuration.query_shard_size users.
+
+        The shards are selected and summarized by process_query_shard tasks
+        in parallel. The callback of their chord, finish_sharded_query(),
+        merges the summaries, calculates the result and stores it. If a shard
+        fails, abort_sharded_query() aborts the query. Chords require a result
+        backend supporting them, sharding is disabled at worker startup otherwise. """
+    items = [[user_id, settings] for user_id, settings in users.items()]
+    size = Configuration.query_shard_size
+    shards = [items[first:first + size] for first in range(0, len(items), size)]
+    attributes = sorted({a for fun in parsed_query['Select'] for a in function_attributes(fun)})
+    callback = finish_sharded_query.s(query, amount).on_error(abort_sharded_query.si(query))
+    celery.chord(process_query_shard.s(query, shard, attributes, pushdown) for shard in shards)(callback)
+
+
+def summary_response(parsed_query, amount, summary):
+    """ Calculate the response of a query whose functions are all diffpriv functions from the summary of its users. """
+    response = {}
+    response['amount'] = amount
+    for i, fun in enumerate(parsed_query['Select']):
+        attributes = function_attributes(fun)
+        func = functionmapping[fun[0]['name']]
+        res = summary_calculations[func[2]](summary, attributes)
+        res = globals()[func[3]](None, attributes, res, summary_sensitivities(summary, attributes))
+        response['Fun' + str(i)] = globals()[func[1]](res, attributes)
+    return response
+
+
+def summary_sensitivities(summary, attributes):
+    """ Return the sensitivities of an AVG query (see get_sensitivities()) from a summary, None if an attribute has no values. """
+    if any(summary.get(a, {}).get('min') is None for a in attributes):
+        return None
+    count = sum(sum(summary[a]['participants']) for a in attributes)
+    return sensitivities_from_ranges({a: summary[a]['min'] for a in attributes}, {a: summary[a]['max'] for a in attributes}, count, attributes)
+
 
 def add_data_to_database(data):
     """ This function enables to commit data to the database
@@ -61,72 +138,106 @@ def add_data_to_database(data):
 """ Query
     query related tasks:
     - register_query: register query in for processing, create query reply
+    - start_query: process a query at the end of its consent phase
+    - process_queries: start pending queries whose consent phase is over
     - process_query: parse query, select and inform users
+    - process_query_shard: select and summarize the data of a shard of users of a query
+    - finish_sharded_query: calculate and store the result of a query processed in shards
     - get_queries: return queries concerning a specific user
     - set_consent: set consent for user """
 
 
+def schedule_query(proc_id, query_id, consent_finish_time, pin=False):
+    """ Enqueue the start of a query (see start_query()) for the end of its consent phase.
+
+    Args:
+        - proc_id (int): processor id
+        - query_id (int): query id
+        - consent_finish_time (int): end of the consent phase in milliseconds
+        - pin (bool): True for a pin query """
+    eta = datetime.fromtimestamp(consent_finish_time / 1000., tz=timezone.utc)
+    start_query.apply_async((proc_id, query_id, pin), eta=eta)
+
+
+def claim_query(session, model, proc_id, query_id, cur_time):
+    """ Atomically change the state of a pending query whose consent phase is over to processing.
+
+    Args:
+        - session (db session): session to use, it is committed
+        - model (class): Query_Db or Pin_Query_Db
+        - proc_id (int): processor id
+        - query_id (int): query id
+        - cur_time (int): current time in milliseconds
+
+    Returns:
+        - bool: True if the query was claimed, i.e. the caller has to process it """
+    pending = QueryState.PENDING if model is Query_Db else QueryState.PENDING.value
+    processing = QueryState.PROCESSING if model is Query_Db else QueryState.PROCESSING.value
+    claimed = session.query(model).filter(
+        model.processor_id == proc_id,
+        model.query_id == query_id,
+        model.state == pending,
+        model.consent_finish_time <= cur_time
+    ).update({model.state: processing}, synchronize_session=False)
+    session.commit()
+    return claimed == 1
+
+
+@celery.shared_task(ignore_result=True)
+def start_query(proc_id, query_id, pin=False):
+    """ Process a query once its consent phase is over. Scheduled by schedule_query() when the query is registered
+        and by the sweep of process_queries(). Only the first of several starts of the same query processes it.
+
+    Args:
+        - proc_id (int): processor id
+        - query_id (int): query id
+        - pin (bool): True for a pin query
+    """
+    model = Pin_Query_Db if pin else Query_Db
+    session = db.get_db_session()
+    cur_time = int(round(time.time() * 1000))
+    try:
+        if not claim_query(session, model, proc_id, query_id, cur_time):
+            # started too early (e.g. clock skew), schedule again if the query is still pending
+            query = session.query(model).filter(model.processor_id == proc_id, model.query_id == query_id).one_or_none()
+            if query is not None and query.state == QueryState.PENDING and query.consent_finish_time > cur_time:
+                schedule_query(proc_id, query_id, query.consent_finish_time, pin)
+            return
+        queryobj = session.query(model).filter(model.processor_id == proc_id, model.query_id == query_id).one().as_dict()
+    finally:
+        session.close()
+    if pin:
+        process_pin_query(queryobj)
+    else:
+        process_query(queryobj)
+
+
 @celery.task(ignore_result=True)
 def process_queries():
-    """ Get all open queries (including pin queries), which are ready for processing (i.e., the phase, during which
-        users check_authorization decide if they want to particiapte or not, is over)
-        and initiate it such that the result can be calculated and the query can be closed.
+    """ Safety sweep for queries (including pin queries) whose consent phase is over but which are still pending,
+        e.g. because their scheduled start (see schedule_query()) got lost or they were registered before it existed.
+        A start_query task is enqueued for each of them, the sweep does not wait for their processing.
 
     Args:
 
     Returns:
         - success (bool)
-        - error (list of dicts):
-            - content of dicts:
-                - code (int):
-                    24 -- Undefined failure during query processing
-                - message (str): error code meaning including query information
-
-        (returns error only if success == False)
+        - response (dict):
+            - started (int): number of enqueued queries
     """
     session = db.get_db_session()
     cur_time = int(round(time.time() * 1000))
-    # get processable queries, i.e. all queries for which the time for participating is over
-    result = {}
-    result['success'] = True
-    queries = session.query(Query_Db).filter(Query_Db.state == QueryState.PENDING, Query_Db.consent_finish_time <= cur_time).all()
-    requests_q = {}
-    for query in queries:
-        queryobj = query.as_dict()  # Make the object serializable
-        query.state = 'processing'
-        session.commit()
-        requests_q[queryobj['query_id']] = process_query.delay(queryobj)
-    # get processable pin queries, i.e. all queries for which the time for participating is over
-    queries = session.query(Pin_Query_Db).filter(Pin_Query_Db.state is QueryState.PENDING, Pin_Query_Db.consent_finish_time <= cur_time).all()
-    requests_qp = {}
-    for query in queries:
-        queryobj = query.as_dict()  # Make the object serializable
-        query.state = 'processing'
-        session.commit()
-        requests_qp[queryobj['query_id']] = process_pin_query.delay(queryobj)
-    session.close()
-
-    for qid, res in requests_q.items():
-        with allow_join_result():
-            if not res.get():
-                error = {}
-                error['code'] = enums.Error.CANNOT_PROCESS_QUERY
-                error['message'] = "Undefined failure during query processing of query " + str(qid)
-                if 'error' not in result:
-                    result['error'] = []
-                    result['success'] = False
-                result['error'].append(error)
-    for qid, res in requests_qp.items():
-        with allow_join_result():
-            if not res.get():
-                error = {}
-                error['code'] = enums.Error.CANNOT_PROCESS_QUERY
-                error['message'] = "Undefined failure during query processing of query " + str(qid)
-                if 'error' not in result:
-                    result['error'] = []
-                    result['success'] = False
-                result['error'].append(error)
-    return result
+    try:
+        # get processable queries, i.e. all queries for which the time for participating is over
+        due = [(row.processor_id, row.query_id, False) for row in session.query(Query_Db.processor_id, Query_Db.query_id).filter(
+            Query_Db.state == QueryState.PENDING, Query_Db.consent_finish_time <= cur_time)]
+        due.extend((row.processor_id, row.query_id, True) for row in session.query(Pin_Query_Db.processor_id, Pin_Query_Db.query_id).filter(
+            Pin_Query_Db.state == QueryState.PENDING.value, Pin_Query_Db.consent_finish_time <= cur_time))
+    finally:
+        session.close()
+    for proc_id, query_id, pin in due:
+        start_query.delay(proc_id, query_id, pin)
+    return {'success': True, 'response': {'started': len(due)}}
 
 
 @celery.shared_task
@@ -154,20 +265,27 @@ def process_query(query):
         if amount >= query['amount']:
             users_db = users_db.all()
             # get settings of users for relevant attributes (privacy, granularity)
+            users = QueryUserSetting.load(session, query['processor_id'], query['query_id'], QueryState.ACCEPTED)
             for user in users_db:
-                users[user.user_id] = ast.literal_eval(user.settings)
-            # select the data relevant for query
-            values = select_query_data(users, query['interval_start_time'], query['interval_finish_time'], session)
-            values = split_by_privacy(values)
+                # users prepared before the settings were stored in their own table
+                if user.user_id not in users and user.settings:
+                    users[user.user_id] = ast.literal_eval(user.settings)
+            parsed_query = load_plan(query['query'], query.get('plan')).parsed
+            # select the data relevant for query, aggregated by the database if possible
+            pushdown = supports_pushdown(parsed_query, query['granularity'])
+            if supports_sharding(parsed_query, amount):
+                # large queries: select and summarize the data in shards of users processed in parallel,
+                # the result is stored by the callback of the shards
+                process_in_shards(query, users, parsed_query, pushdown, amount)
+                session.close()
+                return True
+            values = split_by_privacy(select_values(users, query, pushdown, session))
             # select operation and calculate the result:
             response = {}
             response['amount'] = amount
             i = 0
-            parsed_query = SqlTransformer().transform(sql_parser.parse(query['query']))
             for fun in parsed_query['Select']:
-                attributes = list()
-                for a in range(0, len(fun[0]['attr'])):
-                    attributes.append(fun[0]['attr'][a].split(".")[1])
+                attributes = function_attributes(fun)
                 func = functionmapping[fun[0]['name']]
                 if func[0] == "kanon":
                     anonvals = k_anonymity(values, attributes)
@@ -210,6 +328,75 @@ def process_query(query):
         return False
 
 
+@celery.shared_task
+def process_query_shard(query, users, attributes, pushdown):
+    """ Select the data of a shard of the users of a query and reduce it to a summary.
+
+    Args:
+        - query (dict): query to be processed (see process_query())
+        - users (list): [user_id, settings] pairs of the users of the shard, settings as returned by select_users()
+        - attributes (list of str): attributes used by the functions of the query
+        - pushdown (bool): True if the data is aggregated by the database (see supports_pushdown())
+
+    Returns:
+        - dict: summary of the shard (see kernels.shard_summary())
+    """
+    session = db.get_db_session()
+    try:
+        users = {user_id: settings for user_id, settings in users}
+        values = split_by_privacy(select_values(users, query, pushdown, session))
+        return kernels.shard_summary(values, attributes)
+    finally:
+        session.close()
+
+
+@celery.shared_task
+def finish_sharded_query(summaries, query, amount):
+    """ Merge the summaries of the shards of a query, calculate its result and store it.
+        Callback of the shards started by process_in_shards().
+
+    Args:
+        - summaries (list of dicts): summaries of the shards (see process_query_shard())
+        - query (dict): query to be processed (see process_query())
+        - amount (int): number of users who consented
+
+    Returns:
+        - success (bool): True if the result was stored, False otherwise
+    """
+    session = db.get_db_session()
+    try:
+        queryres = session.query(Query_Db).filter(Query_Db.query_id == query['query_id'], Query_Db.processor_id == query['processor_id']).one()
+        parsed_query = load_plan(query['query'], query.get('plan')).parsed
+        summary = kernels.merge_shard_summaries(summaries)
+        queryres.result = json.dumps({'response': summary_response(parsed_query, amount, summary)})
+        # recalculated queries (see check_payment()) keep their state
+        if queryres.state == QueryState.PROCESSING:
+            queryres.state = 'completed'
+        session.commit()
+        return True
+    except Exception:
+        if Configuration.test_mode:
+            logging.exception("An error occured:")
+        session.rollback()
+        abort_sharded_query(query)
+        return False
+    finally:
+        session.close()
+
+
+@celery.shared_task
+def abort_sharded_query(query):
+    """ Abort a query whose processing in shards failed. """
+    session = db.get_db_session()
+    try:
+        queryres = session.query(Query_Db).filter(Query_Db.query_id == query['query_id'], Query_Db.processor_id == query['processor_id']).one()
+        queryres.state = 'aborted'
+        queryres.result = '{"error":"Exception during query processing"}'
+        session.commit()
+    finally:
+        session.close()
+
+
 @celery.shared_task
 def process_pin_query(query):
     """ Check if any user participated in the pin query and fetch the requested data from the database.
@@ -227,7 +414,7 @@ def process_pin_query(query):
     session = db.get_db_session()
     # read users with consent="yes" from database
     try:
-        queryres = session.query(Pin_Query_Db).filter(Query_Db.query_id == query['query_id'], Query_Db.processor_id == query['processor_id']).one()
+        queryres = session.query(Pin_Query_Db).filter(Pin_Query_Db.query_id == query['query_id'], Pin_Query_Db.processor_id == query['processor_id']).one()
         result = {}
         users = {}
         users_db = session.query(QueryUser).filter_by(query_id=query['query_id'], proc_id=query['processor_id'], consent=QueryState.ACCEPTED)
@@ -235,18 +422,10 @@ def process_pin_query(query):
         users = [row.user_id for row in users_db.all()]
 
         if amount > 0:
-            # get data sources and attributes from parser
-            parsed_query = SqlTransformer().transform(sql_parser.parse(query['query']))
-            target_attr = list()
-            for e in parsed_query['Select']:
-                for i in range(0, len(e[0]['attr'])):
-                    target_attr.append(e[0]['attr'][i])
-            attributes = list()
-            datasources = list()
-            for attr in target_attr:
-                temp = attr.split(".")
-                datasources.append(temp[0])
-                attributes.append(temp[1])
+            # get data sources and attributes from the stored plan
+            plan = load_plan(query['query'], query.get('plan'))
+            attributes = plan.attributes
+            datasources = plan.data_sources
             # dict to store values for all users
             values_dict = {}
             # for each data source
@@ -323,6 +502,8 @@ def register_query(proc_id, query_id, query, price, amount, interval_start_time,
             - code (int): one of
                 1 -- invalid token
                 2 -- query_id, proc_id combination already exists for query
+                9 -- a data source of the query is not registered
+                32 -- invalid query
             - message (str): error code meaning
         - response (dict):
             - query_id (int): query id
@@ -340,6 +521,25 @@ def register_query(proc_id, query_id, query, price, amount, interval_start_time,
         return result
     if query_id == -1:
         query_id = int(str(int(uuid.uuid1()))[:12])
+    # build the plan of the query once, later stages load it instead of parsing the query
+    try:
+        plan = get_plan(query)
+        plan.used_data_types()
+    except Exception as e:
+        if Configuration.test_mode:
+            logging.exception("An error occured:")
+        session.close()
+        result['error'] = {'code': enums.Error.INVALID_QUERY, 'message': "The Query you entered is invalid! Explicit Error: {}".format(str(e))}
+        return result
+    try:
+        stored_plan = plan.dumps(session)
+    except Exception:
+        if Configuration.test_mode:
+            logging.exception("An error occured:")
+        session.rollback()
+        session.close()
+        result['error'] = {'code': enums.Error.DATA_SOURCE_NOT_REGISTERED, 'message': "data source could not be found."}
+        return result
 
     # create new btc address if multiple
     if Configuration.payment_mode is PaymentMethod.NONE:
@@ -372,8 +572,9 @@ def register_query(proc_id, query_id, query, price, amount, interval_start_time,
         title=title,
         description=description,
         goal_description=goal_description,
-        usedDataTypes=str([]),
-        thumbnail_url=thumbnail_url
+        usedDataTypes=str(plan.used_data_types()),
+        thumbnail_url=thumbnail_url,
+        plan=stored_plan
     )
     db.add_data_to_database(new_query_entry)
     session.commit()
@@ -382,6 +583,8 @@ def register_query(proc_id, query_id, query, price, amount, interval_start_time,
     try:
         res = prepare_query(query_id, proc_id)
         if res['success']:
+            if query_state == QueryState.PENDING:
+                schedule_query(proc_id, query_id, consent_finish_time)
             result['success'] = True
             result['response'] = query_reply
         else:
@@ -390,6 +593,8 @@ def register_query(proc_id, query_id, query, price, amount, interval_start_time,
         if Configuration.test_mode:
             logging.exception("An error occured:")
         session.delete(new_query_entry)
+        session.query(QueryUser).filter_by(proc_id=proc_id, query_id=query_id).delete(synchronize_session=False)
+        QueryUserSetting.remove(session, proc_id, query_id)
         session.commit()
         session.close()
         result['success'] = False
@@ -417,6 +622,8 @@ def register_pin_query(proc_id, query_id, session_id, query, consent_start_time,
             - code (int): one of
                 1 -- invalid token
                 2 -- query_id, proc_id combination already exists for query
+                9 -- a data source of the query is not registered
+                32 -- invalid query
             - message (str): error code meaning
         - response (dict):
             - query_id (int): query id
@@ -439,6 +646,25 @@ def register_pin_query(proc_id, query_id, session_id, query, consent_start_time,
         return result
     if query_id == -1:
         query_id = int(str(int(uuid.uuid1()))[:12])
+    # build the plan of the query once, later stages load it instead of parsing the query
+    try:
+        plan = get_plan(query)
+        plan.used_data_types()
+    except Exception as e:
+        if Configuration.test_mode:
+            logging.exception("An error occured:")
+        session.close()
+        result['error'] = {'code': enums.Error.INVALID_QUERY, 'message': "The Query you entered is invalid! Explicit Error: {}".format(str(e))}
+        return result
+    try:
+        stored_plan = plan.dumps(session)
+    except Exception:
+        if Configuration.test_mode:
+            logging.exception("An error occured:")
+        session.rollback()
+        session.close()
+        result['error'] = {'code': enums.Error.DATA_SOURCE_NOT_REGISTERED, 'message': "data source could not be found."}
+        return result
 
     # create query entry
     pin = int(hashlib.sha256((str(proc_id) + str(query_id)).encode('utf-8')).hexdigest(), 16) % 10**5
@@ -450,12 +676,15 @@ def register_pin_query(proc_id, query_id, session_id, query, consent_start_time,
         state=query_state,
         session_id=session_id,
         result=query_result,
+        plan=stored_plan
     )
     db.add_data_to_database(new_query_entry)
     session.commit()
     # create query reply
     response_data = {'session_id': session_id, 'session_pin': pin}
     query_reply = {'query_id': query_id, 'processor_id': proc_id, 'response_data': response_data}
+    if query_state == QueryState.PENDING:
+        schedule_query(proc_id, query_id, consent_finish_time, pin=True)
     result['response'] = query_reply
     result['success'] = True
     return result
@@ -467,26 +696,8 @@ def check_query(query):
     result = {'success': False}
     session = db.get_db_session()
     try:
-        parsed_query = SqlTransformer().transform(sql_parser.parse(query))
-        target_attr = list()
-        for e in parsed_query['Select']:
-            for i in range(0, len(e[0]['attr'])):
-                target_attr.append(e[0]['attr'][i])
-        attributes = list()
-        datasources = list()
-        usedDataTypes = list()
-        for attr in target_attr:
-            temp = attr.split(".")
-            datasources.append(temp[0])
-            attributes.append(temp[1])
-            usedDataTypes.append(HelperMethods.str_to_attr("label", HelperMethods.classname_to_source(temp[0]))[temp[1]].value)
-        # construct the constraintlist from the WHERE part of the query
-        if 'Where' in parsed_query:
-            andparts = find_and_parts(parsed_query['Where'], list([]))
-            for p in andparts:
-                constraintlist = constructConstraintList(p, list([]))
-                for constraint in constraintlist:
-                    usedDataTypes.append(HelperMethods.str_to_attr("label", HelperMethods.classname_to_source(constraint[0]))[constraint[1]].value)
+        # parses the query and resolves all attributes, including the ones of the WHERE part
+        get_plan(query).used_data_types()
         result['success'] = True
         return result
     except Exception as e:
@@ -531,27 +742,13 @@ def prepare_query(query_id, proc_id):
         error = {'code': enums.Error.INVALID_TOKEN, 'message': "query was not in DB"}
         result['error'] = error
         return result
-    parsed_query = SqlTransformer().transform(sql_parser.parse(query.query))
-    target_attr = list()
-    for e in parsed_query['Select']:
-        for i in range(0, len(e[0]['attr'])):
-            target_attr.append(e[0]['attr'][i])
-    attributes = list()
-    datasources = list()
-    usedDataTypes = list()
-    for attr in target_attr:
-        temp = attr.split(".")
-        datasources.append(temp[0])
-        attributes.append(temp[1])
-        usedDataTypes.append(HelperMethods.str_to_attr("label", HelperMethods.classname_to_source(temp[0]))[temp[1]].value)
-    # construct the constraintlist from the WHERE part of the query
+    plan = load_plan(query.query, query.plan)
+    attributes = plan.attributes
+    datasources = plan.data_sources
+    # select the users of every part of the WHERE part of the query
     all_users = {}
-    if 'Where' in parsed_query:
-        andparts = find_and_parts(parsed_query['Where'], list([]))
-        for p in andparts:
-            constraintlist = constructConstraintList(p, list([]))
-            for constraint in constraintlist:
-                usedDataTypes.append(HelperMethods.str_to_attr("label", HelperMethods.classname_to_source(constraint[0]))[constraint[1]].value)
+    if plan.constraint_lists() is not None:
+        for constraintlist in plan.constraint_lists():
             users = select_users(
                 datasources,
                 attributes,
@@ -579,16 +776,9 @@ def prepare_query(query_id, proc_id):
                 all_users[u] = users[u]
 
     # store users and their settings in database
-    datasource_ids = []
     try:
-        for ds in datasources:
-            datasource_ids.append(
-                session.query(
-                    AvailableDataSource
-                ).filter_by(
-                    data_source_name=HelperMethods.classname_to_tablename(ds)
-                ).one().data_source_id
-            )
+        datasource_ids = plan.data_source_ids(session)
+        stored_plan = plan.dumps(session)
     except Exception:
         if Configuration.test_mode:
             logging.exception("An error occured:")
@@ -598,29 +788,37 @@ def prepare_query(query_id, proc_id):
         result['error'] = error
         return result
     try:
-        session.query(Query_Db).filter_by(processor_id=proc_id, query_id=query_id).update({"usedDataTypes": str(usedDataTypes)})
-        session.commit()
-        for user in all_users:
-
-            # Retrive expicit consent
-            try:
-                explicitConsents = session.query(PrivacySetting).filter_by(user_id=user).filter(PrivacySetting.data_source_id.in_(datasource_ids)).all()
-                explicitConsents = [e.explicitconsent for e in explicitConsents]
-            except Exception:
-                if Configuration.test_mode:
-                    logging.exception("An error occured:")
-                session.rollback()
-                session.close()
-                error = {'code': enums.Error.INVALID_PRIVACY_LEVEL, 'message': "Could not retrive the explicit Consent!"}
-                result['error'] = error
-                return result
-            # If explicit consent false, set querystate as accepted
-
-            if True in explicitConsents or None in explicitConsents:
-                query_user = QueryUser(user, proc_id, query_id, QueryState.PENDING, str(all_users[user]))
-            else:
-                query_user = QueryUser(user, proc_id, query_id, QueryState.ACCEPTED, str(all_users[user]))
-            session.add(query_user)
+        if query.plan != stored_plan:
+            # queries registered before plans were stored
+            session.query(Query_Db).filter_by(processor_id=proc_id, query_id=query_id).update({
+                "usedDataTypes": str(plan.used_data_types()),
+                "plan": stored_plan
+            })
+            session.commit()
+        # users asking for their explicit consent (set or unset flag) for any of the data sources have to consent,
+        # all other users participate right away
+        try:
+            consent_required = set(row[0] for row in session.query(
+                PrivacySetting.user_id
+            ).filter(
+                PrivacySetting.data_source_id.in_(datasource_ids),
+                or_(PrivacySetting.explicitconsent.is_(None), PrivacySetting.explicitconsent.is_(True))
+            ).distinct())
+        except Exception:
+            if Configuration.test_mode:
+                logging.exception("An error occured:")
+            session.rollback()
+            session.close()
+            error = {'code': enums.Error.INVALID_PRIVACY_LEVEL, 'message': "Could not retrive the explicit Consent!"}
+            result['error'] = error
+            return result
+        if all_users:
+            session.execute(QueryUser.__table__.insert(), [
+                {'user_id': user, 'proc_id': proc_id, 'query_id': query_id, 'settings': None,
+                 'consent': QueryState.PENDING if user in consent_required else QueryState.ACCEPTED}
+                for user in all_users
+            ])
+        QueryUserSetting.add(session, proc_id, query_id, all_users)
     except Exception:
         if Configuration.test_mode:
             logging.exception("An error occured:")
@@ -850,6 +1048,13 @@ def get_user_pin_queries(user_id, query_state):
         return result
 
 
+def used_data_types(query):
+    """ Return the labels of the attributes used by a Query_Db row, from its plan if it has one. """
+    if query.plan:
+        return load_plan(query.query, query.plan).used_data_types()
+    return ast.literal_eval(query.usedDataTypes)
+
+
 @celery.shared_task
 def retrieve_query(user_id, query_id, processor=True):
     """ Get specific query in which the user with the passed id participated or which was posed by this processor.
@@ -877,10 +1082,16 @@ def retrieve_query(user_id, query_id, processor=True):
     """
     result = {}
     result['success'] = False
+    if processor:
+        response = get_result_cache().get((user_id, query_id))
+        if response is not None:
+            result['success'] = True
+            result['response'] = response
+            return result
     session = db.get_db_session()
     try:
         if processor:
-            query_list = session.query(Query_Db).filter(Query_Db.query_id == query_id)
+            query_list = session.query(Query_Db).filter(Query_Db.query_id == query_id, Query_Db.processor_id == user_id)
             row = query_list.one()
             if (row.state is not QueryState.PAID) and (row.state is not QueryState.ABORTED):
                 row.result = "query not paid"
@@ -899,11 +1110,12 @@ def retrieve_query(user_id, query_id, processor=True):
                 "title": row.title,
                 "description": row.description,
                 "goal_description": row.goal_description,
-                "used_data_types": ast.literal_eval(row.usedDataTypes),
+                "used_data_types": used_data_types(row),
                 "result": row.result,
                 "query": row.query,
                 "thumbnail_url": row.thumbnail_url
             }
+            get_result_cache().put((user_id, query_id), response)
         else:
             query_list = session.query(
                 Query_Db,
@@ -932,7 +1144,7 @@ def retrieve_query(user_id, query_id, processor=True):
                 "title": row.Query_Db.title,
                 "description": row.Query_Db.description,
                 "goal_description": row.Query_Db.goal_description,
-                "used_data_types": ast.literal_eval(row.Query_Db.usedDataTypes),
+                "used_data_types": used_data_types(row.Query_Db),
                 "consent_state": row.QueryUser.consent,
                 "thumbnail_url": row.Query_Db.thumbnail_url
             }
@@ -1107,12 +1319,13 @@ def get_pin_query_info(user_id, pin):
 @celery.shared_task
 def set_query_consent(user_id, proc_id, query_id, accept):
     """ Change consent to participate in a query or not for the user with the passed id and
-        the query with the passed processor and query ids.
+        the query with the passed processor and query ids. The consent to several queries of
+        the same processor is changed at once by passing a list of query ids.
 
     Args:
         - user_id (int): user id of user or processor who is posing this request
         - proc_id (int): processor id of processor who posed the query
-        - query_id (int): id of the query
+        - query_id (int or list of int): id of the query or ids of the queries
         - accept (bool): can be True or False = user gives consent vs. refuses to give consent
 
     Returns:
@@ -1120,7 +1333,7 @@ def set_query_consent(user_id, proc_id, query_id, accept):
         - error (dict):
             - code (int): one of
                 1  -- invalid session token
-                19 -- query was not in db
+                19 -- query was not in db (or one of the queries)
             - message (str): error code meaning
         - response (empty dict)
 
@@ -1129,20 +1342,18 @@ def set_query_consent(user_id, proc_id, query_id, accept):
     """
     result = {}
     result['success'] = False
+    query_ids = set(query_id) if isinstance(query_id, list) else {query_id}
     session = db.get_db_session()
     try:
-        query = session.query(
+        updated = session.query(
             QueryUser
         ).filter(
             QueryUser.user_id == user_id,
-            QueryUser.query_id == query_id,
+            QueryUser.query_id.in_(query_ids),
             QueryUser.proc_id == proc_id
-        ).one()
-        if accept:
-            query.consent = QueryState.ACCEPTED
-
-        else:
-            query.consent = "refused"
+        ).update({'consent': QueryState.ACCEPTED if accept else QueryState.REFUSED}, synchronize_session=False)
+        if updated != len(query_ids):
+            raise SqlAlchemyException.NoResultFound("query was not in DB")
         session.commit()
         session.close()
         response = {}
@@ -1290,99 +1501,22 @@ def add(values, attributes):
 
 def calcAvg(values, attributes):
     """ Execute avg function. """
-    result = {}
-    amounts = {}
-    for a in attributes:
-        result[a] = {}
-        amounts[a] = {}
-        for p in range(1, 4):
-            result[a][p] = []
-            amounts[a][p] = []
-    for attr in values:
-        if attr in attributes:
-            for priv in range(1, 4):
-                for u in values[attr][priv]:
-
-                    length = len(values[attr][priv][u]['v'])
-                    if len(result[attr][priv]) == 0:
-                        for i in range(length):
-                            result[attr][priv].append((0, 0))
-                            amounts[attr][priv].append(0)
-                    for i in range(length):
-                        amounts[attr][priv][i] += 1
-                        result[attr][priv][i] = tuple(map(sum, zip(result[attr][priv][i], (values[attr][priv][u]['v'][i], 1))))
-    for a in attributes:
-        for p in range(1, 4):
-            for i in range(len(result[a][p])):
-                result[a][p][i] = result[a][p][i][0] / result[a][p][i][1]
-    stDevs = calc_stDevs(values, attributes, result)
-    res = []
-    res.append(result)
-    res.append(stDevs)
-    res.append(amounts)
-    return res
+    return kernels.level_moments(values, attributes)
 
 
 def calc_stDevs(values, attributes, means):
     """ Execute stDev function. """
-    stDevs = {}
-    for a in attributes:
-        stDevs[a] = {}
-        for p in range(1, 4):
-            stDevs[a][p] = []
-            for i in range(len(means[a][p])):
-                stDevs[a][p].append(0)
-    for a in attributes:
-        for p in range(1, 4):
-            for u in values[a][p]:
-                for i in range(len(values[a][p][u]['v'])):
-                    stDevs[a][p][i] += (values[a][p][u]['v'][i] - means[a][p][i])**2
-
-    return stDevs
+    return kernels.squared_deviations(values, attributes, means)
 
 
 def addAvg(values, attributes):
     """ Execute addAvg function. """
-    means = values[0]
-    stDevs = values[1]
-    amounts = values[2]
-    res = {}
-    length = None
-    for a in attributes:
-        res[a] = {}
-        finalmean = []
-        finalstDev = []
-        count = []
-        for p in range(1, 4):
-
-            length = len(means[a][p])
-            if length > 0:
-                if count == []:
-                    for _ in range(length):
-                        count.append(0)
-                if finalmean == []:
-                    for _ in range(length):
-                        finalmean.append(0.0)
-                        finalstDev.append(0.0)
-                count = [sum(x) for x in zip(count, amounts[a][p])]
-                finalmean = [sum(x) for x in zip(finalmean, [c * d for c, d in zip(means[a][p], amounts[a][p])])]
-                finalstDev = [sum(x) for x in zip(finalstDev, [c * d for c, d in zip(stDevs[a][p], amounts[a][p])])]
-
-        finalmean = [c / d for c, d in zip(finalmean, count)]
-        finalstDev = [c / d for c, d in zip(finalstDev, count)]
-        res[a]['mean'] = finalmean
-        res[a]['stDev'] = finalstDev
-    return res
+    return kernels.combine_levels(values[0], values[1], values[2], attributes)
 
 
 def calcCount(values, attributes):
     """ Counts the number of participants in each privacy class """
-    res = {}
-    for a in attributes:
-        res[a] = {}
-        for p in range(1, 4):
-            res[a][p] = len(values[a][p])
-    return res
+    return kernels.level_counts(values, attributes)
 
 
 def addCount(values, attributes):
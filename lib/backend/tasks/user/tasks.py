@@ -11,6 +11,7 @@ import celery
 from lib.config import Configuration
 from lib.data_structures import enums
 from lib.data_structures import QueryUser
+from lib.data_structures import QueryUserSetting
 from lib.data_structures import Query_Db
 from lib.data_structures.available_data_source import AvailableDataSource
 from lib.data_structures import UserDataType
@@ -482,6 +483,7 @@ def remove(user_id, passw, db_query_inf, db_query_privacy, db_query_queries, is_
                     queries_to_delete = session.query(db_query_queries).filter_by(**param).all()
                     for query in queries_to_delete:
                         session.delete(query)
+                    QueryUserSetting.remove_user(session, user_id)
                 except Exception:
                     if Configuration.test_mode:
                         logging.exception("An error occured:")
@@ -0,0 +1,100 @@
+""" Write-behind buffer for data points uploaded one at a time.
+
+    Data points are collected per (user, data source) into batches. A batch
+    is written as soon as it holds max_points data points or its oldest data
+    point is older than max_age seconds. A background thread flushes the
+    batches reaching the age limit, all of them with one call of the write
+    function, the remaining batches are flushed when the process exits. """
+import atexit
+import logging
+import threading
+import time
+
+from lib.data_structures import enums
+
+
+class PendingBatch():
+    """ Data points of one user and data source waiting to be written.
+
+    Attributes:
+        - user_id (int): user the data points belong to
+        - data_source_name (str): data source the data points belong to
+        - data_points (list of dicts): buffered data points
+        - created (float): time.monotonic() of the first data point
+        - written (threading.Event): set as soon as the batch was written
+        - result (dict): result of the write function """
+
+    def __init__(self, user_id, data_source_name):
+        self.user_id = user_id
+        self.data_source_name = data_source_name
+        self.data_points = []
+        self.created = time.monotonic()
+        self.written = threading.Event()
+        self.result = None
+
+
+class WriteBuffer():
+    """ Coalesces data points per user and data source into batches. """
+
+    def __init__(self, write, max_points, max_age):
+        """ Create a buffer.
+
+        Args:
+            - write (function): called as write(batches) with a list of PendingBatch, returns a list with a result dict per batch
+            - max_points (int): number of data points after which a batch is written
+            - max_age (float): number of seconds after which a batch is written """
+        self._write = write
+        self.max_points = max_points
+        self.max_age = max_age
+        self._batches = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+        atexit.register(self.flush)
+
+    def add(self, user_id, data_source_name, data_points):
+        """ Buffer data points.
+
+        Returns:
+            - PendingBatch: the batch containing the data points, wait for its written event to get the result """
+        key = (user_id, data_source_name.lower())
+        with self._lock:
+            batch = self._batches.get(key)
+            if batch is None:
+                batch = self._batches[key] = PendingBatch(user_id, data_source_name)
+            batch.data_points.extend(data_points)
+            full = len(batch.data_points) >= self.max_points
+            if full:
+                del self._batches[key]
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+                self._flusher.start()
+        if full:
+            self._flush_batches([batch])
+        return batch
+
+    def flush(self, max_age=0.):
+        """ Write all batches whose first data point is at least max_age seconds old. """
+        now = time.monotonic()
+        with self._lock:
+            keys = [key for key, batch in self._batches.items() if now - batch.created >= max_age]
+            batches = [self._batches.pop(key) for key in keys]
+        if batches:
+            self._flush_batches(batches)
+
+    def _flush_batches(self, batches):
+        try:
+            results = self._write(batches)
+        except Exception:
+            logging.exception("An error occured:")
+            results = [{'success': False, 'error': {'code': enums.Error.UNDEFINED, 'message': "Unknown error occured."}}] * len(batches)
+        for batch, result in zip(batches, results):
+            batch.result = result
+            if not result.get('success', False):
+                logging.error("Could not write %i buffered data points of user %s to %s: %s", len(batch.data_points),
+                              batch.user_id, batch.data_source_name, result.get('error'))
+            batch.written.set()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.max_age / 2.)
+            self.flush(self.max_age)
@@ -1,6 +1,7 @@
 """ This module handles constant, file-based, and runtime configuration. """
 import configparser
 from lib.data_structures import PaymentMethod
+from lib.data_structures import PreprocessingEngine
 
 
 # CONSTANTS NEEDED FOR PREPROCESSING
@@ -11,6 +12,30 @@ INTERPOLATION_LIMIT = 0.21
 # If there are no values for a longer
 # time than this (in seconds), the data row is discarded.
 MAX_INTERPOLATION_INTERVAL = 2 * 60 * 60
+# Number of rows fetched at once when selecting the data of a query.
+QUERY_DATA_YIELD_PER = 1000
+
+# CONSTANTS NEEDED FOR QUERY PROCESSING
+
+# Aggregation kernels switch to chunked (streaming) moments
+# for panels with more values than this.
+KERNEL_STREAMING_THRESHOLD = 10 ** 7
+# Number of rows stacked at once by the streaming moments.
+KERNEL_CHUNK_SIZE = 1000
+# Number of query plans (parsed queries) cached per process.
+QUERY_PLAN_CACHE_SIZE = 1024
+# Seconds a response stays in the shared tier of the result cache.
+RESULT_CACHE_SHARED_TTL = 24 * 60 * 60
+# Seconds between two sweeps for pending queries whose scheduled start got lost.
+QUERY_SWEEP_INTERVAL = 60.0
+# Seconds after which a payout cycle stops, such that it ends before the next one starts.
+PAYOUT_TIME_BUDGET = 50.0
+# Name of the chain cursor of the transactions already mapped to queries by add_txids().
+ADD_TXIDS_CURSOR = 'add_txids'
+# Name of the payout cursor of the last user examined by pay_out().
+PAY_OUT_CURSOR = 'pay_out'
+# Seconds between two runs of maintain_data_storage() (partitions and retention of data points).
+DATA_STORAGE_MAINTENANCE_INTERVAL = 60 * 60.0
 
 PrivacyParams = {
     1: {
@@ -46,6 +71,13 @@ class Configuration():
             return default
         return Configuration.parsed_config[section_key][entry_key]
 
+    @staticmethod
+    def _readConfigFlag(section_key, entry_key, default=False):
+        value = Configuration._readConfigEntry(section_key, entry_key, default=None)
+        if value is None:
+            return default
+        return str(value).lower() in ['1', 'true', 'yes', 'on']
+
     @staticmethod
     def initialize(configuration_filename='/mynedata/config.ini'):
         """ Initialize configuration based on config file. """
@@ -68,12 +100,33 @@ class Configuration():
         # API section
         key_api = 'API'
         Configuration.api_port = Configuration._readConfigEntry(key_api, 'port', default=None)
+        Configuration.api_max_waiters = int(Configuration._readConfigEntry(key_api, 'max_waiters', default=64))
+        Configuration.api_direct_reads = Configuration._readConfigFlag(key_api, 'direct_reads', default=False)
+        Configuration.write_buffer = Configuration._readConfigFlag(key_api, 'write_buffer', default=False)
+        Configuration.write_buffer_size = int(Configuration._readConfigEntry(key_api, 'write_buffer_size', default=500))
+        Configuration.write_buffer_max_age = float(Configuration._readConfigEntry(key_api, 'write_buffer_max_age', default=1.0))
+        Configuration.write_buffer_durable = Configuration._readConfigFlag(key_api, 'write_buffer_durable', default=True)
 
         # Backend section
         key_backend = 'Backend'
         Configuration.database_uri = Configuration._readConfigEntry(key_backend, 'database_uri', default=None)
         Configuration.concurrency_min = Configuration._readConfigEntry(key_backend, 'concurrency_min', default=1)
         Configuration.concurrency_max = Configuration._readConfigEntry(key_backend, 'concurrency_max', default=1)
+        Configuration.preprocessing_engine = PreprocessingEngine(Configuration._readConfigEntry(key_backend, 'preprocessing_engine', default=PreprocessingEngine.LIST))
+        Configuration.aggregate_pushdown = Configuration._readConfigFlag(key_backend, 'aggregate_pushdown', default=False)
+        Configuration.query_shard_size = int(Configuration._readConfigEntry(key_backend, 'query_shard_size', default=0))
+        Configuration.db_pool_size = int(Configuration._readConfigEntry(key_backend, 'db_pool_size', default=0))
+        Configuration.db_max_overflow = int(Configuration._readConfigEntry(key_backend, 'db_max_overflow', default=10))
+        Configuration.db_pool_recycle = int(Configuration._readConfigEntry(key_backend, 'db_pool_recycle', default=3600))
+        Configuration.db_pool_pre_ping = Configuration._readConfigFlag(key_backend, 'db_pool_pre_ping', default=True)
+        Configuration.partial_aggregate_granularities = [int(g) for g in str(Configuration._readConfigEntry(
+            key_backend, 'partial_aggregate_granularities', default='')).split(',') if g.strip()]
+        Configuration.result_cache_size = int(Configuration._readConfigEntry(key_backend, 'result_cache_size', default=1024))
+        Configuration.result_cache_ttl = float(Configuration._readConfigEntry(key_backend, 'result_cache_ttl', default=60))
+        Configuration.result_cache_url = Configuration._readConfigEntry(key_backend, 'result_cache_url', default=None)
+        Configuration.ingest_chunk_size = int(Configuration._readConfigEntry(key_backend, 'ingest_chunk_size', default=5000))
+        Configuration.time_partitioning = Configuration._readConfigFlag(key_backend, 'time_partitioning', default=False)
+        Configuration.data_retention_months = int(Configuration._readConfigEntry(key_backend, 'data_retention_months', default=0))
 
         # Frontend section
         key_frontend = 'Frontend'
@@ -88,6 +141,8 @@ class Configuration():
         Configuration.payment_bitcoin_rpc_user = Configuration._readConfigEntry(key_payment, 'bitcoin_rpc_user', default='admin1')
         Configuration.payment_bitcoin_rpc_password = Configuration._readConfigEntry(key_payment, 'bitcoin_rpc_password', default='123')
         Configuration.payment_bitcoin_rpc_timeout = Configuration._readConfigEntry(key_payment, 'bitcoin_rpc_timeout', default=2000)
+        Configuration.payment_bitcoin_rpc_pool_size = int(Configuration._readConfigEntry(key_payment, 'bitcoin_rpc_pool_size', default=4))
+        Configuration.payout_shard_size = int(Configuration._readConfigEntry(key_payment, 'payout_shard_size', default=100))
 
         if Configuration.test_mode:
             Configuration.enable_test_mode()
@@ -115,4 +170,21 @@ class Configuration():
         print('    result_backend = {}'.format(Configuration.result_backend))
         print('    database_uri = {}'.format(Configuration.database_uri))
         print('    api_port = {}'.format(Configuration.api_port))
+        print('    api_max_waiters = {}'.format(Configuration.api_max_waiters))
+        print('    api_direct_reads = {}'.format(Configuration.api_direct_reads))
+        print('    write_buffer = {} [size {}, max_age {}, durable {}]'.format(
+            Configuration.write_buffer, Configuration.write_buffer_size,
+            Configuration.write_buffer_max_age, Configuration.write_buffer_durable))
         print('    autoscaling = [{}, {}]'.format(Configuration.concurrency_max, Configuration.concurrency_min))
+        print('    preprocessing_engine = {}'.format(Configuration.preprocessing_engine.value))
+        print('    aggregate_pushdown = {}'.format(Configuration.aggregate_pushdown))
+        print('    query_shard_size = {}'.format(Configuration.query_shard_size))
+        print('    db_pool = [size {}, overflow {}, recycle {}, pre_ping {}]'.format(
+            Configuration.db_pool_size or Configuration.concurrency_max, Configuration.db_max_overflow,
+            Configuration.db_pool_recycle, Configuration.db_pool_pre_ping))
+        print('    ingest_chunk_size = {}'.format(Configuration.ingest_chunk_size))
+        print('    partial_aggregate_granularities = {}'.format(Configuration.partial_aggregate_granularities))
+        print('    time_partitioning = {} [retention {} months]'.format(
+            Configuration.time_partitioning, Configuration.data_retention_months))
+        print('    result_cache = [size {}, ttl {}, shared {}]'.format(
+            Configuration.result_cache_size, Configuration.result_cache_ttl, Configuration.result_cache_url))
@@ -0,0 +1,121 @@
+""" Codecs turning uploaded data points into rows of the data source tables.
+
+    The codec of a data source is derived once from the __table__ of its
+    class: column order, a coercion per column type, the defaults of the
+    constructor and the required keys (primary key columns and the value
+    attributes listed in the label of the data source, except boolean flags).
+    Decoding a data point then only walks over a precompiled list of columns.
+    Every class in lib.data_sources gets a codec automatically. """
+import inspect
+import struct
+
+from sqlalchemy import Boolean, Float, Integer, String
+
+import lib.data_sources
+from lib.data_structures import BaseObject
+
+
+class DataSourceCodec():
+    """ Decoder for the data points of one data source.
+
+    Attributes:
+        - source (class): data source class
+        - table (sqlalchemy.Table): table of the data source
+        - columns (list of str): columns in table order, without user_id
+        - required (set of str): keys every data point must contain """
+
+    packed_formats = {Integer: 'q', Float: 'd', Boolean: '?'}
+
+    def __init__(self, source):
+        self.source = source
+        self.table = source.__table__
+        self.columns = [c.name for c in self.table.columns if c.name != 'user_id']
+
+        parameters = inspect.signature(source.__init__).parameters
+        defaults = {name: p.default for name, p in parameters.items() if p.default is not inspect.Parameter.empty}
+        # the defaults of the constructors are placeholders (e.g. -1.0), so every value attribute has to be given,
+        # only boolean flags (e.g. PersonalInformation.anon) fall back to their default
+        labels = getattr(source, 'label', {})
+        self.required = {c.name for c in self.table.columns if c.primary_key and c.name != 'user_id'}
+        self.required.update(name for name in self.columns
+                             if (name in labels and not isinstance(self.table.columns[name].type, Boolean))
+                             or name not in defaults)
+        self._decoders = [(c.name, _coercion(c.type), defaults.get(c.name))
+                          for c in self.table.columns if c.name != 'user_id']
+
+    def decode(self, user_id, data_point):
+        """ Turn a data point into a row of the table, unknown keys are ignored.
+
+        Args:
+            - user_id (int): user the data point belongs to
+            - data_point (dict): column values, missing optional columns get the default of the constructor
+
+        Returns:
+            - dict: {column: value} including user_id
+
+        Raises:
+            - ValueError: if a required key is missing or a value cannot be converted """
+        if not self.required.issubset(data_point):
+            missing = self.required.difference(data_point)
+            raise ValueError("Data point misses {}".format(', '.join(sorted(missing))))
+        row = {'user_id': user_id}
+        for name, coerce, default in self._decoders:
+            value = data_point.get(name, default)
+            try:
+                row[name] = None if value is None else coerce(value)
+            except (TypeError, ValueError):
+                raise ValueError("Invalid value {!r} for {}".format(value, name))
+        return row
+
+    def packed_struct(self):
+        """ Return the struct of a packed record, i.e. all columns in table order.
+
+        Raises:
+            - ValueError: if the data source has columns which cannot be packed """
+        formats = []
+        for name in self.columns:
+            column_type = type(self.table.columns[name].type)
+            fmt = next((f for t, f in DataSourceCodec.packed_formats.items() if issubclass(column_type, t)), None)
+            if fmt is None:
+                raise ValueError("Data source {} cannot be uploaded packed, column {} is a {}".format(
+                    self.source.__name__, name, column_type.__name__))
+            formats.append(fmt)
+        return struct.Struct('<' + ''.join(formats))
+
+
+def _coercion(column_type):
+    """ Return the function converting a value into the given column type. """
+    if isinstance(column_type, Boolean):
+        return _to_bool
+    if isinstance(column_type, Integer):
+        return int
+    if isinstance(column_type, Float):
+        return float
+    if isinstance(column_type, String):
+        return str
+    return lambda value: value
+
+
+def _to_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ['1', 'true', 'yes', 'on']
+    return bool(value)
+
+
+_codecs = {}
+
+
+def get_codecs():
+    """ Return the codecs of all data sources. """
+    if not _codecs:
+        for obj in vars(lib.data_sources).values():
+            if inspect.isclass(obj) and issubclass(obj, BaseObject):
+                _codecs[obj.__name__.lower()] = DataSourceCodec(obj)
+    return list(_codecs.values())
+
+
+def get_codec(data_source_name):
+    """ Return the codec of a data source by its class name (case insensitive), None if there is no such data source. """
+    if not _codecs:
+        get_codecs()
+    return _codecs.get(data_source_name.lower())
@@ -1,14 +1,17 @@
 """ Faster access to required data structures. """
 
-from .enums import QueryState, UserDataType, PaymentMethod
+from .enums import QueryState, UserDataType, PaymentMethod, PreprocessingEngine
 from .base_object import BaseObject
 from .access_token import AccessToken
 from .available_data_source import AvailableDataSource
 from .privacy_default import PrivacyDefault
 from .privacy_setting import PrivacySetting
+from .eligibility_index import EligibilityIndex
+from .partial_aggregate import PartialAggregate
 from .query_db import Query_Db
 from .pin_query_db import Pin_Query_Db
 from .query_user import QueryUser
+from .query_user_setting import QueryUserSetting
 from .registered_data_source import RegisteredDataSource
 from .user import User
 from .processor import Processor
@@ -16,3 +19,5 @@ from .token import JwtToken
 from .upload_granularity import UploadGranularity
 from .query_user_mapping import QueryUserMapping
 from .txid import Txid
+from .chain_cursor import ChainCursor
+from .payout_cursor import PayoutCursor
@@ -0,0 +1,22 @@
+""" This module defines the database representation of a position in the Bitcoin block chain. """
+
+from sqlalchemy import Column, String
+from . import BaseObject
+
+
+class ChainCursor(BaseObject):
+    """ Database representation of the last block examined by a task, e.g. by add_txids() with listsinceblock. """
+    __tablename__ = 'chain_cursor'
+
+    name = Column(String, primary_key=True)
+    block_hash = Column(String)
+
+    def __init__(self, name, block_hash):
+        self.name = name
+        self.block_hash = block_hash
+
+    def __repr__(self):
+        return "<ChainCursor(name='%s', block_hash='%s')>" % (
+            self.name,
+            self.block_hash
+        )
@@ -0,0 +1,132 @@
+""" Module to store an index of the privacy settings: for every data source,
+    attribute and privacy level the ids of all users who chose it, one row
+    per user.
+
+    The index is maintained by mapper events of PrivacySetting, i.e. every
+    insert, update or delete of a privacy setting updates the index within the
+    same transaction. A change touches the rows of its user only, such that
+    changes of different users do not wait for each other. """
+
+import numpy as np
+from sqlalchemy import Column, Integer, String, and_, event, func, select
+from sqlalchemy.orm.attributes import get_history
+from . import BaseObject
+from .privacy_setting import PrivacySetting
+
+
+class EligibilityIndex(BaseObject):
+    """ Database representation of a user having chosen a privacy level for an attribute. """
+    # the index was stored as one array of user ids per level in the table eligibility_index before
+    __tablename__ = 'eligibility_entry'
+
+    data_source_id = Column(Integer, primary_key=True)
+    attribute = Column(String, primary_key=True)
+    level = Column(Integer, primary_key=True)
+    user_id = Column(Integer, primary_key=True)
+
+    def __init__(self, data_source_id, attribute, level, user_id):
+        self.data_source_id = data_source_id
+        self.attribute = attribute
+        self.level = level
+        self.user_id = user_id
+
+    def __repr__(self):
+        return "EligibilityIndex(data_source_id='%i', attribute='%s', level='%i', user_id='%i')" % (
+            self.data_source_id,
+            self.attribute,
+            self.level,
+            self.user_id
+        )
+
+    @staticmethod
+    def lookup(session, data_source_ids, attributes, max_level):
+        """ Return the indexed users of the given data sources and attributes.
+
+        Args:
+            - session (db session): session to use
+            - data_source_ids (list of int): data sources to look up
+            - attributes (list of str): attributes to look up
+            - max_level (int): highest privacy level to look up, starting at level 1
+
+        Returns:
+            - dict of tuple : dict of int : numpy.ndarray: {(data_source_id, attribute): {level: sorted user ids}} """
+        rows = session.query(
+            EligibilityIndex.data_source_id,
+            EligibilityIndex.attribute,
+            EligibilityIndex.level,
+            EligibilityIndex.user_id
+        ).filter(
+            EligibilityIndex.data_source_id.in_(data_source_ids),
+            EligibilityIndex.attribute.in_(attributes),
+            EligibilityIndex.level.between(1, max_level)
+        ).order_by(
+            EligibilityIndex.data_source_id,
+            EligibilityIndex.attribute,
+            EligibilityIndex.level,
+            EligibilityIndex.user_id
+        )
+        user_ids = {}
+        for data_source_id, attribute, level, user_id in rows:
+            user_ids.setdefault((data_source_id, attribute, level), []).append(user_id)
+        index = {}
+        for (data_source_id, attribute, level), users in user_ids.items():
+            index.setdefault((data_source_id, attribute), {})[level] = np.asarray(users, dtype=np.int64)
+        return index
+
+    @staticmethod
+    def update(connection, data_source_id, attribute, user_id, old_level, new_level):
+        """ Move a user from one privacy level to another, None meaning not indexed. """
+        table = EligibilityIndex.__table__
+        key = and_(table.c.data_source_id == data_source_id, table.c.attribute == attribute, table.c.user_id == user_id)
+        if old_level is not None:
+            connection.execute(table.delete().where(and_(key, table.c.level == old_level)))
+        if new_level is not None:
+            # an entry left behind, e.g. by a change of the level outside of the mapper, is replaced
+            connection.execute(table.delete().where(and_(key, table.c.level == new_level)))
+            connection.execute(table.insert().values(data_source_id=data_source_id, attribute=attribute,
+                                                     level=new_level, user_id=user_id))
+
+    @staticmethod
+    def rebuild(session):
+        """ Rebuild the whole index from the privacy settings. """
+        table = EligibilityIndex.__table__
+        session.execute(table.delete())
+        session.execute(table.insert().from_select(
+            ['data_source_id', 'attribute', 'level', 'user_id'],
+            select([
+                PrivacySetting.data_source_id,
+                PrivacySetting.attribute,
+                PrivacySetting.level,
+                PrivacySetting.user_id
+            ]).where(PrivacySetting.level.isnot(None)).distinct()
+        ))
+        session.commit()
+
+    @staticmethod
+    def ensure_populated(session):
+        """ Build the index if there are privacy settings but no index, e.g. after an update of the database schema,
+            and drop the index of the previous layout. """
+        session.execute('DROP TABLE IF EXISTS eligibility_index')
+        session.commit()
+        if session.query(func.count(EligibilityIndex.level)).scalar() == 0 \
+                and session.query(func.count(PrivacySetting.level)).scalar() > 0:
+            EligibilityIndex.rebuild(session)
+
+
+@event.listens_for(PrivacySetting, 'after_insert')
+def _index_privacy_setting_insert(_, connection, target):
+    EligibilityIndex.update(connection, target.data_source_id, target.attribute, target.user_id, None, target.level)
+
+
+@event.listens_for(PrivacySetting, 'after_update')
+def _index_privacy_setting_update(_, connection, target):
+    history = get_history(target, 'level')
+    if not history.has_changes():
+        return
+    old_level = history.deleted[0] if history.deleted else None
+    EligibilityIndex.update(connection, target.data_source_id, target.attribute, target.user_id, old_level, target.level)
+
+
+@event.listens_for(PrivacySetting, 'after_delete')
+def _index_privacy_setting_delete(_, connection, target):
+    EligibilityIndex.update(connection, target.data_source_id, target.attribute, target.user_id, target.level, None)
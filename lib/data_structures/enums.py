@@ -53,6 +53,13 @@ class PaymentMethod(str, Enum):
     BITCOIN_CENTRAL = 'bitcoin_central'
 
 
+class PreprocessingEngine(str, Enum):
+    """ Available implementations of the preprocessing chain. """
+
+    LIST = 'list'
+    NUMPY = 'numpy'
+
+
 class Error(IntEnum):
     """ Definition of error codes. """
 
@@ -89,4 +96,5 @@ class Error(IntEnum):
     PROFILE_NOT_FOUND = 30
     NO_DATA_GIVEN = 31
     INVALID_QUERY = 32
+    INVALID_DATA_POINT = 33
     UNDEFINED = 99
@@ -0,0 +1,176 @@
+""" Module to store partial aggregates of the data points: for every data
+    source, numeric attribute, user and bucket of a configured size the sum
+    and the amount of the values whose timestamps fall into the bucket.
+
+    Buckets are aligned to multiples of their size. The aggregates are
+    updated whenever data points are uploaded or removed, such that
+    aggregate queries can combine them instead of scanning all data points
+    of their interval (see select_query_partials()). """
+
+from sqlalchemy import Column, Integer, String, Float, and_, bindparam, func, literal, select
+from . import BaseObject
+
+
+class PartialAggregate(BaseObject):
+    """ Database representation of the sum and amount of an attribute of a user in one time bucket. """
+    __tablename__ = 'partial_aggregate'
+
+    source = Column(String, primary_key=True)
+    attribute = Column(String, primary_key=True)
+    user_id = Column(Integer, primary_key=True)
+    bucket_size = Column(Integer, primary_key=True)
+    bucket_start = Column(Integer, primary_key=True)
+    total = Column(Float)
+    count = Column(Integer)
+
+    def __init__(self, source, attribute, user_id, bucket_size, bucket_start, total, count):
+        self.source = source
+        self.attribute = attribute
+        self.user_id = user_id
+        self.bucket_size = bucket_size
+        self.bucket_start = bucket_start
+        self.total = total
+        self.count = count
+
+    def __repr__(self):
+        return "PartialAggregate(source='%s', attribute='%s', user_id='%i', bucket_size='%i', bucket_start='%i', total='%f', count='%i')" % (
+            self.source,
+            self.attribute,
+            self.user_id,
+            self.bucket_size,
+            self.bucket_start,
+            self.total,
+            self.count
+        )
+
+    @staticmethod
+    def attributes(source):
+        """ Return the names of the attributes of a data source class which are aggregated, i.e. all numeric non key columns. """
+        return [c.name for c in source.__table__.columns
+                if not c.primary_key and isinstance(c.type, (Integer, Float))]
+
+    @staticmethod
+    def add(session, source, rows, bucket_sizes):
+        """ Add data points to the partial aggregates.
+
+        Args:
+            - session (db session): session to use, it is not committed
+            - source (class): data source class of the data points
+            - rows (list of dicts): data points as {column: value}, including user_id and timestamp
+            - bucket_sizes (list of int): bucket sizes to maintain in milliseconds """
+        attributes = PartialAggregate.attributes(source)
+        if len(rows) == 0 or len(attributes) == 0:
+            return
+        deltas = {}
+        for row in rows:
+            for size in bucket_sizes:
+                bucket_start = row['timestamp'] - row['timestamp'] % size
+                for a in attributes:
+                    if row.get(a) is None:
+                        continue
+                    delta = deltas.setdefault((a, row['user_id'], size, bucket_start), [0., 0])
+                    delta[0] += row[a]
+                    delta[1] += 1
+        if len(deltas) == 0:
+            return
+
+        table = PartialAggregate.__table__
+        name = source.__tablename__
+        existing = set(session.query(
+            PartialAggregate.attribute,
+            PartialAggregate.user_id,
+            PartialAggregate.bucket_size,
+            PartialAggregate.bucket_start
+        ).filter(
+            PartialAggregate.source == name,
+            PartialAggregate.user_id.in_({key[1] for key in deltas}),
+            PartialAggregate.bucket_size.in_(bucket_sizes),
+            PartialAggregate.bucket_start.between(min(key[3] for key in deltas), max(key[3] for key in deltas))
+        ))
+        updates = []
+        inserts = []
+        for (a, user_id, size, bucket_start), (total, count) in deltas.items():
+            entry = {'a': a, 'u': user_id, 's': size, 'b': bucket_start, 'dt': total, 'dc': count}
+            (updates if (a, user_id, size, bucket_start) in existing else inserts).append(entry)
+        if updates:
+            session.execute(table.update().where(and_(
+                table.c.source == name,
+                table.c.attribute == bindparam('a'),
+                table.c.user_id == bindparam('u'),
+                table.c.bucket_size == bindparam('s'),
+                table.c.bucket_start == bindparam('b')
+            )).values(total=table.c.total + bindparam('dt'), count=table.c['count'] + bindparam('dc')), updates)
+        if inserts:
+            session.execute(table.insert(), [
+                {'source': name, 'attribute': e['a'], 'user_id': e['u'], 'bucket_size': e['s'],
+                 'bucket_start': e['b'], 'total': e['dt'], 'count': e['dc']} for e in inserts])
+
+    @staticmethod
+    def remove(session, source_name, user_id):
+        """ Remove the partial aggregates of a user and data source (given by its table name). """
+        session.query(PartialAggregate).filter(
+            PartialAggregate.source == source_name,
+            PartialAggregate.user_id == user_id
+        ).delete(synchronize_session=False)
+
+    @staticmethod
+    def remove_before(session, source, cutoff):
+        """ Remove the partial aggregates of the data points with timestamps before cutoff, e.g. after dropping them.
+            Buckets containing cutoff are recomputed from the remaining data points. """
+        name = source.__tablename__
+        bucket_sizes = [row[0] for row in session.query(PartialAggregate.bucket_size).filter(
+            PartialAggregate.source == name).distinct()]
+        session.query(PartialAggregate).filter(
+            PartialAggregate.source == name,
+            PartialAggregate.bucket_start < cutoff
+        ).delete(synchronize_session=False)
+        table = source.__table__
+        for size in bucket_sizes:
+            if cutoff % size == 0:
+                continue
+            bucket_end = cutoff - cutoff % size + size
+            rows = [dict(row) for row in session.execute(select([table]).where(and_(
+                table.c.timestamp >= cutoff,
+                table.c.timestamp < bucket_end
+            )))]
+            PartialAggregate.add(session, source, rows, [size])
+
+    @staticmethod
+    def rebuild(session, source, bucket_size):
+        """ Compute the partial aggregates of one data source and bucket size from all its data points. """
+        table = PartialAggregate.__table__
+        name = source.__tablename__
+        session.query(PartialAggregate).filter(
+            PartialAggregate.source == name,
+            PartialAggregate.bucket_size == bucket_size
+        ).delete(synchronize_session=False)
+        bucket_start = (source.timestamp / bucket_size) * bucket_size
+        for a in PartialAggregate.attributes(source):
+            column = getattr(source, a)
+            aggregates = select([
+                literal(name),
+                literal(a),
+                source.user_id,
+                literal(bucket_size),
+                bucket_start,
+                func.sum(column),
+                func.count(column)
+            ]).where(column.isnot(None)).group_by(source.user_id, bucket_start)
+            session.execute(table.insert().from_select(
+                ['source', 'attribute', 'user_id', 'bucket_size', 'bucket_start', 'total', 'count'], aggregates))
+        session.commit()
+
+    @staticmethod
+    def ensure_populated(session, sources, bucket_sizes):
+        """ Build the partial aggregates of every data source and bucket size which has data points but no aggregates,
+            e.g. after adding a bucket size to the configuration. """
+        for source in sources:
+            if len(PartialAggregate.attributes(source)) == 0:
+                continue
+            for size in bucket_sizes:
+                has_aggregates = session.query(PartialAggregate.source).filter(
+                    PartialAggregate.source == source.__tablename__,
+                    PartialAggregate.bucket_size == size
+                ).first() is not None
+                if not has_aggregates and session.query(source.user_id).first() is not None:
+                    PartialAggregate.rebuild(session, source, size)
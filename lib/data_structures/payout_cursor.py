@@ -0,0 +1,22 @@
+""" This module defines the database representation of the position of the payout in the users. """
+
+from sqlalchemy import Column, Integer, String
+from . import BaseObject
+
+
+class PayoutCursor(BaseObject):
+    """ Database representation of the last user examined by a task, e.g. by pay_out() in its shards. """
+    __tablename__ = 'payout_cursor'
+
+    name = Column(String, primary_key=True)
+    user_id = Column(Integer)
+
+    def __init__(self, name, user_id):
+        self.name = name
+        self.user_id = user_id
+
+    def __repr__(self):
+        return "<PayoutCursor(name='%s', user_id='%s')>" % (
+            self.name,
+            self.user_id
+        )
@@ -1,12 +1,14 @@
 """ This module defines the database representation of a PIN query. """
 
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import Column, Index, Integer, String
 from . import BaseObject
 
 
 class Pin_Query_Db(BaseObject):
     """ Database representation of a PIN query. """
     __tablename__ = 'pin_query_db'
+    # pending queries are looked up by the end of their consent phase (see process_queries)
+    __table_args__ = (Index('ix_pin_query_db_state_consent_finish_time', 'state', 'consent_finish_time'),)
 
     processor_id = Column(Integer, primary_key=True)
     query_id = Column(Integer, primary_key=True)
@@ -18,8 +20,10 @@ class Pin_Query_Db(BaseObject):
     consent_finish_time = Column(Integer)
     state = Column(String)
     result = Column(String)
+    # JSON of the plan of the query (see lib.backend.tasks.query.plan), None for queries registered before plans were stored
+    plan = Column(String)
 
-    def __init__(self, processor_id, query_id, query, pin, session_id, consent_start_time, consent_finish_time, state, result):
+    def __init__(self, processor_id, query_id, query, pin, session_id, consent_start_time, consent_finish_time, state, result, plan=None):
         self.processor_id = processor_id
         self.query_id = query_id
         self.query = query
@@ -30,6 +34,7 @@ class Pin_Query_Db(BaseObject):
         self.consent_finish_time = consent_finish_time
         self.state = state
         self.result = result
+        self.plan = plan
 
     def __repr__(self):
         return "Pin_Query('%i', '%i', '%s', '%i', '%i', '%i', '%i', '%s', '%s')" % (
@@ -43,3 +48,7 @@ class Pin_Query_Db(BaseObject):
             self.state,
             self.result
         )
+
+    def as_dict(self):
+        """ Dictionary representation. """
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
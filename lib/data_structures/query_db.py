@@ -1,6 +1,6 @@
 """ This module defines the database representation of a query. """
 
-from sqlalchemy import Column, Integer, String, Enum as DbEnum
+from sqlalchemy import Column, Index, Integer, String, Enum as DbEnum
 from lib.data_structures import QueryState
 from . import BaseObject
 
@@ -8,6 +8,8 @@ from . import BaseObject
 class Query_Db(BaseObject):
     """ Database representation of a query. """
     __tablename__ = 'query_db'
+    # pending queries are looked up by the end of their consent phase (see process_queries)
+    __table_args__ = (Index('ix_query_db_state_consent_finish_time', 'state', 'consent_finish_time'),)
 
     processor_id = Column(Integer, primary_key=True)
     query_id = Column(Integer, primary_key=True)
@@ -22,12 +24,14 @@ class Query_Db(BaseObject):
     max_privacy = Column(Integer)
     state = Column(DbEnum(QueryState))
     result = Column(String)
-    address = Column(String)
+    address = Column(String, index=True)
     title = Column(String)
     description = Column(String)
     goal_description = Column(String)
     usedDataTypes = Column(String)
     thumbnail_url = Column(String)
+    # JSON of the plan of the query (see lib.backend.tasks.query.plan), None for queries registered before plans were stored
+    plan = Column(String)
 
     def __init__(
             self,
@@ -49,7 +53,8 @@ class Query_Db(BaseObject):
             goal_description,
             usedDataTypes,
             thumbnail_url,
-            address=None):
+            address=None,
+            plan=None):
         self.processor_id = processor_id
         self.query_id = query_id
         self.query = query
@@ -69,6 +74,7 @@ class Query_Db(BaseObject):
         self.description = description
         self.goal_description = goal_description
         self.thumbnail_url = thumbnail_url
+        self.plan = plan
 
     def __repr__(self):
         return "Query('%i', '%i', '%s', '%i', '%i', '%i', '%i', '%i', '%i', '%i', '%i', '%s', '%s', '%s', '%s', '%s', '%s', '%s')" % (
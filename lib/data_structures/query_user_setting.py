@@ -0,0 +1,116 @@
+""" Module to store the settings of the users of a query for its relevant
+    attributes: one row per user, query and attribute holding the privacy
+    level and the finest and coarsest upload granularity during the query
+    interval (see select_users()). The settings of all users of a query are
+    written and loaded at once. They are removed together with the query or
+    the account of the user. """
+
+from sqlalchemy import Column, Integer, String, and_, select
+from . import BaseObject
+from .query_user import QueryUser
+
+
+class QueryUserSetting(BaseObject):
+    """ Database representation of the setting of a user for one attribute of a query. """
+    __tablename__ = 'query_user_setting'
+
+    proc_id = Column(Integer, primary_key=True)
+    query_id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, primary_key=True)
+    position = Column(Integer, primary_key=True)
+    data_source = Column(String)
+    attribute = Column(String)
+    privacy_level = Column(Integer)
+    fine_granularity = Column(Integer)
+    coarse_granularity = Column(Integer)
+
+    def __init__(self, proc_id, query_id, user_id, position, data_source, attribute, privacy_level, fine_granularity, coarse_granularity):
+        self.proc_id = proc_id
+        self.query_id = query_id
+        self.user_id = user_id
+        self.position = position
+        self.data_source = data_source
+        self.attribute = attribute
+        self.privacy_level = privacy_level
+        self.fine_granularity = fine_granularity
+        self.coarse_granularity = coarse_granularity
+
+    def __repr__(self):
+        return "QueryUserSetting(proc_id='%i', query_id='%i', user_id='%i', position='%i', data_source='%s', attribute='%s', privacy_level='%i', fine_granularity='%i', coarse_granularity='%i')" % (
+            self.proc_id,
+            self.query_id,
+            self.user_id,
+            self.position,
+            self.data_source,
+            self.attribute,
+            self.privacy_level,
+            self.fine_granularity,
+            self.coarse_granularity
+        )
+
+    @staticmethod
+    def add(session, proc_id, query_id, users):
+        """ Add the settings of users to a query.
+
+        Args:
+            - session (db session): session to use, it is not committed
+            - proc_id (int): processor id
+            - query_id (int): query id
+            - users (dict): settings as returned by select_users(), i.e. {user_id: [[data_source, attribute, a, fg, cg], ...]} """
+        rows = [
+            {'proc_id': proc_id, 'query_id': query_id, 'user_id': user_id, 'position': position,
+             'data_source': setting[0], 'attribute': setting[1], 'privacy_level': setting[2],
+             'fine_granularity': setting[3], 'coarse_granularity': setting[4]}
+            for user_id, settings in users.items() for position, setting in enumerate(settings)
+        ]
+        if rows:
+            session.execute(QueryUserSetting.__table__.insert(), rows)
+
+    @staticmethod
+    def remove(session, proc_id, query_id):
+        """ Remove the settings of all users of a query. """
+        session.query(QueryUserSetting).filter(
+            QueryUserSetting.proc_id == proc_id,
+            QueryUserSetting.query_id == query_id
+        ).delete(synchronize_session=False)
+
+    @staticmethod
+    def remove_user(session, user_id):
+        """ Remove the settings of a user for all queries. """
+        session.query(QueryUserSetting).filter(QueryUserSetting.user_id == user_id).delete(synchronize_session=False)
+
+    @staticmethod
+    def load(session, proc_id, query_id, consent=None):
+        """ Return the settings of the users of a query in the form of select_users().
+
+        Args:
+            - session (db session): session to use
+            - proc_id (int): processor id
+            - query_id (int): query id
+            - consent (QueryState): only return the settings of users with this consent, None for all users
+
+        Returns:
+            - dict: {user_id: [[data_source, attribute, a, fg, cg], ...]} """
+        table = QueryUserSetting.__table__
+        statement = select([
+            table.c.user_id,
+            table.c.data_source,
+            table.c.attribute,
+            table.c.privacy_level,
+            table.c.fine_granularity,
+            table.c.coarse_granularity
+        ]).where(and_(
+            table.c.proc_id == proc_id,
+            table.c.query_id == query_id
+        )).order_by(table.c.user_id, table.c.position)
+        if consent is not None:
+            users = QueryUser.__table__
+            statement = statement.select_from(table.join(users, and_(
+                users.c.proc_id == table.c.proc_id,
+                users.c.query_id == table.c.query_id,
+                users.c.user_id == table.c.user_id
+            ))).where(users.c.consent == consent)
+        settings = {}
+        for user_id, data_source, attribute, privacy_level, fine_granularity, coarse_granularity in session.execute(statement):
+            settings.setdefault(user_id, []).append([data_source, attribute, privacy_level, fine_granularity, coarse_granularity])
+        return settings
@@ -1,7 +1,11 @@
 """ This module defines a basic token. """
 
-import time
+from collections import OrderedDict
+import hashlib
 import logging
+import threading
+import time
+
 from jose import JWTError, ExpiredSignatureError, jwt
 
 from sqlalchemy import Column, Integer, String
@@ -87,6 +91,43 @@ class JwtToken(BaseObject):
         jwttoken = jwt.encode(payload, 'jwtsecret', algorithm='HS256')
         return JwtToken(user_id, jwttoken)
 
+    @staticmethod
+    def generate_task_handle(user_id, task_id, scope):
+        """ Create a handle allowing a user or processor to poll an asynchronously dispatched task.
+
+        Args:
+            - user_id (int): id of the user or processor who dispatched the task
+            - task_id (str): celery task id
+            - scope (str): scope a token needs for polling, i.e. 'user' or 'processor'
+
+        Returns:
+            - JWT token: (str)
+        """
+        JWT_LIFETIME_SECONDS = 3600
+        timestamp = _current_timestamp()
+        payload = {
+            "iss": 'Mynedata',
+            "iat": timestamp,
+            "exp": timestamp + JWT_LIFETIME_SECONDS,
+            "sub": str(user_id),
+            "purpose": "task",
+            "task": str(task_id),
+            "scope": scope,
+        }
+
+        return jwt.encode(payload, 'jwtsecret', algorithm='HS256')
+
+    @staticmethod
+    def decode_task_handle(handle):
+        """ Decode a task handle, None if it is invalid or expired. """
+        try:
+            tok = jwt.decode(handle, 'jwtsecret', issuer='Mynedata', algorithms=['HS256'])
+        except JWTError:
+            return None
+        if tok.get('purpose') != 'task':
+            return None
+        return tok
+
     @staticmethod
     def decode_token(user_id, token):
         """ Decode an authentication token. """
@@ -114,12 +155,47 @@ class JwtToken(BaseObject):
     def check_token(tok, user_id, scope=None):
         """ Check validity of an authentication token. """
         try:
-            token = JwtToken.decode_token(user_id, tok)
-            token['scope'] = token['scope'].split(' ')
-            # Special case: 'everyone' scope takes any user name
-            validity_condition = (token['purpose'] == 'general' and scope in token['scope'])
-            if scope != 'everyone':
-                validity_condition = (token['sub'] == str(user_id) and validity_condition)
-            return validity_condition
+            token = JwtToken.verified_claims(tok)
+            # the subject is compared for every scope, including 'everyone'
+            return token['sub'] == str(user_id) and token['purpose'] == 'general' and scope in token['scope']
         except Exception as e:
             return False
+
+    # bounded cache of verified tokens: {sha256 of token: claims with scope split into a list}
+    cache_size = 1024
+    cache_hits = 0
+    cache_misses = 0
+    _cache = OrderedDict()
+    _cache_lock = threading.Lock()
+
+    @staticmethod
+    def verified_claims(tok):
+        """ Verify a token and return its claims, the scope split into a list.
+
+            Verified claims are cached until the token expires, such that
+            repeated checks of the same token skip the signature verification.
+            The subject is not verified, this is up to the caller.
+
+        Raises:
+            - JWTError: if the token is invalid or expired """
+        digest = hashlib.sha256(tok.encode() if isinstance(tok, str) else tok).digest()
+        now = _current_timestamp()
+        with JwtToken._cache_lock:
+            claims = JwtToken._cache.get(digest)
+            if claims is not None:
+                if claims['exp'] > now:
+                    JwtToken._cache.move_to_end(digest)
+                    JwtToken.cache_hits += 1
+                    return claims
+                del JwtToken._cache[digest]
+            JwtToken.cache_misses += 1
+
+        claims = jwt.decode(tok, 'jwtsecret', issuer='Mynedata', algorithms=['HS256'])
+        claims['scope'] = claims['scope'].split(' ')
+        if 'exp' not in claims:
+            return claims
+        with JwtToken._cache_lock:
+            JwtToken._cache[digest] = claims
+            while len(JwtToken._cache) > JwtToken.cache_size:
+                JwtToken._cache.popitem(last=False)
+        return claims
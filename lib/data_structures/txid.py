@@ -1,12 +1,14 @@
 """ This module defines the database representation of a (Bitcoin) transaction ID. """
 
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import Column, Index, Integer, String, func
 from . import BaseObject
 
 
 class Txid(BaseObject):
     """ Database representation of a (Bitcoin) transaction ID. """
     __tablename__ = 'txid'
+    # a transaction is mapped to a query at most once (see add_all)
+    __table_args__ = (Index('ux_txid_tx_id_query_id_proc_id', 'tx_id', 'query_id', 'proc_id', unique=True),)
     id = Column(Integer, primary_key=True)
     tx_id = Column(String(250))
     query_id = Column(Integer)
@@ -22,3 +24,34 @@ class Txid(BaseObject):
             self.query_id,
             self.tx_id
         )
+
+    @staticmethod
+    def add_all(session, mappings):
+        """ Insert mappings of transactions to queries, skipping the ones which already exist.
+
+        Args:
+            - session (db session): session to use, it is not committed
+            - mappings (iterable of tuples): (tx_id, query_id, proc_id) """
+        rows = [{'tx_id': tx_id, 'query_id': query_id, 'proc_id': proc_id} for tx_id, query_id, proc_id in set(mappings)]
+        if len(rows) == 0:
+            return
+        table = Txid.__table__
+        dialect = session.bind.dialect.name
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+            session.execute(insert(table).on_conflict_do_nothing(index_elements=['tx_id', 'query_id', 'proc_id']), rows)
+        elif dialect == 'sqlite':
+            session.execute(table.insert().prefix_with('OR IGNORE'), rows)
+        else:
+            existing = set(session.query(Txid.tx_id, Txid.query_id, Txid.proc_id).filter(Txid.tx_id.in_({r['tx_id'] for r in rows})))
+            rows = [r for r in rows if (r['tx_id'], r['query_id'], r['proc_id']) not in existing]
+            if rows:
+                session.execute(table.insert(), rows)
+
+    @staticmethod
+    def remove_duplicates(session):
+        """ Delete all but the first of duplicate mappings, which were possible before the unique index existed. """
+        first_ids = session.query(func.min(Txid.id)).group_by(Txid.tx_id, Txid.query_id, Txid.proc_id)
+        removed = session.query(Txid).filter(Txid.id.notin_(first_ids.subquery())).delete(synchronize_session=False)
+        session.commit()
+        return removed